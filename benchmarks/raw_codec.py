@@ -0,0 +1,88 @@
+"""Micro benchmark for the raw collector payload serializers.
+
+Compares the compiled encoders/decoders with the previous
+model_dump + fastavro / thriftpy2 implementation. The "raw" decoders
+return a RawCollectorPayload instead of the pydantic model.
+
+    python benchmarks/raw_codec.py
+"""
+import timeit
+from io import BytesIO
+
+from fastavro import schemaless_reader, schemaless_writer
+from thriftpy2.protocol.binary import TBinaryProtocol
+
+from datenstrom.common.schema.raw import (
+    AVRO_SCHEMA, CollectorPayload, TCollectorPayload,
+    to_avro, from_avro, decode_avro, to_thrift, from_thrift, decode_thrift,
+)
+
+
+def make_payload() -> CollectorPayload:
+    return CollectorPayload(
+        schema="CollectorPayload",
+        ipAddress="127.0.0.1",
+        timestamp=1700000000000,
+        encoding="UTF-8",
+        collector="datenstrom-0.1.0",
+        userAgent="Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36",
+        refererUri="https://www.example.com/products/1",
+        path="/com.snowplowanalytics.snowplow/tp2",
+        body=b'{"schema":"iglu:com.snowplowanalytics.snowplow/payload_data/jsonschema/1-0-4",'
+             b'"data":[{"e":"pv","url":"https://www.example.com/products/1","tv":"js-3.0.0"}]}',
+        headers=["Host: collector.example.com", "Accept: */*", "Accept-Language: en-US",
+                 "User-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36"],
+        contentType="application/json",
+        hostname="collector.example.com",
+        networkUserId="c5f6ad3a-8ab7-4b1a-9d1c-2f1b3e8a7f10",
+    )
+
+
+def legacy_to_avro(e):
+    o = BytesIO()
+    schemaless_writer(o, AVRO_SCHEMA, e.model_dump(by_alias=True))
+    return o.getvalue()
+
+
+def legacy_from_avro(b):
+    return CollectorPayload(**schemaless_reader(BytesIO(b), AVRO_SCHEMA))
+
+
+def legacy_to_thrift(e):
+    o = BytesIO()
+    TBinaryProtocol(o).write_struct(TCollectorPayload(**e.model_dump(by_alias=True)))
+    return o.getvalue()
+
+
+def legacy_from_thrift(b):
+    te = TCollectorPayload()
+    TBinaryProtocol(BytesIO(b)).read_struct(te)
+    return CollectorPayload(**{k: getattr(te, k) for _, k, *_ in TCollectorPayload.thrift_spec.values()})
+
+
+def bench(name, fn, number):
+    seconds = min(timeit.repeat(fn, number=number, repeat=5))
+    print(f"{name:<24} {seconds / number * 1e6:8.2f} us/op")
+
+
+def main(number: int = 20000):
+    p = make_payload()
+    avro = to_avro(p)
+    thrift = to_thrift(p)
+    assert legacy_to_avro(p) == avro
+    assert legacy_to_thrift(p) == thrift
+
+    bench("avro encode (legacy)", lambda: legacy_to_avro(p), number)
+    bench("avro encode", lambda: to_avro(p), number)
+    bench("avro decode (legacy)", lambda: legacy_from_avro(avro), number)
+    bench("avro decode", lambda: from_avro(avro), number)
+    bench("avro decode (raw)", lambda: decode_avro(avro), number)
+    bench("thrift encode (legacy)", lambda: legacy_to_thrift(p), number)
+    bench("thrift encode", lambda: to_thrift(p), number)
+    bench("thrift decode (legacy)", lambda: legacy_from_thrift(thrift), number)
+    bench("thrift decode", lambda: from_thrift(thrift), number)
+    bench("thrift decode (raw)", lambda: decode_thrift(thrift), number)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,40 @@
+"""Micro benchmark for inserts into common.cache.TTLCache.
+
+Fills caches of increasing size with a mix of values and None values
+(which use the shorter none_ttl) and measures the cost of inserting new
+keys into the full cache. The insert cost should not grow with the size.
+
+    python benchmarks/ttl_cache.py
+"""
+import time
+import timeit
+
+from datenstrom.common.cache import TTLCache
+
+
+SIZES = [1_000, 10_000, 100_000]
+INSERTS = 20_000
+
+
+def fill(size: int) -> TTLCache:
+    cache = TTLCache(maxsize=size, ttl=3600, none_ttl=300, timer=time.monotonic)
+    for i in range(size):
+        cache[i] = None if i % 4 == 0 else i
+    return cache
+
+
+def main():
+    for size in SIZES:
+        cache = fill(size)
+        keys = iter(range(size, size + 10 * INSERTS))
+
+        def insert():
+            k = next(keys)
+            cache[k] = None if k % 4 == 0 else k
+
+        seconds = min(timeit.repeat(insert, number=INSERTS, repeat=5))
+        print(f"{size:>8} entries: {seconds / INSERTS * 1e6:8.2f} us/insert")
+
+
+if __name__ == "__main__":
+    main()
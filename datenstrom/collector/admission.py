@@ -0,0 +1,86 @@
+import logging
+
+from typing import Callable, Optional, Tuple
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from datenstrom.collector.cors import CORSPolicy, get_origin
+from datenstrom.common.metrics import metrics
+
+
+# liveness, readiness and informational endpoints are always served
+EXEMPT_PATHS = frozenset(["/", "/health", "/ready", "/docs", "/openapi.json"])
+
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionController:
+    """Rejects new requests while the sink backlog is above a high-water mark.
+
+    `backlog` returns the number of records and bytes that were accepted
+    but not delivered yet. Once one of the limits is reached the collector
+    is overloaded until both values drop below `low_water` times the limits.
+    """
+
+    def __init__(self, backlog: Callable[[], Tuple[int, int]], max_records: int,
+                 max_bytes: int, low_water: float = 0.5, retry_after: int = 5):
+        self.backlog = backlog
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.low_records = int(max_records * low_water)
+        self.low_bytes = int(max_bytes * low_water)
+        self.retry_after = retry_after
+        self.overloaded = False
+
+    @classmethod
+    def from_config(
+        cls, config, backlog: Callable[[], Tuple[int, int]]
+    ) -> "AdmissionController":
+        return cls(backlog, max_records=config.admission_max_records,
+                   max_bytes=config.admission_max_bytes,
+                   low_water=config.admission_low_water,
+                   retry_after=config.admission_retry_after)
+
+    def admit(self) -> bool:
+        records, size = self.backlog()
+        if self.overloaded:
+            if records <= self.low_records and size <= self.low_bytes:
+                self.overloaded = False
+                logger.info("sink backlog recovered (%d records, %d bytes)", records, size)
+        elif records >= self.max_records or size >= self.max_bytes:
+            self.overloaded = True
+            metrics.incr("collector.overloaded")
+            logger.warning(
+                "sink backlog too large (%d records, %d bytes), rejecting requests",
+                records,
+                size,
+            )
+        return not self.overloaded
+
+    @property
+    def ready(self) -> bool:
+        return self.admit()
+
+
+class AdmissionMiddleware:
+    """Answers 503 with Retry-After while the admission controller rejects."""
+
+    def __init__(self, app: ASGIApp, controller: AdmissionController,
+                 cors: Optional[CORSPolicy] = None):
+        self.app = app
+        self.controller = controller
+        self.cors = cors
+        self.retry_after = str(controller.retry_after).encode("latin-1")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if (scope["type"] != "http" or scope["method"] == "OPTIONS"
+                or scope["path"] in EXEMPT_PATHS or self.controller.admit()):
+            await self.app(scope, receive, send)
+            return
+        metrics.incr("collector.rejected")
+        headers = [(b"content-length", b"0"), (b"retry-after", self.retry_after)]
+        if self.cors is not None:
+            headers.extend(self.cors.headers_for(get_origin(scope)))
+        await send({"type": "http.response.start", "status": 503, "headers": headers})
+        await send({"type": "http.response.body", "body": b""})
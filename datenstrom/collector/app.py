@@ -1,23 +1,21 @@
-from fastapi import FastAPI, Request, Response
+import logging
 
-from datenstrom.settings import get_settings
+from typing import Optional, Tuple
+from fastapi import FastAPI
 
+from datenstrom.settings import BaseConfig, get_settings
+from datenstrom.collector.cors import CORSMiddleware, CORSPolicy
+from datenstrom.collector.collect import (
+    PayloadRejected,
+    payload_rejected_handler,
+    sink_full_handler,
+)
+from datenstrom.connectors.sinks.base import SinkFullError
+from datenstrom.connectors.keys import key_extractor
+from datenstrom.common.metrics import metrics, setup_logging, start_reporter, stop_reporter
 
-async def cors_preflight(request: Request, call_next):
-    if request.method == "OPTIONS":
-        response = Response(status_code=200)
-    else:
-        response = await call_next(request)
-    # try to get domain out of Origin header
-    origin = request.headers.get("Origin")
-    if origin:
-        response.headers["Access-Control-Allow-Origin"] = origin
-    else:
-        response.headers["Access-Control-Allow-Origin"] = "*"
-    response.headers["Access-Control-Allow-Credentials"] = "true"
-    response.headers["Access-Control-Max-Age"] = "3600"
-    response.headers["Access-Control-Allow-Headers"] = "Content-Type, SP-Anonymous, Anonymous, Origin, Referer, User-Agent"
-    return response
+
+logger = logging.getLogger(__name__)
 
 
 api_description = """
@@ -25,29 +23,137 @@ Datenstrom Collector API with support for Snowplow Trackers.
 """
 
 
-def create_app() -> FastAPI:
+def start_sinks(app: FastAPI):
+    """Create the sink and the writer in front of it, does nothing if they exist."""
+    if app.state.sink is not None:
+        return
+    config = app.config
+    if config.transport == "kafka":
+        from datenstrom.connectors.sinks.kafka import KafkaSink
+        sink = KafkaSink(config=config, queue_type="raw")
+    elif config.transport == "dev":
+        from datenstrom.connectors.sinks.dev import DevSink
+        sink = DevSink(config=config, queue_type="raw")
+    elif config.transport == "sqs":
+        from datenstrom.connectors.sinks.sqs import SQSSink
+        sink = SQSSink(config=config, queue_type="raw")
+    else:
+        raise ValueError(f"Unknown transport sink: {config.transport}")
+    app.state.sink = sink
+
+    log = None
+    if config.spill_enabled:
+        from datenstrom.connectors.sinks.spill import SpillLog, SpillLogLocked
+        try:
+            log = SpillLog(config.spill_directory, segment_bytes=config.spill_segment_bytes,
+                           max_bytes=config.spill_max_bytes, fsync=config.spill_fsync)
+        except SpillLogLocked as e:
+            # several workers of one uvicorn or gunicorn process,
+            # see datenstrom.collector.server
+            logger.error("spilling disabled in this worker: %s", e)
+    if log is not None:
+        from datenstrom.connectors.sinks.spill import SpillingSink
+        sink = SpillingSink(sink, log, batch_records=config.spill_replay_batch_records,
+                            retry_interval=config.spill_retry_interval)
+        metrics.register_gauge("collector.spill_bytes", lambda: log.size)
+
+    # spill log writes and fsyncs must not run on the event loop
+    if config.collector_batch_enabled or config.spill_enabled:
+        from datenstrom.connectors.sinks.batch import BatchingSink
+        sink = BatchingSink(
+            sink,
+            max_records=config.collector_batch_max_records,
+            max_bytes=config.collector_batch_max_bytes,
+            linger_ms=config.collector_batch_linger_ms,
+            max_buffer_records=config.collector_batch_max_buffer_records,
+            max_buffer_bytes=config.collector_batch_max_buffer_bytes,
+        )
+    app.state.writer = sink
+
+
+def stop_sinks(app: FastAPI):
+    """Flush and close the writer and the sinks behind it."""
+    writer = app.state.writer
+    if writer is None:
+        return
+    app.state.writer = None
+    app.state.sink = None
+    writer.close()
+
+
+def sink_backlog(app: FastAPI) -> Tuple[int, int]:
+    if app.state.writer is None:
+        return 0, 0
+    return app.state.writer.backlog()
+
+
+def create_app(config: Optional[BaseConfig] = None, lazy_sinks: bool = False) -> FastAPI:
     app = FastAPI(
         title="Datenstrom Collector",
         description=api_description,
         version="1.0.0",
     )
 
-    config = get_settings()
+    if config is None:
+        config = get_settings()
     app.config = config
 
-    app.middleware("http")(cors_preflight)
+    setup_logging(config.log_level)
+    from datenstrom.collector.collect import sampled_logger
+    sampled_logger.rate = config.log_sample_rate
 
-    if config.transport == "kafka":
-        from datenstrom.connectors.sinks.kafka import KafkaSink
-        app.state.sink = KafkaSink(config=config, queue_type="raw")
-    elif config.transport == "dev":
-        from datenstrom.connectors.sinks.dev import DevSink
-        app.state.sink = DevSink(config=config, queue_type="raw")
-    elif config.transport == "sqs":
-        from datenstrom.connectors.sinks.sqs import SQSSink
-        app.state.sink = SQSSink(config=config, queue_type="raw")
+    cors_policy = CORSPolicy(allowed_origins=config.cors_allowed_origins,
+                             max_age=config.cors_max_age)
+    app.add_middleware(CORSMiddleware, policy=cors_policy)
+    if config.collector_fast_path:
+        # added last so it runs ahead of the CORS middleware and the router
+        from datenstrom.collector.fastpath import FastPathMiddleware
+        app.add_middleware(FastPathMiddleware, config=config, cors=cors_policy)
+
+    from datenstrom.collector.collect import HeaderFilter
+    app.state.header_filter = HeaderFilter.from_config(config)
+    app.state.partition_key = key_extractor(config.partition_key_raw)
+
+    if config.remote_config_endpoint and config.remote_config_shared:
+        from datenstrom.common.shared_cache import SharedRemoteConfigClient
+        app.state.remote_config = SharedRemoteConfigClient.from_config(config)
+        app.add_event_handler("shutdown", app.state.remote_config.close)
+    elif config.remote_config_endpoint:
+        from datenstrom.collector.remote_config import AsyncRemoteConfigClient
+        app.state.remote_config = AsyncRemoteConfigClient.from_config(config)
+        app.add_event_handler("shutdown", app.state.remote_config.close)
     else:
-        raise ValueError(f"Unknown transport sink: {config.transport}")
+        app.state.remote_config = None
+
+    app.state.sink = None
+    app.state.writer = None
+    if lazy_sinks:
+        # created in the worker process, producers must not be inherited across fork()
+        app.add_event_handler("startup", lambda: start_sinks(app))
+    else:
+        start_sinks(app)
+    app.add_event_handler("shutdown", lambda: stop_sinks(app))
+
+    metrics.register_gauge("collector.queue_depth",
+                           lambda: getattr(app.state.writer, "queue_depth", 0))
+    metrics.register_gauge("collector.backlog_records", lambda: sink_backlog(app)[0])
+    metrics.register_gauge("collector.backlog_bytes", lambda: sink_backlog(app)[1])
+
+    if config.admission_enabled:
+        from datenstrom.collector.admission import AdmissionController, AdmissionMiddleware
+        app.state.admission = AdmissionController.from_config(
+            config, lambda: sink_backlog(app)
+        )
+        # added last so it rejects before any other work is done
+        app.add_middleware(
+            AdmissionMiddleware, controller=app.state.admission, cors=cors_policy
+        )
+    else:
+        app.state.admission = None
+    app.add_exception_handler(SinkFullError, sink_full_handler)
+    app.add_exception_handler(PayloadRejected, payload_rejected_handler)
+    app.add_event_handler("startup", lambda: start_reporter(config.metrics_interval))
+    app.add_event_handler("shutdown", stop_reporter)
 
     from datenstrom.collector.routes import add_vendor_path, router, add_redirect_routes
     app.include_router(router)
@@ -1,16 +1,27 @@
 import time
 import uuid
+import zlib
+import logging
+import orjson
+import http.cookies
 from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
 
 from urllib.parse import urlparse
-from typing import Optional, List, Dict, Any, NamedTuple
-from fastapi import Request, Response
-
-from datenstrom.common.schema.raw import CollectorPayload, PayloadException
-from datenstrom.common.cache import CachedRequestClient
+from typing import Optional, List, Dict, Any, NamedTuple, Iterable, Tuple
+from fastapi import FastAPI, Request, Response
 
+from datenstrom.common.schema.raw import (
+    RawCollectorPayload, PayloadException, PayloadTooLargeException
+)
+from datenstrom.common.metrics import metrics, SampledLogger
+from datenstrom.connectors.sinks.base import SinkFullError
+from datenstrom.connectors.keys import ANONYMOUS_USER_ID
 
-httpclient = CachedRequestClient(maxsize=2048, ttl=3600, none_ttl=300)
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
 
 
 COLLECTOR_NAME = "datenstrom-0.1.0"
@@ -18,25 +29,91 @@ PIXEL_GIF = (
     b"GIF89a\x01\x00\x01\x00\x80\x00\x00\xff\xff\xff\x00\x00\x00!\xf9\x04"
     b"\x01\x00\x00\x00\x00,\x00\x00\x00\x00\x01\x00\x01\x00\x00\x02\x02D\x01\x00;"
 )
-ANONYMOUS_USER_ID = "00000000-0000-0000-0000-000000000000"
 HEADER_FILTER = ["remote-address", "raw-request-uri", "timeout-access"]
 ANONYMOUS_HEADER_FILTER = ["cookie", "x-forwarded-for", "x-real-ip"]
 
 ENABLE_COOKIES_DEFAULT = False
+HEADER_CACHE_SIZE = 1024
+# brotli < 1.2 cannot limit the output, the input is fed in tiny
+# chunks instead to check the output size as often as possible
+BROTLI_CHUNK_SIZE = 64
+
+
+logger = logging.getLogger(__name__)
+sampled_logger = SampledLogger(logger, rate=0.01)
 
 
 class RemoteCollectorConfig(NamedTuple):
     enable_cookies: bool
 
 
+class PayloadRejected(Exception):
+    """The request is answered with an error status and nothing is written."""
+
+    def __init__(self, status_code: int, reason: str):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+
+
 def get_milliseconds():
     return int(time.time() * 1000)
 
 
-def get_host_from_url(url: str) -> str:
+def get_host_from_url(url: Optional[str]) -> Optional[str]:
+    if not url:
+        return None
     return urlparse(url).hostname
 
 
+def should_set_cookie(anonymous: bool = False,
+                      collector_config: Optional[RemoteCollectorConfig] = None) -> bool:
+    if anonymous:
+        return False
+    if collector_config and not collector_config.enable_cookies:
+        return False
+    # enable / disable cookies per default
+    if not collector_config and not ENABLE_COOKIES_DEFAULT:
+        return False
+    return True
+
+
+def get_cookie_domain(config: Any, origin: Optional[str]) -> Optional[str]:
+    # extract host from origins
+    host = get_host_from_url(origin)
+    # get possible domains from config
+    cookie_domain = None
+    cookie_domains = config.cookie_domains or []
+    if host:
+        for c in cookie_domains:
+            if host.endswith(c):
+                cookie_domain = host
+                break
+    if not cookie_domain and config.cookie_fallback_domain:
+        cookie_domain = config.cookie_fallback_domain
+    return cookie_domain
+
+
+def make_cookie_header(config: Any, user_id: str, origin: Optional[str]) -> bytes:
+    """Build the raw set-cookie header value (same output as Response.set_cookie)."""
+    key = config.cookie_name
+    cookie = http.cookies.SimpleCookie()
+    cookie[key] = user_id
+    expires = datetime.now(timezone.utc) + timedelta(days=config.cookie_expiration_days)
+    cookie[key]["expires"] = format_datetime(expires, usegmt=True)
+    cookie[key]["path"] = "/"
+    domain = get_cookie_domain(config, origin)
+    if domain is not None:
+        cookie[key]["domain"] = domain
+    if config.cookie_secure:
+        cookie[key]["secure"] = True
+    if config.cookie_http_only:
+        cookie[key]["httponly"] = True
+    if config.cookie_same_site is not None:
+        cookie[key]["samesite"] = config.cookie_same_site
+    return cookie.output(header="").strip().encode("latin-1")
+
+
 def make_response(request: Request, pixel: bool = False,
                   status_code: int = 200, anonymous: bool = False,
                   user_id: Optional[str] = None, redirect: Optional[str] = None,
@@ -50,76 +127,134 @@ def make_response(request: Request, pixel: bool = False,
         r = Response(status_code=status_code)
 
     # check if we should set a cookie
-    if anonymous:
-        return r
-    if collector_config and not collector_config.enable_cookies:
-        return r
-    # enable / disable cookies per default
-    if not collector_config and not ENABLE_COOKIES_DEFAULT:
-        return r
-    if user_id:
-        # get Origin from header
+    if user_id and should_set_cookie(anonymous, collector_config):
         origin = request.headers.get("Origin")
-        # extract host from origins
-        host = get_host_from_url(origin)
-        # get possible domains from config
-        cookie_domain = None
-        cookie_domains = request.app.config.cookie_domains or []
-        for c in cookie_domains:
-            if host.endswith(c):
-                cookie_domain = host
-                break
-        if not cookie_domain and request.app.config.cookie_fallback_domain:
-            cookie_domain = request.app.config.cookie_fallback_domain
-        r.set_cookie(
-            key=request.app.config.cookie_name,
-            value=user_id,
-            expires=datetime.now(timezone.utc) + timedelta(days=request.app.config.cookie_expiration_days),
-            domain=cookie_domain,
-            secure=request.app.config.cookie_secure,
-            httponly=request.app.config.cookie_http_only,
-            samesite=request.app.config.cookie_same_site,
+        r.raw_headers.append(
+            (b"set-cookie", make_cookie_header(request.app.config, user_id, origin))
         )
     return r
 
 
-def get_collector_config(request: Request) -> Optional[RemoteCollectorConfig]:
-    app_config = request.app.config
-    if app_config.remote_config_endpoint:
-        url = f"{app_config.remote_config_endpoint}?hostname={request.url.hostname}"
-        config = httpclient.get_json(url, timeout=5)
-        if config:
-            if "enable_cookies" in config and isinstance(config["enable_cookies"], bool):
-                return RemoteCollectorConfig(enable_cookies=config["enable_cookies"])
+def parse_collector_config(
+    config: Optional[Dict[str, Any]],
+) -> Optional[RemoteCollectorConfig]:
+    if config:
+        if "enable_cookies" in config and isinstance(config["enable_cookies"], bool):
+            return RemoteCollectorConfig(enable_cookies=config["enable_cookies"])
     return None
 
 
-def get_anonymous(request: Request) -> bool:
+def lookup_collector_config(
+    app: FastAPI, hostname: Optional[str]
+) -> Optional[RemoteCollectorConfig]:
+    remote_config = app.state.remote_config
+    if remote_config is None:
+        return None
+    # only a local lookup - misses and expired entries are refreshed in the background
+    return parse_collector_config(remote_config.get(hostname))
+
+
+def get_collector_config(request: Request) -> Optional[RemoteCollectorConfig]:
+    return lookup_collector_config(request.app, request.url.hostname)
+
+
+def is_anonymous(headers: Any) -> bool:
     # check headers
-    if request.headers.get("sp-anonymous"):
+    if headers.get("sp-anonymous"):
         return True
-    if request.headers.get("anonymous"):
+    if headers.get("anonymous"):
         return True
     return False
 
 
+def get_anonymous(request: Request) -> bool:
+    return is_anonymous(request.headers)
+
+
+class HeaderFilter:
+    """Decides which request headers are captured in the raw record.
+
+    Entries ending with `*` match a name prefix (`sec-*`). If an allowlist
+    is given only matching headers are captured, the denylist and the
+    built-in HEADER_FILTER are applied in any case.
+    """
+
+    def __init__(self, allowlist: Optional[List[str]] = None,
+                 denylist: Optional[List[str]] = None):
+        self.allow_exact, self.allow_prefixes = self._compile(allowlist)
+        self.allow_all = allowlist is None
+        deny_exact, self.deny_prefixes = self._compile(denylist)
+        self.deny_exact = deny_exact | frozenset(HEADER_FILTER)
+        self.anonymous_deny = frozenset(ANONYMOUS_HEADER_FILTER)
+        self._cache: Dict[str, bool] = {}
+
+    @staticmethod
+    def _compile(names: Optional[List[str]]) -> Tuple[frozenset, Tuple[str, ...]]:
+        names = [n.strip().lower() for n in names or []]
+        exact = frozenset(n for n in names if not n.endswith("*"))
+        prefixes = tuple(n[:-1] for n in names if n.endswith("*"))
+        return exact, prefixes
+
+    @classmethod
+    def from_config(cls, config: Any) -> "HeaderFilter":
+        return cls(
+            allowlist=config.get("header_allowlist"),
+            denylist=config.get("header_denylist"),
+        )
+
+    def is_allowed(self, name: str) -> bool:
+        """Check a lower case header name."""
+        allowed = self._cache.get(name)
+        if allowed is None:
+            allowed = (self.allow_all or name in self.allow_exact or
+                       (bool(self.allow_prefixes) and name.startswith(self.allow_prefixes)))
+            if name in self.deny_exact or (
+                self.deny_prefixes and name.startswith(self.deny_prefixes)
+            ):
+                allowed = False
+            if len(self._cache) >= HEADER_CACHE_SIZE:
+                self._cache.clear()
+            self._cache[name] = allowed
+        return allowed
+
+    def capture(
+        self, headers: Iterable[Tuple[str, str]], anonymous: bool = False
+    ) -> List[str]:
+        """Return the captured headers as `name: value` lines."""
+        lines = []
+        for name, value in headers:
+            lower = name.lower()
+            if not self.is_allowed(lower):
+                continue
+            if anonymous and lower in self.anonymous_deny:
+                continue
+            lines.append(f"{name}: {value}")
+        return lines
+
+
+DEFAULT_HEADER_FILTER = HeaderFilter()
+
+
+def get_header_filter(app: FastAPI) -> HeaderFilter:
+    return getattr(app.state, "header_filter", DEFAULT_HEADER_FILTER)
+
+
+def filter_headers(headers: Iterable[Tuple[str, str]], anonymous: bool = False,
+                   header_filter: Optional[HeaderFilter] = None) -> List[str]:
+    return (header_filter or DEFAULT_HEADER_FILTER).capture(headers, anonymous=anonymous)
+
+
 def get_headers(request: Request, anonymous: bool = False) -> List[str]:
-    headers = []
-    for name, value in request.headers.items():
-        if name.lower() in HEADER_FILTER:
-            continue
-        if anonymous and name.lower() in ANONYMOUS_HEADER_FILTER:
-            continue
-        headers.append(f"{name}: {value}")
-    return headers
+    return get_header_filter(request.app).capture(
+        request.headers.items(), anonymous=anonymous
+    )
 
 
-def get_network_userid(request: Request, anonymous: bool = False,
-                       cookie_user_id: Optional[str] = None) -> Optional[str]:
+def choose_network_userid(nuid: Optional[str] = None, anonymous: bool = False,
+                          cookie_user_id: Optional[str] = None) -> str:
     if anonymous:
         return ANONYMOUS_USER_ID
-    # get nuid from query string
-    nuid = request.query_params.get("nuid")
+    # nuid from query string
     if nuid:
         return nuid
     if cookie_user_id:
@@ -128,6 +263,15 @@ def get_network_userid(request: Request, anonymous: bool = False,
     return str(uuid.uuid4())
 
 
+def get_network_userid(request: Request, anonymous: bool = False,
+                       cookie_user_id: Optional[str] = None) -> Optional[str]:
+    if anonymous:
+        return ANONYMOUS_USER_ID
+    # get nuid from query string
+    nuid = request.query_params.get("nuid")
+    return choose_network_userid(nuid, anonymous=anonymous, cookie_user_id=cookie_user_id)
+
+
 def get_tracking_cookie(request: Request) -> Optional[str]:
     cookie_name = request.app.config.cookie_name
     cookie = request.cookies.get(cookie_name)
@@ -135,45 +279,224 @@ def get_tracking_cookie(request: Request) -> Optional[str]:
         return cookie
 
 
-def write_to_sink(request: Request, e: CollectorPayload):
-    sink = request.app.state.sink
+def get_route_name(request: Request) -> str:
+    # use the route template to keep the number of distinct labels small
+    route = request.scope.get("route")
+    if route is not None:
+        return route.path
+    return request.url.path
+
+
+def check_content_length(value: Optional[str], limit: int):
+    """Reject a declared body size above `limit` before reading the body."""
+    if value is None:
+        return
+    try:
+        length = int(value)
+    except ValueError:
+        raise PayloadRejected(400, "invalid_content_length")
+    if length > limit:
+        raise PayloadRejected(413, "body_too_large")
+
+
+async def read_request_body(request: Request) -> bytes:
+    """Read the body in chunks and stop as soon as it exceeds `max_body_bytes`."""
     config = request.app.config
+    limit = config.max_body_bytes
+    check_content_length(request.headers.get("content-length"), limit)
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > limit:
+            raise PayloadRejected(413, "body_too_large")
+        chunks.append(chunk)
+    return decode_body(config, b"".join(chunks), request.headers.get("content-encoding"))
+
+
+def _zlib_decode(body: bytes, wbits: int, limit: int) -> bytes:
+    d = zlib.decompressobj(wbits)
+    try:
+        data = d.decompress(body, limit + 1)
+    except zlib.error:
+        raise PayloadRejected(400, "invalid_encoding")
+    if len(data) > limit:
+        raise PayloadRejected(413, "decoded_body_too_large")
+    if not d.eof:
+        raise PayloadRejected(400, "invalid_encoding")
+    return data
+
+
+def _brotli_decode(body: bytes, limit: int) -> bytes:
+    if brotli is None:
+        raise PayloadRejected(415, "unsupported_encoding")
+    d = brotli.Decompressor()
+    chunks = []
+    size = 0
     try:
-        size = sink.write(e.split_and_serialize(config.record_format, max_size=config.max_bytes))
-    except PayloadException as e:
-        print(f"PayloadException: {e}", flush=True)
+        if hasattr(d, "can_accept_more_data"):
+            # the output of each call is bounded by what is left of the limit
+            chunk = d.process(body, output_buffer_limit=limit + 1)
+            while True:
+                size += len(chunk)
+                if size > limit:
+                    raise PayloadRejected(413, "decoded_body_too_large")
+                chunks.append(chunk)
+                if d.can_accept_more_data():
+                    break
+                chunk = d.process(b"", output_buffer_limit=limit + 1 - size)
+        else:
+            for i in range(0, len(body), BROTLI_CHUNK_SIZE):
+                chunk = d.process(body[i:i + BROTLI_CHUNK_SIZE])
+                size += len(chunk)
+                if size > limit:
+                    raise PayloadRejected(413, "decoded_body_too_large")
+                chunks.append(chunk)
+    except brotli.error:
+        raise PayloadRejected(400, "invalid_encoding")
+    if not d.is_finished():
+        # truncated stream
+        raise PayloadRejected(400, "invalid_encoding")
+    return b"".join(chunks)
+
+
+def decode_body(config: Any, body: bytes, content_encoding: Optional[str]) -> bytes:
+    """Undo the content encoding of a request body.
+
+    The decoded body is limited to `max_decoded_body_bytes`, decoding
+    stops as soon as the limit is reached.
+    """
+    if not content_encoding or not body:
+        return body
+    limit = config.max_decoded_body_bytes
+    # encodings are listed in the order they were applied
+    for encoding in reversed(content_encoding.lower().split(",")):
+        encoding = encoding.strip()
+        if encoding in ("", "identity"):
+            continue
+        if not config.decode_content_encoding:
+            raise PayloadRejected(415, "unsupported_encoding")
+        if encoding in ("gzip", "x-gzip"):
+            body = _zlib_decode(body, 16 + zlib.MAX_WBITS, limit)
+        elif encoding == "deflate":
+            # zlib wrapped deflate, some clients send raw deflate streams
+            wbits = zlib.MAX_WBITS if body[:1] == b"\x78" else -zlib.MAX_WBITS
+            body = _zlib_decode(body, wbits, limit)
+        elif encoding == "br":
+            body = _brotli_decode(body, limit)
+        else:
+            raise PayloadRejected(415, "unsupported_encoding")
+        metrics.incr("collector.decoded_bodies", encoding=encoding)
+    return body
+
+
+def check_tp2_body(body: Optional[bytes]):
+    """Cheap structural check of a tp2 body: an object with a schema and a data array."""
+    try:
+        doc = orjson.loads(body or b"")
+    except orjson.JSONDecodeError:
+        raise PayloadRejected(400, "invalid_json")
+    if (not isinstance(doc, dict) or not isinstance(doc.get("schema"), str)
+            or not isinstance(doc.get("data"), list)):
+        raise PayloadRejected(400, "invalid_tp2")
+
+
+def check_body(config: Any, body: Optional[bytes], tp2: bool = False):
+    if tp2 and config.validate_tp2:
+        check_tp2_body(body)
+
+
+def write_payload(app: FastAPI, e: RawCollectorPayload, route: str):
+    # the writer only enqueues when batching is enabled
+    sink = app.state.writer
+    config = app.config
+    # compress before splitting, max_bytes then applies to the compressed records
+    compressor = app.state.sink.compressor
+    metrics.incr("collector.requests", route=route)
+    partition_key = getattr(app.state, "partition_key", None)
+    try:
+        records = e.split_and_serialize(
+            config.record_format,
+            max_size=config.max_bytes,
+            prefix=config.record_format_prefix,
+            compress=compressor.compress if compressor is not None else None,
+        )
+        if partition_key is not None:
+            # all records of a request share the key
+            size = sink.write(records, keys=[partition_key(e)] * len(records))
+        else:
+            size = sink.write(records)
+    except PayloadTooLargeException as ex:
+        sampled_logger.debug("PayloadTooLargeException: %s", ex)
+        raise PayloadRejected(413, "payload_too_large")
+    except PayloadException as ex:
+        sampled_logger.debug("PayloadException: %s", ex)
+        raise PayloadRejected(400, "payload")
+    except SinkFullError:
+        # answered with a 503, trackers retry later
+        metrics.incr("collector.errors", route=route, reason="sink_full")
+        raise
     else:
-        print(f"wrote {size} bytes to sink", flush=True)
+        metrics.incr("collector.bytes", size, route=route)
+        sampled_logger.debug("wrote %d bytes to sink", size)
 
 
-def get_collector_payload(request: Request, body: Optional[bytes] = None,
-                          anonymous: bool = False) -> CollectorPayload:
-    ip = request.client.host
-    path = request.url.path
-    user_agent = request.headers.get("user-agent")
-    hostname = request.url.hostname
-    querystring = request.url.query
-    cookie = get_tracking_cookie(request)
-    referer = request.headers.get("referer")
-    content_type = request.headers.get("content-type")
-    e = CollectorPayload(
+def write_to_sink(request: Request, e: RawCollectorPayload):
+    write_payload(request.app, e, get_route_name(request))
+
+
+def retry_after(app: FastAPI) -> str:
+    return str(app.config.get("admission_retry_after", 5))
+
+
+async def sink_full_handler(request: Request, exc: SinkFullError) -> Response:
+    return Response(status_code=503, headers={"retry-after": retry_after(request.app)})
+
+
+async def payload_rejected_handler(request: Request, exc: PayloadRejected) -> Response:
+    metrics.incr("collector.errors", route=get_route_name(request), reason=exc.reason)
+    return Response(status_code=exc.status_code)
+
+
+def create_collector_payload(ip: str, path: str, hostname: Optional[str],
+                             querystring: Optional[str], headers: List[str],
+                             network_user_id: str,
+                             user_agent: Optional[str] = None,
+                             referer: Optional[str] = None,
+                             content_type: Optional[str] = None,
+                             body: Optional[bytes] = None) -> RawCollectorPayload:
+    return RawCollectorPayload(
         ipAddress=ip,
         timestamp=get_milliseconds(),
         encoding="UTF-8",
         collector=COLLECTOR_NAME,
+        userAgent=user_agent or None,
+        refererUri=referer or None,
+        path=path,
+        querystring=querystring or None,
+        body=body or None,
+        headers=headers,
+        contentType=content_type or None,
+        hostname=hostname,
+        networkUserId=network_user_id,
+    )
+
+
+def get_collector_payload(request: Request, body: Optional[bytes] = None,
+                          anonymous: bool = False) -> RawCollectorPayload:
+    cookie = get_tracking_cookie(request)
+    headers = get_headers(request, anonymous=anonymous)
+    return create_collector_payload(
+        ip=request.client.host,
+        path=request.url.path,
+        hostname=request.url.hostname,
+        querystring=request.url.query,
+        headers=headers,
+        network_user_id=get_network_userid(
+            request, anonymous=anonymous, cookie_user_id=cookie
+        ),
+        user_agent=request.headers.get("user-agent"),
+        referer=request.headers.get("referer"),
+        content_type=request.headers.get("content-type"),
+        body=body,
     )
-    if querystring:
-        e.querystring = querystring
-    if body:
-        e.body = body
-    e.path = path
-    if user_agent:
-        e.userAgent = user_agent
-    if referer:
-        e.refererUri = referer
-    e.hostname = hostname
-    e.networkUserId = get_network_userid(request, anonymous=anonymous, cookie_user_id=cookie)
-    e.headers = get_headers(request, anonymous=anonymous)
-    if content_type:
-        e.contentType = content_type
-    return e
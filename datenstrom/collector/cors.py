@@ -0,0 +1,118 @@
+import re
+
+from typing import Dict, List, Optional, Tuple
+
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+
+CORS_ALLOW_HEADERS = "Content-Type, SP-Anonymous, Anonymous, Origin, Referer, User-Agent"
+ORIGIN_CACHE_SIZE = 1024
+
+Headers = List[Tuple[bytes, bytes]]
+
+
+class CORSPolicy:
+    """Precomputed CORS response headers and origin allowlist.
+
+    `allowed_origins` entries can be `*` (reflect any origin), exact origins
+    like `https://example.com` or wildcard origins like `https://*.example.com`.
+    Exact origins are kept in a set, all wildcard origins are compiled into a
+    single regular expression and the result per origin is cached.
+    """
+
+    def __init__(self, allowed_origins: Optional[List[str]] = None, max_age: int = 3600,
+                 allow_headers: str = CORS_ALLOW_HEADERS):
+        self.static_headers: Headers = [
+            (b"access-control-allow-credentials", b"true"),
+            (b"access-control-max-age", str(max_age).encode("latin-1")),
+            (b"access-control-allow-headers", allow_headers.encode("latin-1")),
+        ]
+        self.allow_all = allowed_origins is None or "*" in allowed_origins
+        self.exact_origins = set()
+        patterns = []
+        for origin in allowed_origins or []:
+            if origin == "*":
+                continue
+            origin = origin.rstrip("/").lower()
+            if "*" in origin:
+                patterns.append(
+                    re.escape(origin).replace(r"\*", r"[a-z0-9-]+(?:\.[a-z0-9-]+)*")
+                )
+            else:
+                self.exact_origins.add(origin.encode("latin-1"))
+        self.origin_pattern = (
+            re.compile(b"|".join(p.encode("latin-1") for p in patterns))
+            if patterns
+            else None
+        )
+
+        self.any_origin_headers: Headers = [
+            (b"access-control-allow-origin", b"*")
+        ] + self.static_headers
+        self._origin_cache: Dict[bytes, Headers] = {}
+
+    def is_allowed(self, origin: bytes) -> bool:
+        if self.allow_all:
+            return True
+        origin = origin.lower()
+        if origin in self.exact_origins:
+            return True
+        return (
+            self.origin_pattern is not None
+            and self.origin_pattern.fullmatch(origin) is not None
+        )
+
+    def headers_for(self, origin: Optional[bytes]) -> Headers:
+        """Return the CORS headers for a request with the given Origin header."""
+        if not origin:
+            return self.any_origin_headers if self.allow_all else []
+        headers = self._origin_cache.get(origin)
+        if headers is None:
+            if self.is_allowed(origin):
+                headers = [(b"access-control-allow-origin", origin)] + self.static_headers
+            else:
+                headers = []
+            if len(self._origin_cache) >= ORIGIN_CACHE_SIZE:
+                self._origin_cache.clear()
+            self._origin_cache[origin] = headers
+        return headers
+
+
+def get_origin(scope: Scope) -> Optional[bytes]:
+    for key, value in scope["headers"]:
+        if key == b"origin":
+            return value
+    return None
+
+
+class CORSMiddleware:
+    """Pure ASGI CORS middleware.
+
+    OPTIONS requests are answered before any routing happens, all other
+    responses get the precomputed CORS headers appended.
+    """
+
+    def __init__(self, app: ASGIApp, policy: CORSPolicy):
+        self.app = app
+        self.policy = policy
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        cors_headers = self.policy.headers_for(get_origin(scope))
+        if scope["method"] == "OPTIONS":
+            await send({"type": "http.response.start", "status": 200,
+                        "headers": [(b"content-length", b"0")] + cors_headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+        if not cors_headers:
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + cors_headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
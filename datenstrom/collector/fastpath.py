@@ -0,0 +1,257 @@
+"""Raw ASGI fast path for the tracking endpoints.
+
+The middleware sits in front of the FastAPI router and answers the high
+volume tracking endpoints (pixel, tp2, iglu and redirect) directly on the
+ASGI primitives. Everything else is passed through to FastAPI.
+The collector payloads are built with the same helpers as the FastAPI
+routes in `datenstrom.collector.routes`, so both paths emit identical records.
+"""
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, urlparse, urlsplit
+
+from starlette.requests import cookie_parser
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from datenstrom.collector.cors import CORSPolicy, get_origin
+from datenstrom.collector.collect import (
+    PIXEL_GIF,
+    create_collector_payload, get_header_filter, choose_network_userid,
+    is_anonymous, lookup_collector_config, should_set_cookie,
+    make_cookie_header, write_payload, retry_after,
+    PayloadRejected, check_content_length, check_body, decode_body,
+)
+from datenstrom.common.metrics import metrics
+from datenstrom.connectors.sinks.base import SinkFullError
+
+
+PIXEL = "pixel"
+POST = "post"
+REDIRECT = "redirect"
+
+PIXEL_HEADERS = [
+    (b"content-length", str(len(PIXEL_GIF)).encode("latin-1")),
+    (b"content-type", b"image/gif"),
+]
+EMPTY_HEADERS = [(b"content-length", b"0")]
+
+
+@lru_cache(maxsize=1024)
+def get_hostname(scheme: str, host: str) -> Optional[str]:
+    # same parsing as starlette.datastructures.URL.hostname
+    return urlsplit(f"{scheme}://{host}").hostname
+
+
+def get_query(query_string: bytes) -> str:
+    query = query_string.decode()
+    if "#" in query or "\t" in query or "\r" in query or "\n" in query:
+        # rare - let urlsplit deal with these like starlette does
+        return urlsplit("http://localhost/?" + query).query
+    return query
+
+
+def get_query_param(query_string: bytes, name: str) -> Optional[str]:
+    # same semantics as starlette QueryParams.get (last value wins)
+    if name.encode("latin-1") not in query_string:
+        return None
+    value = None
+    for k, v in parse_qsl(query_string.decode("latin-1"), keep_blank_values=True):
+        if k == name:
+            value = v
+    return value
+
+
+class FastPathMiddleware:
+    """Handle the tracking endpoints without FastAPI routing and request objects."""
+
+    def __init__(self, app: ASGIApp, config: Any, cors: CORSPolicy):
+        self.app = app
+        self.config = config
+        self.cors = cors
+        self.get_routes: Dict[str, Tuple[str, str]] = {"/i": ("/i", PIXEL)}
+        self.post_routes: Dict[str, Tuple[str, str]] = {
+            "/com.snowplowanalytics.snowplow/tp2": (
+                "/com.snowplowanalytics.snowplow/tp2",
+                POST,
+            ),
+            "/event": ("/event", POST),
+        }
+        if config.enable_redirect_tracking:
+            self.get_routes["/r"] = ("/r", REDIRECT)
+            self.get_routes["/r/tp2"] = ("/r/tp2", REDIRECT)
+        for vendor in config.add_vendor_paths or []:
+            self.post_routes[f"/{vendor}/tp2"] = (f"/{vendor}/tp2", POST)
+            self.get_routes[f"/{vendor}/i"] = (f"/{vendor}/i", PIXEL)
+            self.get_routes[f"/{vendor}/r"] = (f"/{vendor}/r", REDIRECT)
+
+    def match(self, method: str, path: str) -> Optional[Tuple[str, str]]:
+        if method == "GET":
+            route = self.get_routes.get(path)
+        elif method == "POST":
+            route = self.post_routes.get(path)
+        else:
+            return None
+        if route is not None:
+            return route
+        # /{vendor}/v1 and /{vendor}/tp2
+        parts = path.split("/")
+        if len(parts) == 3 and not parts[0] and parts[1]:
+            if parts[2] == "v1":
+                return ("/{vendor}/v1", PIXEL if method == "GET" else POST)
+            if parts[2] == "tp2" and method == "POST":
+                return ("/{vendor}/tp2", POST)
+        return None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        method = scope["method"]
+        if method == "OPTIONS":
+            await self.send_response(send, 200, list(EMPTY_HEADERS), b"", get_origin(scope))
+            return
+        route = self.match(method, scope["path"])
+        if route is None:
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.handle(scope, receive, send, *route)
+        except PayloadRejected as ex:
+            metrics.incr("collector.errors", route=route[0], reason=ex.reason)
+            await self.send_response(send, ex.status_code, list(EMPTY_HEADERS), b"",
+                                     get_origin(scope))
+
+    async def read_body(
+        self, receive: Receive, content_length: Optional[str]
+    ) -> Optional[bytes]:
+        # same limits as collect.read_request_body
+        limit = self.config.max_body_bytes
+        check_content_length(content_length, limit)
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            chunk = message.get("body", b"")
+            size += len(chunk)
+            if size > limit:
+                raise PayloadRejected(413, "body_too_large")
+            chunks.append(chunk)
+            more_body = message.get("more_body", False)
+        return b"".join(chunks)
+
+    async def handle(self, scope: Scope, receive: Receive, send: Send,
+                     route: str, kind: str) -> None:
+        app = scope["app"]
+        config = self.config
+
+        raw_headers = scope["headers"]
+        headers: List[Tuple[str, str]] = []
+        first: Dict[str, str] = {}
+        host_header = None
+        origin = None
+        for k, v in raw_headers:
+            name = k.decode("latin-1")
+            value = v.decode("latin-1")
+            headers.append((name, value))
+            if name not in first:
+                first[name] = value
+            if host_header is None and k == b"host":
+                host_header = value
+            elif origin is None and k == b"origin":
+                origin = v
+
+        scheme = scope.get("scheme", "http")
+        if host_header is not None:
+            hostname = get_hostname(scheme, host_header)
+        elif scope.get("server"):
+            hostname = get_hostname(scheme, scope["server"][0])
+        else:
+            hostname = None
+
+        query_string = scope.get("query_string", b"")
+        collector_config = lookup_collector_config(app, hostname)
+
+        redirect = None
+        if kind == REDIRECT:
+            u = get_query_param(query_string, "u")
+            if u:
+                try:
+                    u = urlparse(u)
+                except ValueError:
+                    u = None
+            if not u or not u.scheme:
+                await self.send_response(send, 400, list(EMPTY_HEADERS), b"", origin)
+                return
+            redirect = u.geturl()
+
+        body = None
+        if kind == POST:
+            body = await self.read_body(receive, first.get("content-length"))
+            if body is None:
+                return
+            body = decode_body(config, body, first.get("content-encoding"))
+            check_body(config, body, tp2=route.endswith("/tp2"))
+
+        anonymous = is_anonymous(first)
+        captured = get_header_filter(app).capture(headers, anonymous=anonymous)
+        cookie_user_id = None
+        cookie_header = first.get("cookie")
+        if cookie_header:
+            cookie_user_id = cookie_parser(cookie_header).get(config.cookie_name) or None
+        if anonymous:
+            nuid = None
+        else:
+            nuid = get_query_param(query_string, "nuid")
+        e = create_collector_payload(
+            ip=scope["client"][0],
+            path=scope.get("root_path", "") + scope["path"],
+            hostname=hostname,
+            querystring=get_query(query_string) if query_string else "",
+            headers=captured,
+            network_user_id=choose_network_userid(nuid, anonymous=anonymous,
+                                                  cookie_user_id=cookie_user_id),
+            user_agent=first.get("user-agent"),
+            referer=first.get("referer"),
+            content_type=first.get("content-type"),
+            body=body,
+        )
+        try:
+            write_payload(app, e, route)
+        except SinkFullError:
+            response_headers = list(EMPTY_HEADERS)
+            response_headers.append((b"retry-after", retry_after(app).encode("latin-1")))
+            await self.send_response(send, 503, response_headers, b"", origin)
+            return
+
+        if kind == PIXEL:
+            status, response_headers, content = 200, list(PIXEL_HEADERS), PIXEL_GIF
+        elif kind == REDIRECT:
+            status, content = 302, b""
+            response_headers = list(EMPTY_HEADERS)
+            response_headers.append((b"location", redirect.encode("latin-1")))
+        else:
+            status, response_headers, content = 200, list(EMPTY_HEADERS), b""
+        if should_set_cookie(anonymous, collector_config):
+            response_headers.append(
+                (
+                    b"set-cookie",
+                    make_cookie_header(config, e.networkUserId, first.get("origin")),
+                )
+            )
+        await self.send_response(send, status, response_headers, content, origin)
+
+    async def send_response(
+        self,
+        send: Send,
+        status: int,
+        headers: List[Tuple[bytes, bytes]],
+        content: bytes,
+        origin: Optional[bytes],
+    ) -> None:
+        # CORS is handled inline with the precomputed header blocks
+        headers.extend(self.cors.headers_for(origin))
+        await send({"type": "http.response.start", "status": status, "headers": headers})
+        await send({"type": "http.response.body", "body": content})
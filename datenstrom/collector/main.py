@@ -1,3 +1,4 @@
 from datenstrom.collector.app import create_app
 
-app = create_app()
\ No newline at end of file
+# sinks are created on lifespan startup, safe for servers that preload the app
+app = create_app(lazy_sinks=True)
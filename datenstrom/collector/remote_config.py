@@ -0,0 +1,129 @@
+import time
+import asyncio
+import logging
+
+from typing import Optional, Dict, Any, NamedTuple, Callable
+
+from datenstrom.common.cache import damped_ttl
+from datenstrom.common.http import HttpClient, default_client, get_json_object
+
+
+logger = logging.getLogger(__name__)
+
+
+class RemoteConfigEntry(NamedTuple):
+    value: Optional[Dict[str, Any]]
+    expires: float
+
+
+class AsyncRemoteConfigClient:
+    """Non-blocking remote config lookup for the collector.
+
+    `get()` is a plain dict lookup and never waits on the network. Missing
+    or expired hostnames are loaded in the background: concurrent misses for
+    the same hostname share a single fetch and an expired value keeps being
+    served until its refresh has finished (stale-while-revalidate).
+
+    Requests go through `http` and its circuit breaker. With `none_ttl_max`
+    the TTL of missing configs and failed requests doubles with every
+    failure of a hostname in a row, starting at `none_ttl`.
+    """
+
+    def __init__(self, endpoint: str, ttl: int = 3600, none_ttl: int = 300,
+                 timeout: float = 5.0, maxsize: int = 2048,
+                 timer: Callable[[], float] = time.monotonic,
+                 none_ttl_max: Optional[int] = None, http: Optional[HttpClient] = None):
+        self.endpoint = endpoint
+        self.ttl = ttl
+        self.none_ttl = none_ttl
+        self.none_ttl_max = none_ttl_max
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.timer = timer
+        self.http = http if http is not None else default_client()
+        self._entries: Dict[str, RemoteConfigEntry] = {}
+        self._pending: Dict[str, asyncio.Task] = {}
+        self._failures: Dict[str, int] = {}
+
+    @classmethod
+    def from_config(cls, config: Any) -> "AsyncRemoteConfigClient":
+        return cls(endpoint=config.remote_config_endpoint,
+                   ttl=config.remote_config_ttl,
+                   none_ttl=config.remote_config_none_ttl,
+                   timeout=config.remote_config_timeout,
+                   none_ttl_max=config.none_cache_ttl_max,
+                   http=HttpClient.from_config(config))
+
+    def get(self, hostname: Optional[str]) -> Optional[Dict[str, Any]]:
+        """Return the cached config for hostname and schedule a refresh if needed."""
+        if not hostname:
+            return None
+        entry = self._entries.get(hostname)
+        if entry is None or self.timer() >= entry.expires:
+            self._schedule_refresh(hostname)
+        if entry is None:
+            return None
+        return entry.value
+
+    def _schedule_refresh(self, hostname: str) -> None:
+        if hostname in self._pending:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop (e.g. called from a thread) - the next
+            # lookup from within the loop will trigger the refresh
+            return
+        task = loop.create_task(self.refresh(hostname))
+        self._pending[hostname] = task
+        task.add_done_callback(lambda _: self._pending.pop(hostname, None))
+
+    async def wait(self, hostname: str) -> Optional[Dict[str, Any]]:
+        """Wait for a pending refresh of hostname (or start one) and return the value."""
+        task = self._pending.get(hostname)
+        if task is None:
+            self._schedule_refresh(hostname)
+            task = self._pending[hostname]
+        return await task
+
+    async def refresh(self, hostname: str) -> Optional[Dict[str, Any]]:
+        loop = asyncio.get_running_loop()
+        try:
+            value = await loop.run_in_executor(None, self._fetch, hostname)
+        except Exception as e:
+            # any failure gets an entry, otherwise every lookup starts another fetch
+            logger.warning("remote config request for %s failed: %s", hostname, e)
+            # keep serving the last known value and retry after the negative ttl
+            previous = self._entries.get(hostname)
+            value = previous.value if previous else None
+            self._store(hostname, value, self._none_ttl(hostname))
+            return value
+        if value is None:
+            self._store(hostname, None, self._none_ttl(hostname))
+        else:
+            self._failures.pop(hostname, None)
+            self._store(hostname, value, self.ttl)
+        return value
+
+    def _none_ttl(self, hostname: str) -> float:
+        failures = self._failures.get(hostname, 0)
+        if len(self._failures) > 2 * self.maxsize:
+            self._failures.clear()
+        self._failures[hostname] = failures + 1
+        return damped_ttl(self.none_ttl, failures, self.none_ttl_max)
+
+    def _store(self, hostname: str, value: Optional[Dict[str, Any]], ttl: float) -> None:
+        # re-insert to keep the dict ordered by expiry
+        self._entries.pop(hostname, None)
+        while len(self._entries) >= self.maxsize:
+            del self._entries[next(iter(self._entries))]
+        self._entries[hostname] = RemoteConfigEntry(value=value, expires=self.timer() + ttl)
+
+    def _fetch(self, hostname: str) -> Optional[Dict[str, Any]]:
+        return get_json_object(self.http, self.endpoint, params={"hostname": hostname},
+                               timeout=(self.http.timeout[0], self.timeout))
+
+    def close(self) -> None:
+        for task in self._pending.values():
+            task.cancel()
+        self.http.close()
@@ -5,13 +5,13 @@ from datetime import datetime, timedelta, timezone
 from urllib.parse import urlparse
 from typing import Optional, List, Dict, Any
 from fastapi import APIRouter, Request, Response
+from fastapi.responses import JSONResponse
 
-from datenstrom.common.schema.raw import CollectorPayload, PayloadException
-from datenstrom.common.cache import CachedRequestClient
+from datenstrom.collector.app import sink_backlog
 from datenstrom.collector.collect import (
     make_response, get_anonymous,
     get_collector_payload, write_to_sink,
-    get_collector_config
+    get_collector_config, read_request_body, check_body
 )
 
 router = APIRouter()
@@ -26,7 +26,20 @@ def root():
 
 @router.get("/health")
 def health(request: Request):
-    return {"i am": "ok", "hostname": request.url.hostname}
+    return {"i am": "ok", "hostname": request.url.hostname,
+            "queue_depth": getattr(request.app.state.writer, "queue_depth", 0)}
+
+
+@router.get("/ready")
+def ready(request: Request):
+    # readiness for the load balancer - flips while the sink is backed up
+    records, size = sink_backlog(request.app)
+    admission = request.app.state.admission
+    is_ready = admission is None or admission.ready
+    return JSONResponse(
+        {"ready": is_ready, "backlog_records": records, "backlog_bytes": size},
+        status_code=200 if is_ready else 503,
+    )
 
 
 @router.post(
@@ -36,7 +49,8 @@ def health(request: Request):
 async def post_tp2(request: Request):
     collector_config = get_collector_config(request)
     anonymous = get_anonymous(request)
-    body = await request.body()
+    body = await read_request_body(request)
+    check_body(request.app.config, body, tp2=True)
     e = get_collector_payload(request, body=body, anonymous=anonymous)
     write_to_sink(request, e)
     return make_response(request, anonymous=anonymous,
@@ -70,7 +84,7 @@ async def get_i(request: Request):
 async def post_event(request: Request):
     collector_config = get_collector_config(request)
     anonymous = get_anonymous(request)
-    body = await request.body()
+    body = await read_request_body(request)
     e = get_collector_payload(request, body=body, anonymous=anonymous)
     write_to_sink(request, e)
     return make_response(request, anonymous=anonymous,
@@ -122,7 +136,7 @@ async def get_v1(request: Request, vendor: str):
 async def post_v1(request: Request, vendor: str):
     collector_config = get_collector_config(request)
     anonymous = get_anonymous(request)
-    body = await request.body()
+    body = await read_request_body(request)
     e = get_collector_payload(request, body=body, anonymous=anonymous)
     write_to_sink(request, e)
     return make_response(request, anonymous=anonymous,
@@ -137,7 +151,8 @@ async def post_v1(request: Request, vendor: str):
 async def vendor_post_tp2(vendor: str, request: Request):
     collector_config = get_collector_config(request)
     anonymous = get_anonymous(request)
-    body = await request.body()
+    body = await read_request_body(request)
+    check_body(request.app.config, body, tp2=True)
     e = get_collector_payload(request, body=body, anonymous=anonymous)
     write_to_sink(request, e)
     return make_response(request, anonymous=anonymous,
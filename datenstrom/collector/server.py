@@ -0,0 +1,138 @@
+"""Multi-process collector server.
+
+The master process only binds sockets and supervises the workers. The app
+and its sinks are created in every worker after the fork, Kafka producers
+and boto3 clients must not be inherited across fork(). With SO_REUSEPORT
+every worker listens on its own socket and the kernel balances the
+connections, otherwise all workers accept on one shared socket.
+"""
+import os
+import time
+import signal
+import socket
+import logging
+import multiprocessing
+import multiprocessing.connection
+
+from typing import Dict, Optional
+
+import uvicorn
+
+from datenstrom.settings import BaseConfig, get_settings
+from datenstrom.common.metrics import setup_logging
+
+
+RESTART_DELAY = 1.0  # seconds before a crashed worker is restarted
+
+
+logger = logging.getLogger(__name__)
+
+
+def bind_socket(host: str, port: int, reuse_port: bool = False) -> socket.socket:
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.set_inheritable(True)
+    return sock
+
+
+def worker_config(config: BaseConfig, index: int) -> BaseConfig:
+    """Config of the worker with the given index.
+
+    Every worker spills to its own directory, keyed by the index so that a
+    restarted worker picks up the records its predecessor spilled.
+    """
+    if not config.spill_enabled:
+        return config
+    spill_directory = os.path.join(config.spill_directory, f"worker-{index}")
+    return config.model_copy(update={"spill_directory": spill_directory})
+
+
+def run_worker(config: BaseConfig, sock: Optional[socket.socket] = None):
+    """Serve the collector in this process, sinks are created on lifespan startup."""
+    from datenstrom.collector.app import create_app
+
+    # forked workers inherit the handlers of the master until uvicorn installs its own
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if sock is None:
+        sock = bind_socket(config.collector_host, config.collector_port, reuse_port=True)
+    server = uvicorn.Server(uvicorn.Config(
+        create_app(config, lazy_sinks=True),
+        lifespan="on",
+        log_level=config.log_level.lower(),
+        access_log=False,
+        proxy_headers=True,
+        backlog=config.collector_backlog,
+        timeout_graceful_shutdown=config.collector_graceful_timeout,
+    ))
+    server.run(sockets=[sock])
+
+
+def serve(config: Optional[BaseConfig] = None):
+    """Start the workers and restart them when they die until we get SIGINT or SIGTERM."""
+    if config is None:
+        config = get_settings()
+    setup_logging(config.log_level)
+    workers = config.collector_workers or os.cpu_count() or 1
+    reuse_port = config.collector_reuse_port and hasattr(socket, "SO_REUSEPORT")
+    # with reuse_port every worker binds its own socket
+    sock = None if reuse_port else bind_socket(config.collector_host, config.collector_port)
+    if workers == 1:
+        run_worker(config, sock)
+        return
+
+    # the master has not created any sinks, forking is safe
+    context = multiprocessing.get_context("fork")
+    processes: Dict[int, multiprocessing.Process] = {}
+    stopping = False
+
+    def start(i: int):
+        p = context.Process(target=run_worker, args=(worker_config(config, i), sock),
+                            name=f"collector-worker-{i}")
+        p.start()
+        processes[i] = p
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for p in processes.values():
+            if p.is_alive():
+                p.terminate()
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    logger.info("starting %d collector workers on %s:%d (reuse_port=%s)",
+                workers, config.collector_host, config.collector_port, reuse_port)
+    for i in range(workers):
+        start(i)
+
+    while not stopping:
+        multiprocessing.connection.wait(
+            [p.sentinel for p in processes.values()], timeout=1.0
+        )
+        for i, p in list(processes.items()):
+            if not stopping and not p.is_alive():
+                logger.error("collector worker %d (pid %d) exited with %s, restarting",
+                             i, p.pid, p.exitcode)
+                time.sleep(RESTART_DELAY)
+                start(i)
+
+    # workers flush and close their sinks on shutdown
+    deadline = time.monotonic() + config.collector_graceful_timeout + 5
+    for p in processes.values():
+        p.join(max(0.0, deadline - time.monotonic()))
+        if p.is_alive():
+            logger.error("collector worker pid %d did not stop, killing it", p.pid)
+            p.kill()
+
+
+def main():
+    serve()
+
+
+if __name__ == "__main__":
+    main()
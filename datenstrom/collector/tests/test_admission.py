@@ -0,0 +1,62 @@
+import os
+import pytest
+
+config_file = os.path.join(os.path.dirname(__file__), "config.json")
+os.environ["DATENSTROM_CONFIG"] = config_file
+
+from fastapi.testclient import TestClient
+from datenstrom.settings import get_settings
+from datenstrom.collector.app import create_app
+from datenstrom.collector.admission import AdmissionController
+from datenstrom.connectors.sinks.base import SinkFullError
+
+
+def test_controller_hysteresis():
+    backlog = [0, 0]
+    controller = AdmissionController(lambda: tuple(backlog), max_records=100,
+                                     max_bytes=1000, low_water=0.5)
+    assert controller.admit()
+    backlog[:] = [100, 0]
+    assert not controller.admit()
+    # still above the low-water mark
+    backlog[:] = [60, 0]
+    assert not controller.admit()
+    backlog[:] = [50, 600]
+    assert not controller.admit()
+    backlog[:] = [50, 500]
+    assert controller.admit()
+    backlog[:] = [0, 1000]
+    assert not controller.ready
+
+
+@pytest.fixture(params=[True, False], ids=["fast", "slow"])
+def client(request):
+    config = get_settings().model_copy(update={"collector_fast_path": request.param,
+                                               "admission_retry_after": 7})
+    return TestClient(create_app(config))
+
+
+def test_overloaded(client):
+    client.app.state.admission.backlog = lambda: (10 ** 9, 0)
+    response = client.get("/i?e=pv")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "7"
+    response = client.post("/com.snowplowanalytics.snowplow/tp2", content=b"{}")
+    assert response.status_code == 503
+    assert client.get("/ready").status_code == 503
+    assert client.get("/health").status_code == 200
+    assert client.options("/i").status_code == 200
+
+    client.app.state.admission.backlog = lambda: (0, 0)
+    assert client.get("/ready").json()["ready"] is True
+    assert client.get("/i?e=pv").status_code == 200
+
+
+def test_sink_full(client, monkeypatch):
+    def write(data):
+        raise SinkFullError("full")
+    monkeypatch.setattr(client.app.state.writer, "write", write)
+    response = client.get("/i?e=pv", headers={"Origin": "https://example.com"})
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "7"
+    assert response.headers["access-control-allow-origin"] == "https://example.com"
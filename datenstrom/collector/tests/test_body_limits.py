@@ -0,0 +1,108 @@
+import os
+import pytest
+
+config_file = os.path.join(os.path.dirname(__file__), "config.json")
+os.environ["DATENSTROM_CONFIG"] = config_file
+
+import gzip
+import zlib
+import orjson
+from fastapi.testclient import TestClient
+from datenstrom.settings import get_settings
+from datenstrom.collector.app import create_app
+from datenstrom.common.schema.raw import CollectorPayload
+
+
+TP2 = "/com.snowplowanalytics.snowplow/tp2"
+SCHEMA = "iglu:com.snowplowanalytics.snowplow/payload_data/jsonschema/1-0-4"
+
+
+@pytest.fixture(params=[True, False], ids=["fast", "slow"])
+def client(request):
+    config = get_settings().model_copy(update={"collector_fast_path": request.param,
+                                               "max_body_bytes": 1000,
+                                               "max_decoded_body_bytes": 100_000,
+                                               "max_bytes": 600,
+                                               "validate_tp2": True})
+    return TestClient(create_app(config))
+
+
+def test_body_too_large(client):
+    sink = client.app.state.sink
+    sink.last_record = None
+    body = orjson.dumps({"schema": SCHEMA, "data": [{"e": "pv", "x": "a" * 1000}]})
+    response = client.post(TP2, content=body, headers={"Origin": "https://example.com"})
+    assert response.status_code == 413
+    assert response.headers["access-control-allow-origin"] == "https://example.com"
+
+    # without a content-length header the limit applies while streaming
+    def chunks():
+        for _ in range(20):
+            yield b"a" * 100
+    assert client.post("/event", content=chunks()).status_code == 413
+    client.app.state.writer.flush()
+    assert sink.last_record is None
+
+
+def test_item_too_large(client):
+    body = orjson.dumps({"schema": SCHEMA, "data": [{"e": "pv", "x": "a" * 600}]})
+    assert client.post(TP2, content=body).status_code == 413
+
+
+def test_invalid_tp2(client):
+    assert client.post(TP2, content=b"not json").status_code == 400
+    assert client.post(TP2, content=b'{"schema": "x", "data": {}}').status_code == 400
+    assert client.post(TP2, content=b'[1, 2]').status_code == 400
+    body = orjson.dumps({"schema": SCHEMA, "data": [{"e": "pv"}]})
+    assert client.post(TP2, content=body).status_code == 200
+    # other endpoints are not checked
+    assert client.post("/event", content=b"not json").status_code == 200
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "deflate"])
+def test_compressed_body(client, encoding):
+    body = orjson.dumps({"schema": SCHEMA, "data": [{"e": "pv", "x": "a" * 50}] * 40})
+    wbits = 16 + zlib.MAX_WBITS if encoding == "gzip" else zlib.MAX_WBITS
+    c = zlib.compressobj(wbits=wbits)
+    compressed = c.compress(body) + c.flush()
+    assert len(compressed) < 1000
+    response = client.post(TP2, content=compressed, headers={"Content-Encoding": encoding})
+    assert response.status_code == 200
+    client.app.state.writer.flush()
+    record = CollectorPayload.decode(client.app.state.sink.last_record, "avro")
+    assert orjson.loads(record.body)["data"][0]["x"] == "a" * 50
+
+
+def test_compression_bomb(client):
+    body = orjson.dumps({"schema": SCHEMA, "data": [{"e": "pv", "x": "a" * 500_000}]})
+    compressed = gzip.compress(body)
+    assert len(compressed) < 1000
+    response = client.post(TP2, content=compressed, headers={"Content-Encoding": "gzip"})
+    assert response.status_code == 413
+
+
+def test_invalid_encoding(client):
+    headers = {"Content-Encoding": "gzip"}
+    assert client.post(TP2, content=b"not gzip", headers=headers).status_code == 400
+    truncated = gzip.compress(b'{"schema": "x", "data": []}')[:-10]
+    assert client.post(TP2, content=truncated, headers=headers).status_code == 400
+    headers = {"Content-Encoding": "compress"}
+    assert client.post(TP2, content=b"abc", headers=headers).status_code == 415
+
+
+def test_brotli(client):
+    brotli = pytest.importorskip("brotli")
+    headers = {"Content-Encoding": "br"}
+    body = orjson.dumps({"schema": SCHEMA, "data": [{"e": "pv", "x": "a" * 50}] * 40})
+    response = client.post(TP2, content=brotli.compress(body), headers=headers)
+    assert response.status_code == 200
+    client.app.state.writer.flush()
+    record = CollectorPayload.decode(client.app.state.sink.last_record, "avro")
+    assert orjson.loads(record.body)["data"][0]["x"] == "a" * 50
+
+    bomb = brotli.compress(b"a" * 10_000_000)
+    assert len(bomb) < 1000
+    assert client.post(TP2, content=bomb, headers=headers).status_code == 413
+    truncated = brotli.compress(body)[:-10]
+    assert client.post(TP2, content=truncated, headers=headers).status_code == 400
+    assert client.post(TP2, content=b"not brotli", headers=headers).status_code == 400
@@ -26,13 +26,11 @@ def generate_jwt_token():
 @pytest.fixture
 def last_record():
     def _last_record():
+        client.app.state.writer.flush()
         sink = client.app.state.sink
         format = client.app.config.record_format
         if sink.last_record:
-            if format == "avro":
-                return CollectorPayload.from_avro(sink.last_record)
-            elif format == "thrift":
-                return CollectorPayload.from_thrift(sink.last_record)
+            return CollectorPayload.decode(sink.last_record, format)
     return _last_record
 
 
@@ -67,3 +65,28 @@ def test_authorized(last_record):
     # decode jwt
     token_info = jwt.decode(jwt_token, "secret", algorithms=["HS256"])
     assert token_info["iss"] == "https://datenstrom.io"
+
+
+@pytest.mark.parametrize("fast_path", [True, False])
+def test_partition_key(fast_path):
+    config = client.app.config.model_copy(update={"partition_key_raw": "hostname",
+                                                  "collector_fast_path": fast_path})
+    keyed = TestClient(create_app(config))
+    response = keyed.post("/io.datenstrom/tp2", headers={"Host": "tracker.example.com"})
+    assert response.status_code == 200
+    keyed.app.state.writer.flush()
+    assert keyed.app.state.sink.last_key == b"tracker.example.com"
+
+
+@pytest.mark.parametrize("fast_path", [True, False])
+def test_anonymous_partition_key(fast_path):
+    config = client.app.config.model_copy(update={"partition_key_raw": "networkUserId",
+                                                  "collector_fast_path": fast_path})
+    keyed = TestClient(create_app(config))
+    assert keyed.get("/i?e=pv&nuid=user-1").status_code == 200
+    keyed.app.state.writer.flush()
+    assert keyed.app.state.sink.last_key == b"user-1"
+    # anonymous requests are spread over the partitions
+    assert keyed.get("/i?e=pv", headers={"SP-Anonymous": "*"}).status_code == 200
+    keyed.app.state.writer.flush()
+    assert keyed.app.state.sink.last_key is None
@@ -0,0 +1,55 @@
+import os
+
+config_file = os.path.join(os.path.dirname(__file__), "config.json")
+os.environ["DATENSTROM_CONFIG"] = config_file
+
+from fastapi.testclient import TestClient
+from datenstrom.settings import get_settings
+from datenstrom.collector.app import create_app
+from datenstrom.collector.cors import CORSPolicy
+
+
+def test_policy_allow_all():
+    policy = CORSPolicy(max_age=600)
+    headers = dict(policy.headers_for(b"https://example.com"))
+    assert headers[b"access-control-allow-origin"] == b"https://example.com"
+    assert headers[b"access-control-max-age"] == b"600"
+    assert headers[b"access-control-allow-credentials"] == b"true"
+    assert dict(policy.headers_for(None))[b"access-control-allow-origin"] == b"*"
+
+
+def test_policy_allowlist():
+    policy = CORSPolicy(allowed_origins=["https://example.com", "https://*.acme.org"])
+    assert policy.headers_for(b"https://example.com")
+    assert policy.headers_for(b"https://EXAMPLE.com")
+    assert policy.headers_for(b"https://shop.acme.org")
+    assert policy.headers_for(b"https://a.b.acme.org")
+    assert not policy.headers_for(b"http://example.com")
+    assert not policy.headers_for(b"https://acme.org")
+    assert not policy.headers_for(b"https://evilacme.org")
+    assert not policy.headers_for(b"https://example.com.evil.com")
+    assert not policy.headers_for(None)
+
+
+def test_preflight_allowlist():
+    config = get_settings().model_copy(update={
+        "cors_allowed_origins": ["https://example.com"],
+        "cors_max_age": 7200,
+    })
+    for fast_path in (True, False):
+        client = TestClient(
+            create_app(config.model_copy(update={"collector_fast_path": fast_path}))
+        )
+        response = client.options("/com.snowplowanalytics.snowplow/tp2",
+                                  headers={"Origin": "https://example.com"})
+        assert response.status_code == 200
+        assert response.headers["access-control-allow-origin"] == "https://example.com"
+        assert response.headers["access-control-max-age"] == "7200"
+
+        response = client.options("/i", headers={"Origin": "https://evil.com"})
+        assert response.status_code == 200
+        assert "access-control-allow-origin" not in response.headers
+
+        response = client.get("/health", headers={"Origin": "https://example.com"})
+        assert response.status_code == 200
+        assert response.headers["access-control-allow-origin"] == "https://example.com"
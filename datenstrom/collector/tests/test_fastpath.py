@@ -0,0 +1,120 @@
+import os
+import pytest
+
+config_file = os.path.join(os.path.dirname(__file__), "config.json")
+os.environ["DATENSTROM_CONFIG"] = config_file
+
+from fastapi.testclient import TestClient
+from datenstrom.settings import get_settings
+from datenstrom.collector.app import create_app
+from datenstrom.collector.collect import PIXEL_GIF
+from datenstrom.common.schema.raw import CollectorPayload
+
+
+config = get_settings()
+fast_client = TestClient(
+    create_app(config.model_copy(update={"collector_fast_path": True}))
+)
+slow_client = TestClient(
+    create_app(config.model_copy(update={"collector_fast_path": False}))
+)
+
+
+def last_record(client):
+    client.app.state.writer.flush()
+    record = client.app.state.sink.last_record
+    client.app.state.sink.last_record = None
+    return record
+
+
+def request_both(method, url, **kwargs):
+    results = []
+    for client in (fast_client, slow_client):
+        response = client.request(method, url, **kwargs)
+        raw = last_record(client)
+        results.append((response, raw))
+    return results
+
+
+def assert_same_record(fast_raw, slow_raw):
+    assert fast_raw is not None and slow_raw is not None
+    fast = CollectorPayload.from_avro(fast_raw)
+    slow = CollectorPayload.from_avro(slow_raw)
+    # the timestamp is the only field that may differ
+    fast.timestamp = slow.timestamp
+    assert fast == slow
+
+
+@pytest.mark.parametrize("url", [
+    "/i?e=pv&nuid=abc",
+    "/i?e=pv&url=http%3A%2F%2Fexample.com%2F%3Fa%3D1&nuid=abc",
+    "/com.snowplowanalytics.snowplow/v1?nuid=abc",
+])
+def test_pixel(url):
+    (fast, fast_raw), (slow, slow_raw) = request_both(
+        "GET", url, headers={"User-Agent": "test"}
+    )
+    assert fast.status_code == slow.status_code == 200
+    assert fast.content == slow.content == PIXEL_GIF
+    assert fast.headers["content-type"] == "image/gif"
+    assert_same_record(fast_raw, slow_raw)
+
+
+@pytest.mark.parametrize("url", [
+    "/com.snowplowanalytics.snowplow/tp2",
+    "/io.datenstrom/tp2",
+    "/com.acme/v1",
+    "/event",
+])
+def test_post(url):
+    body = (
+        b'{"schema":"iglu:com.snowplowanalytics.snowplow/payload_data/jsonschema/1-0-4",'
+        b'"data":[]}'
+    )
+    headers = {"Content-Type": "application/json", "Referer": "http://example.com",
+               "Origin": "http://example.com", "Cookie": "sp=cookie-user"}
+    (fast, fast_raw), (slow, slow_raw) = request_both(
+        "POST", url, content=body, headers=headers
+    )
+    assert fast.status_code == slow.status_code == 200
+    assert fast.headers["access-control-allow-origin"] == "http://example.com"
+    assert_same_record(fast_raw, slow_raw)
+    assert CollectorPayload.from_avro(fast_raw).networkUserId == "cookie-user"
+
+
+def test_anonymous():
+    headers = {
+        "SP-Anonymous": "*",
+        "Cookie": "sp=cookie-user",
+        "X-Forwarded-For": "1.2.3.4",
+    }
+    (fast, fast_raw), (slow, slow_raw) = request_both("GET", "/i?nuid=abc", headers=headers)
+    assert_same_record(fast_raw, slow_raw)
+    record = CollectorPayload.from_avro(fast_raw)
+    assert record.networkUserId == "00000000-0000-0000-0000-000000000000"
+    assert not any(h.startswith("cookie") for h in record.headers)
+
+
+def test_redirect():
+    (fast, fast_raw), (slow, slow_raw) = request_both(
+        "GET", "/r/tp2?u=https%3A%2F%2Fexample.com%2F&nuid=abc", follow_redirects=False)
+    assert fast.status_code == slow.status_code == 302
+    assert fast.headers["location"] == slow.headers["location"] == "https://example.com/"
+    assert_same_record(fast_raw, slow_raw)
+
+    (fast, fast_raw), (slow, slow_raw) = request_both(
+        "GET", "/r?u=invalid", follow_redirects=False
+    )
+    assert fast.status_code == slow.status_code == 400
+    assert fast_raw is None and slow_raw is None
+
+
+def test_preflight_and_passthrough():
+    response = fast_client.options("/i", headers={"Origin": "http://example.com"})
+    assert response.status_code == 200
+    assert response.headers["access-control-allow-origin"] == "http://example.com"
+    assert response.headers["access-control-allow-credentials"] == "true"
+    # not a tracking endpoint - handled by FastAPI
+    response = fast_client.get("/health")
+    assert response.status_code == 200
+    assert response.json()["i am"] == "ok"
@@ -0,0 +1,91 @@
+import os
+import pytest
+
+config_file = os.path.join(os.path.dirname(__file__), "config.json")
+os.environ["DATENSTROM_CONFIG"] = config_file
+
+from fastapi.testclient import TestClient
+from datenstrom.settings import get_settings
+from datenstrom.collector.app import create_app
+from datenstrom.collector import collect, fastpath
+from datenstrom.collector.collect import HeaderFilter
+from datenstrom.common.schema.raw import RawCollectorPayload, parse_headers
+
+
+HEADERS = [
+    ("host", "example.com"),
+    ("user-agent", "test"),
+    ("cookie", "sp=abc"),
+    ("accept", "*/*"),
+    ("accept-language", "en"),
+    ("sec-fetch-mode", "cors"),
+    ("x-forwarded-for", "1.2.3.4"),
+    ("remote-address", "1.2.3.4"),
+]
+
+
+def names(lines):
+    return [line.split(":", 1)[0] for line in lines]
+
+
+def test_default_filter():
+    lines = HeaderFilter().capture(HEADERS)
+    assert "remote-address" not in names(lines)
+    assert "cookie" in names(lines)
+
+    lines = HeaderFilter().capture(HEADERS, anonymous=True)
+    assert "cookie" not in names(lines)
+    assert "x-forwarded-for" not in names(lines)
+
+
+def test_denylist():
+    lines = HeaderFilter(denylist=["Cookie", "accept*", "sec-*"]).capture(HEADERS)
+    assert names(lines) == ["host", "user-agent", "x-forwarded-for"]
+
+
+def test_allowlist():
+    f = HeaderFilter(allowlist=["host", "user-agent", "sec-*", "remote-address"],
+                     denylist=["sec-fetch-mode"])
+    lines = f.capture(HEADERS)
+    # the built-in filter always applies
+    assert names(lines) == ["host", "user-agent"]
+    assert parse_headers(lines) == {"host": "example.com", "user-agent": "test"}
+
+
+def test_headers_dict_cache():
+    raw = RawCollectorPayload(headers=["a: 1"])
+    assert raw.get_headers_dict() == {"a": "1"}
+    assert raw.get_headers_dict() is raw.get_headers_dict()
+    raw.headers = ["b: 2"]
+    assert raw.get_headers_dict() == {"b": "2"}
+
+
+@pytest.mark.parametrize("fast_path", [True, False])
+def test_capture_with_config(fast_path, monkeypatch):
+    config = get_settings().model_copy(update={
+        "collector_fast_path": fast_path,
+        "header_denylist": ["cookie", "accept*", "sec-*"],
+    })
+    client = TestClient(create_app(config))
+    payloads = []
+
+    def write_payload(app, e, route):
+        payloads.append(e)
+    monkeypatch.setattr(collect, "write_payload", write_payload)
+    monkeypatch.setattr(fastpath, "write_payload", write_payload)
+
+    response = client.get(
+        "/i?e=pv",
+        headers={
+            "Cookie": "sp=abc",
+            "Accept": "*/*",
+            "Sec-Fetch-Mode": "cors",
+            "User-Agent": "test",
+        },
+    )
+    assert response.status_code == 200
+    e = payloads[0]
+    assert not any(h.lower().startswith(("cookie", "accept", "sec-")) for h in e.headers)
+    # the collector does not parse the headers
+    assert e._headers_dict is None
+    assert e.get_headers_dict()["user-agent"] == "test"
@@ -0,0 +1,96 @@
+import asyncio
+import requests
+
+from datenstrom.collector.remote_config import AsyncRemoteConfigClient
+
+
+class Timer:
+    def __init__(self):
+        self.time = 0
+
+    def __call__(self):
+        return self.time
+
+
+class FakeRemoteConfigClient(AsyncRemoteConfigClient):
+    def __init__(self, **kwargs):
+        super().__init__(endpoint="http://config.local/", timer=Timer(), **kwargs)
+        self.calls = []
+        self.fail = False
+
+    def _fetch(self, hostname):
+        self.calls.append(hostname)
+        if self.fail:
+            raise requests.ConnectionError("down")
+        return {"enable_cookies": True, "call": len(self.calls)}
+
+
+def test_miss_does_not_wait():
+    async def run():
+        client = FakeRemoteConfigClient()
+        assert client.get("example.com") is None
+        assert client.get("example.com") is None
+        value = await client.wait("example.com")
+        assert value["call"] == 1
+        # concurrent misses share a single fetch
+        assert client.calls == ["example.com"]
+        assert client.get("example.com")["call"] == 1
+    asyncio.run(run())
+
+
+def test_stale_while_revalidate():
+    async def run():
+        client = FakeRemoteConfigClient(ttl=10, none_ttl=5)
+        await client.wait("example.com")
+        client.timer.time = 11
+        # expired entries are still served while the refresh runs
+        assert client.get("example.com")["call"] == 1
+        await client.wait("example.com")
+        assert client.get("example.com")["call"] == 2
+
+        # failed refreshes keep the last known value
+        client.fail = True
+        client.timer.time = 30
+        assert client.get("example.com")["call"] == 2
+        await client.wait("example.com")
+        assert client.get("example.com")["call"] == 2
+    asyncio.run(run())
+
+
+def test_maxsize():
+    async def run():
+        client = FakeRemoteConfigClient(maxsize=2)
+        for host in ["a", "b", "c"]:
+            await client.wait(host)
+        assert set(client._entries.keys()) == {"b", "c"}
+    asyncio.run(run())
+
+
+def test_unexpected_error():
+    async def run():
+        client = FakeRemoteConfigClient(ttl=10, none_ttl=5)
+        client._fetch = lambda hostname: client.calls.append(hostname) or {}["missing"]
+        assert await client.wait("example.com") is None
+        # the failure is cached for none_ttl, lookups do not start new fetches
+        assert client.get("example.com") is None
+        assert "example.com" not in client._pending
+        assert client.calls == ["example.com"]
+    asyncio.run(run())
+
+
+def test_none_ttl_doubles():
+    async def run():
+        client = FakeRemoteConfigClient(ttl=10, none_ttl=5, none_ttl_max=12)
+        client.fail = True
+        for expires in [5, 15, 27, 39]:
+            await client.wait("example.com")
+            assert client._entries["example.com"].expires == expires
+            client.timer.time = expires
+        # a success resets the negative ttl
+        client.fail = False
+        await client.wait("example.com")
+        client.fail = True
+        client.timer.time = 100
+        await client.wait("example.com")
+        assert client._entries["example.com"].expires == 105
+    asyncio.run(run())
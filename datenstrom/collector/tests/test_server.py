@@ -0,0 +1,62 @@
+import os
+import pytest
+
+config_file = os.path.join(os.path.dirname(__file__), "config.json")
+os.environ["DATENSTROM_CONFIG"] = config_file
+
+from fastapi.testclient import TestClient
+from datenstrom.settings import get_settings
+from datenstrom.collector.app import create_app
+
+
+def test_lazy_sinks():
+    app = create_app(get_settings(), lazy_sinks=True)
+    assert app.state.sink is None
+    assert app.state.writer is None
+    with TestClient(app) as client:
+        writer = app.state.writer
+        assert app.state.sink is not None
+        assert client.get("/i?e=pv").status_code == 200
+        assert client.get("/ready").json()["ready"] is True
+    # flushed and closed on shutdown
+    assert app.state.writer is None
+    assert writer.sink.last_record is not None
+
+
+def test_spill_implies_batching(tmp_path):
+    config = get_settings().model_copy(update={"collector_batch_enabled": False,
+                                               "spill_enabled": True,
+                                               "spill_directory": str(tmp_path)})
+    with TestClient(create_app(config)) as client:
+        writer = client.app.state.writer
+        # spill appends happen on the batching thread, not on the event loop
+        assert type(writer).__name__ == "BatchingSink"
+        assert type(writer.sink).__name__ == "SpillingSink"
+
+
+def test_spill_directory_locked(tmp_path):
+    config = get_settings().model_copy(update={"spill_enabled": True,
+                                               "spill_directory": str(tmp_path)})
+    with TestClient(create_app(config)) as first, TestClient(create_app(config)) as second:
+        assert type(first.app.state.writer.sink).__name__ == "SpillingSink"
+        # a second worker on the same directory runs without spilling
+        assert type(second.app.state.writer.sink).__name__ == "DevSink"
+        assert second.get("/i?e=pv").status_code == 200
+
+
+def test_reuse_port():
+    server = pytest.importorskip("datenstrom.collector.server")
+    a = server.bind_socket("127.0.0.1", 0, reuse_port=True)
+    port = a.getsockname()[1]
+    b = server.bind_socket("127.0.0.1", port, reuse_port=True)
+    assert b.getsockname()[1] == port
+    a.close()
+    b.close()
+
+
+def test_worker_spill_directory(tmp_path):
+    server = pytest.importorskip("datenstrom.collector.server")
+    config = get_settings().model_copy(update={"spill_enabled": True,
+                                               "spill_directory": str(tmp_path)})
+    directories = {server.worker_config(config, i).spill_directory for i in range(3)}
+    assert directories == {str(tmp_path / f"worker-{i}") for i in range(3)}
@@ -1,26 +1,43 @@
+import os
 import time
+import queue
+import logging
+import threading
 import collections
 import requests
-from typing import Optional, Dict
+from typing import Any, Callable, Optional, Dict, Hashable
 
 from cachetools import Cache, cached, cachedmethod # noqa
 from cachetools import _TimedCache
 from cachetools.keys import hashkey
 
+from datenstrom.common.http import HttpClient, default_client
+from datenstrom.common.metrics import metrics
+
+
+logger = logging.getLogger(__name__)
+
 
 class TTLCache(_TimedCache):
-    """LRU Cache implementation with per-item time-to-live (TTL) value."""
+    """LRU Cache implementation with per-item time-to-live (TTL) value.
+
+    Items with a value of None expire after `none_ttl`, `setitem()` takes
+    the TTL of a single item. Each TTL has its own expiry queue, the items
+    of a queue expire in insertion order so expiring stops at the first
+    item that is still valid. There should only be a few distinct TTLs.
+    """
 
     class _Link:
 
-        __slots__ = ("key", "expires", "next", "prev")
+        __slots__ = ("key", "expires", "ttl", "next", "prev")
 
-        def __init__(self, key=None, expires=None):
+        def __init__(self, key=None, expires=None, ttl=None):
             self.key = key
             self.expires = expires
+            self.ttl = ttl
 
         def __reduce__(self):
-            return TTLCache._Link, (self.key, self.expires)
+            return TTLCache._Link, (self.key, self.expires, self.ttl)
 
         def unlink(self):
             next = self.next
@@ -28,13 +45,27 @@ class TTLCache(_TimedCache):
             prev.next = next
             next.prev = prev
 
+        def append_to(self, root):
+            self.next = root
+            self.prev = prev = root.prev
+            prev.next = root.prev = self
+
     def __init__(self, maxsize, ttl, none_ttl=None, timer=time.monotonic, getsizeof=None):
         _TimedCache.__init__(self, maxsize, timer, getsizeof)
-        self.__root = root = TTLCache._Link()
-        root.prev = root.next = root
+        self.__roots = {}
         self.__links = collections.OrderedDict()
         self.__ttl = ttl
         self.__none_ttl = none_ttl if none_ttl is not None else ttl
+        self.__root(ttl)
+        self.__root(self.__none_ttl)
+
+    def __root(self, ttl):
+        try:
+            return self.__roots[ttl]
+        except KeyError:
+            self.__roots[ttl] = root = TTLCache._Link(ttl=ttl)
+            root.prev = root.next = root
+            return root
 
     def __contains__(self, key):
         try:
@@ -56,7 +87,13 @@ class TTLCache(_TimedCache):
         else:
             return cache_getitem(self, key)
 
-    def __setitem__(self, key, value, cache_setitem=Cache.__setitem__):
+    def __setitem__(self, key, value):
+        self.setitem(key, value)
+
+    def setitem(self, key, value, ttl=None, cache_setitem=Cache.__setitem__):
+        """Set an item that expires after `ttl` instead of the TTL of the cache."""
+        if ttl is None:
+            ttl = self.__none_ttl if value is None else self.__ttl
         with self.timer as time:
             self.expire(time)
             cache_setitem(self, key, value)
@@ -66,13 +103,9 @@ class TTLCache(_TimedCache):
             self.__links[key] = link = TTLCache._Link(key)
         else:
             link.unlink()
-        if value is None:
-            link.expires = time + self.__none_ttl
-        else:
-            link.expires = time + self.__ttl
-        link.next = root = self.__root
-        link.prev = prev = root.prev
-        prev.next = root.prev = link
+        link.expires = time + ttl
+        link.ttl = ttl
+        link.append_to(self.__root(ttl))
 
     def __delitem__(self, key, cache_delitem=Cache.__delitem__):
         cache_delitem(self, key)
@@ -82,23 +115,21 @@ class TTLCache(_TimedCache):
             raise KeyError(key)
 
     def __iter__(self):
-        root = self.__root
-        curr = root.next
-        while curr is not root:
-            # "freeze" time for iterator access
-            with self.timer as time:
-                if time < curr.expires:
-                    yield curr.key
-            curr = curr.next
+        for root in list(self.__roots.values()):
+            curr = root.next
+            while curr is not root:
+                # "freeze" time for iterator access
+                with self.timer as time:
+                    if time < curr.expires:
+                        yield curr.key
+                curr = curr.next
 
     def __setstate__(self, state):
         self.__dict__.update(state)
-        root = self.__root
-        root.prev = root.next = root
+        for root in self.__roots.values():
+            root.prev = root.next = root
         for link in sorted(self.__links.values(), key=lambda obj: obj.expires):
-            link.next = root
-            link.prev = prev = root.prev
-            prev.next = root.prev = link
+            link.append_to(self.__root(link.ttl))
         self.expire(self.timer())
 
     @property
@@ -106,30 +137,27 @@ class TTLCache(_TimedCache):
         """The time-to-live value of the cache's items."""
         return self.__ttl
 
+    @property
+    def none_ttl(self):
+        """The time-to-live value of None items."""
+        return self.__none_ttl
+
     def expire(self, time=None):
         """Remove expired items from the cache."""
         if time is None:
             time = self.timer()
-        root = self.__root
-        curr = root.next
         links = self.__links
         cache_delitem = Cache.__delitem__
-        # while curr is not root and not (time < curr.expires):
-        #     cache_delitem(self, curr.key)
-        #     del links[curr.key]
-        #     next = curr.next
-        #     curr.unlink()
-        #     curr = next
-        while curr is not root:
-            if time >= curr.expires:
-                # delete items that are not expired
+        for ttl, root in list(self.__roots.items()):
+            curr = root.next
+            while curr is not root and not (time < curr.expires):
                 cache_delitem(self, curr.key)
                 del links[curr.key]
                 next = curr.next
                 curr.unlink()
                 curr = next
-            else:
-                curr = curr.next
+            if root.next is root and ttl != self.__ttl and ttl != self.__none_ttl:
+                del self.__roots[ttl]
 
     def popitem(self):
         """Remove and return the `(key, value)` pair least recently used that
@@ -151,9 +179,316 @@ class TTLCache(_TimedCache):
         return value
 
 
+def refresh_ttl(ttl: float, refresh_ratio: Optional[float]) -> Optional[float]:
+    """Soft TTL as a fraction of the hard TTL, None disables refreshing."""
+    if refresh_ratio is None or refresh_ratio >= 1:
+        return None
+    return ttl * refresh_ratio
+
+
+def damped_ttl(ttl: float, failures: int, ttl_max: Optional[float]) -> float:
+    """TTL after `failures` failures in a row, doubling from `ttl` up to `ttl_max`."""
+    if ttl_max is None:
+        return ttl
+    return min(ttl * 2 ** failures, ttl_max)
+
+
+class _Flight:
+    """A load in progress, other callers wait for its result."""
+
+    __slots__ = ("done", "value", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error: Optional[BaseException] = None
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+class _Refresh:
+    """When a cached value should be refreshed and how often it was read since then."""
+
+    __slots__ = ("refresh_at", "reads", "loader")
+
+    def __init__(self, refresh_at: float, loader: Callable[[], Any]):
+        self.refresh_at = refresh_at
+        self.reads = 0
+        self.loader = loader
+
+
+class SingleFlightCache:
+    """Thread-safe wrapper around a cache that loads each missing key once.
+
+    Concurrent misses of the same key are coalesced: the first caller runs
+    the loader, the others wait for its result. The loader runs without
+    holding the lock. If it raises, the waiting callers get the same
+    exception and nothing is cached.
+
+    With `refresh_ttl` (the soft TTL, shorter than the TTL of the cache)
+    a value older than `refresh_ttl` is still returned but reloaded by a
+    background thread (stale-while-revalidate). Values read at least
+    `hot_reads` times since they were loaded are reloaded once they are
+    older than `refresh_ttl` even if they are not read again, so hot keys
+    do not reach the hard TTL. The refresher thread that looks for them
+    is started when the first key becomes hot. None values are not
+    refreshed.
+
+    Failures are damped when the cache is a `TTLCache`: with
+    `none_ttl_max` the TTL of None values and failed loads doubles with
+    every failure of the key in a row, starting at the `none_ttl` of the
+    cache. With `fallback` the last value loaded for a key is returned
+    (and cached for that TTL) when the loader raises. Without a last
+    value, `cache_errors` caches and returns None instead of raising.
+    """
+
+    def __init__(
+        self,
+        cache: Cache,
+        name: str = "default",
+        refresh_ttl: Optional[float] = None,
+        hot_reads: Optional[int] = None,
+        refresh_interval: float = 1.0,
+        none_ttl_max: Optional[float] = None,
+        fallback: bool = False,
+        cache_errors: bool = False,
+    ):
+        self.cache = cache
+        self.name = name
+        self.refresh_ttl = refresh_ttl
+        self.hot_reads = hot_reads
+        self.refresh_interval = refresh_interval
+        self.none_ttl_max = none_ttl_max
+        self.fallback = fallback
+        self.cache_errors = cache_errors
+        self.timer = getattr(cache, "timer", time.monotonic)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.stale = 0
+        self.refreshes = 0
+        self.fallbacks = 0
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight] = {}
+        self._refresh: Dict[Hashable, _Refresh] = {}
+        self._failures: Dict[Hashable, int] = {}
+        self._last_good: "collections.OrderedDict[Hashable, Any]" = (
+            collections.OrderedDict()
+        )
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._pid: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+
+    def get(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """Return the cached value for key, load it if it is missing."""
+        with self._lock:
+            try:
+                value = self.cache[key]
+            except KeyError:
+                pass
+            else:
+                self.hits += 1
+                refresh = self._refresh.get(key)
+                if refresh is not None:
+                    refresh.reads += 1
+                    if self.timer() >= refresh.refresh_at and key not in self._flights:
+                        self.stale += 1
+                        self._schedule(key, refresh.loader)
+                    elif refresh.reads == self.hot_reads:
+                        self._start()
+                metrics.incr("cache.hits", cache=self.name)
+                return value
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+                self.misses += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            metrics.incr("cache.coalesced", cache=self.name)
+            return flight.result()
+        metrics.incr("cache.misses", cache=self.name)
+        return self._load(key, flight, loader)
+
+    def _load(self, key: Hashable, flight: _Flight, loader: Callable[[], Any]) -> Any:
+        try:
+            try:
+                value = loader()
+            except Exception as e:
+                value = self._on_error(key, e)
+            else:
+                with self._lock:
+                    self._store(key, value, loader)
+            flight.value = value
+            return value
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def _store(self, key: Hashable, value: Any, loader: Callable[[], Any]):
+        # called with the lock held
+        if value is None and self.none_ttl_max is not None:
+            self.cache.setitem(key, None, self._none_ttl(key))
+        else:
+            self._failures.pop(key, None)
+            self.cache[key] = value
+            if self.fallback and value is not None:
+                self._last_good[key] = value
+                self._last_good.move_to_end(key)
+                if len(self._last_good) > self.cache.maxsize:
+                    self._last_good.popitem(last=False)
+        self._track(key, value, loader)
+
+    def _none_ttl(self, key: Hashable) -> float:
+        failures = self._failures.get(key, 0)
+        if len(self._failures) > 2 * self.cache.maxsize:
+            self._failures.clear()
+        self._failures[key] = failures + 1
+        return damped_ttl(self.cache.none_ttl, failures, self.none_ttl_max)
+
+    def _on_error(self, key: Hashable, error: Exception) -> Any:
+        with self._lock:
+            if not self.fallback and not self.cache_errors:
+                raise error
+            ttl = self._none_ttl(key) if self.none_ttl_max is not None else None
+            self._refresh.pop(key, None)
+            if key in self._last_good:
+                value = self._last_good[key]
+                self.fallbacks += 1
+            elif self.cache_errors:
+                value = None
+            else:
+                raise error
+            if ttl is not None:
+                self.cache.setitem(key, value, ttl)
+            else:
+                self.cache[key] = value
+        if value is not None:
+            metrics.incr("cache.fallbacks", cache=self.name)
+        logger.warning("loading %s into cache %s failed, serving %s: %s", key, self.name,
+                       "the last known value" if value is not None else "None", error)
+        return value
+
+    def _track(self, key: Hashable, value: Any, loader: Callable[[], Any]):
+        if self.refresh_ttl is None:
+            return
+        if value is None:
+            self._refresh.pop(key, None)
+            return
+        self._refresh[key] = _Refresh(self.timer() + self.refresh_ttl, loader)
+        if len(self._refresh) > 2 * self.cache.maxsize:
+            # forget keys the cache evicted
+            for k in [k for k in self._refresh if k not in self.cache]:
+                del self._refresh[k]
+
+    def _schedule(self, key: Hashable, loader: Callable[[], Any]):
+        # called with the lock held, misses of key wait for the refresh
+        self._flights[key] = flight = _Flight()
+        self._start()
+        self._queue.put((key, flight, loader))
+
+    def _start(self):
+        # called with the lock held
+        if self._pid != os.getpid():
+            # threads do not survive a fork
+            self._pid = os.getpid()
+            self._queue = queue.SimpleQueue()
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name=f"cache-refresher-{self.name}")
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                item = self._queue.get(timeout=self.refresh_interval)
+            except queue.Empty:
+                self.refresh_hot()
+                continue
+            if item is None:
+                return
+            key, flight, loader = item
+            self.refreshes += 1
+            metrics.incr("cache.refreshes", cache=self.name)
+            try:
+                self._load(key, flight, loader)
+            except Exception as e:
+                # the stale value is served until it expires
+                metrics.incr("cache.refresh_errors", cache=self.name)
+                logger.warning("refreshing %s in cache %s failed: %s", key, self.name, e)
+
+    def refresh_hot(self):
+        """Schedule the refresh of hot keys that are older than `refresh_ttl`."""
+        if self.hot_reads is None:
+            return
+        with self._lock:
+            now = self.timer()
+            for key, refresh in self._refresh.items():
+                if (refresh.reads >= self.hot_reads and now >= refresh.refresh_at
+                        and key not in self._flights and key in self.cache):
+                    self._schedule(key, refresh.loader)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "stale": self.stale,
+            "refreshes": self.refreshes,
+            "fallbacks": self.fallbacks,
+            "size": len(self.cache),
+        }
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self.cache
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+    def clear(self):
+        with self._lock:
+            self.cache.clear()
+            self._refresh.clear()
+            self._failures.clear()
+            self._last_good.clear()
+
+    def close(self):
+        """Stop the refresher thread."""
+        self._stopped.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+        self._pid = None
+
+
 class CachedRequestClient:
-    def __init__(self, maxsize: int, ttl: int, none_ttl: Optional[int] = None):
-        self.cache = TTLCache(maxsize=maxsize, ttl=ttl, none_ttl=none_ttl)
+    """Cached GET requests, failed requests return the last known value or None."""
+
+    def __init__(self, maxsize: int, ttl: int, none_ttl: Optional[int] = None,
+                 refresh_ratio: Optional[float] = None, hot_reads: Optional[int] = None,
+                 none_ttl_max: Optional[int] = None, http: Optional[HttpClient] = None):
+        self.http = http if http is not None else default_client()
+        self.cache = SingleFlightCache(
+            TTLCache(maxsize=maxsize, ttl=ttl, none_ttl=none_ttl),
+            name="http",
+            refresh_ttl=refresh_ttl(ttl, refresh_ratio),
+            hot_reads=hot_reads,
+            none_ttl_max=none_ttl_max,
+            fallback=True,
+            cache_errors=True,
+        )
 
     def request(self, url: str, method: str = "GET", result: str = "text",
                 params: Optional[Dict[str, str]] = None,
@@ -162,35 +497,28 @@ class CachedRequestClient:
         hashable_params = frozenset(params.items()) if params else None
         hashable_headers = frozenset(headers.items()) if headers else None
         key = hashkey(url, method, result, hashable_params, hashable_headers)
-        try:
-            #cache hit
-            return self.cache[key]
-        except KeyError:
-            # cache miss
-            pass
+        return self.cache.get(key, lambda: self._load(url, method, result, params=params,
+                                                      headers=headers, **kwargs))
 
-        try:
-            response = requests.request(method, url, **kwargs)
-        except requests.RequestException as e:
-            print(f"Request to {url} failed: {e}", flush=True)
-            result = None
-        else:
-            if response.status_code < 200 or response.status_code >= 300:
-                result = None
-            else:
-                if result == "json":
-                    try:
-                        result = response.json()
-                        print(f"[Cache Miss] Got JSON from {url}", flush=True)
-                    except requests.JSONDecodeError:
-                        print(f"Failed to decode JSON from {url}", flush=True)
-                        result = None
-                else:
-                    result = response.text
-                    print(f"[Cache Miss] Got text from {url}", flush=True)
-
-        self.cache[key] = result
-        return result
+    def _load(self, url: str, method: str, result: str, **kwargs):
+        # transport errors and server errors raise, the cache falls back to the last value
+        response = self.http.request(method, url, **kwargs)
+        if response.status_code >= 500:
+            raise requests.HTTPError(
+                f"{response.status_code} from {url}", response=response
+            )
+        if response.status_code < 200 or response.status_code >= 300:
+            return None
+        if result == "json":
+            try:
+                value = response.json()
+            except requests.JSONDecodeError:
+                logger.warning("failed to decode JSON from %s", url)
+                return None
+            logger.debug("cache miss, got JSON from %s", url)
+            return value
+        logger.debug("cache miss, got text from %s", url)
+        return response.text
 
     def get(self, url: str,
             params: Optional[Dict[str, str]] = None,
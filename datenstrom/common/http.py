@@ -0,0 +1,285 @@
+"""Pooled HTTP client for the remote lookups (remote config, Iglu registries).
+
+Every endpoint (scheme and host) gets its own session, connections are
+kept alive and reused. Requests have connect and read timeouts, failed
+idempotent requests are retried with exponential backoff and full jitter,
+and the number of concurrent requests per endpoint is limited. A circuit
+breaker per endpoint fails requests immediately while the endpoint is down.
+"""
+import os
+import time
+import random
+import logging
+import threading
+
+import requests
+
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urlsplit
+
+from requests.adapters import HTTPAdapter
+
+from datenstrom.common.metrics import metrics, format_metric_name
+
+
+RETRY_METHODS = frozenset(["GET", "HEAD", "OPTIONS"])
+RETRY_STATUS = frozenset([429, 502, 503, 504])
+
+
+logger = logging.getLogger(__name__)
+
+
+class EndpointBusy(requests.RequestException):
+    """Too many requests to the endpoint are in flight."""
+
+
+class CircuitOpen(requests.RequestException):
+    """The endpoint failed too often, requests are not sent."""
+
+
+class CircuitBreaker:
+    """Closed, open and half-open circuit breaker for one endpoint.
+
+    The circuit opens after `failures` failed requests in a row. While it
+    is open requests are rejected. After `reset_timeout` seconds a single
+    trial request is let through (half-open): if it succeeds the circuit
+    closes, otherwise it opens again and the timeout doubles up to
+    `reset_timeout_max`. With `failures=0` the circuit never opens.
+    """
+
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+    def __init__(self, name: str, failures: int = 5, reset_timeout: float = 5.0,
+                 reset_timeout_max: float = 300.0, timer=time.monotonic):
+        self.name = name
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.reset_timeout_max = reset_timeout_max
+        self.timer = timer
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.open_until = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.timer() >= self.open_until:
+                # let one trial request through
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            if self.state != self.CLOSED:
+                self.state = self.CLOSED
+                self.opened = 0
+                metrics.incr("http.circuit_closed", endpoint=self.name)
+                logger.info("circuit for %s closed", self.name)
+
+    def cancel(self):
+        """The trial request was not sent, let the next request try."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.max_failures <= 0:
+                return
+            if self.state == self.HALF_OPEN or self.failures >= self.max_failures:
+                timeout = min(self.reset_timeout * 2 ** self.opened, self.reset_timeout_max)
+                self.opened += 1
+                self.open_until = self.timer() + timeout
+                if self.state != self.OPEN:
+                    metrics.incr("http.circuit_opened", endpoint=self.name)
+                    logger.warning("circuit for %s opened for %.1fs after %d failures",
+                                   self.name, timeout, self.failures)
+                self.state = self.OPEN
+
+
+class HttpClient:
+    """Thread-safe HTTP client with a connection pool per endpoint."""
+
+    def __init__(
+        self,
+        connect_timeout: float = 3.0,
+        read_timeout: float = 10.0,
+        retries: int = 2,
+        retry_backoff: float = 0.2,
+        retry_backoff_max: float = 2.0,
+        pool_size: int = 10,
+        max_concurrency: int = 10,
+        circuit_failures: int = 5,
+        circuit_reset: float = 5.0,
+        circuit_reset_max: float = 300.0,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.retry_backoff_max = retry_backoff_max
+        self.pool_size = pool_size
+        self.max_concurrency = max_concurrency
+        self.circuit_failures = circuit_failures
+        self.circuit_reset = circuit_reset
+        self.circuit_reset_max = circuit_reset_max
+        self._lock = threading.Lock()
+        self._sessions: Dict[str, requests.Session] = {}
+        self._semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._pid = os.getpid()
+
+    @classmethod
+    def from_config(cls, config: Any) -> "HttpClient":
+        return cls(connect_timeout=config.http_connect_timeout,
+                   read_timeout=config.http_read_timeout,
+                   retries=config.http_retries,
+                   retry_backoff=config.http_retry_backoff,
+                   pool_size=config.http_pool_size,
+                   max_concurrency=config.http_max_concurrency,
+                   circuit_failures=config.http_circuit_failures,
+                   circuit_reset=config.http_circuit_reset,
+                   circuit_reset_max=config.http_circuit_reset_max)
+
+    @staticmethod
+    def endpoint(url: str) -> str:
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}"
+
+    def _endpoint(self, url: str) -> Tuple[requests.Session, threading.BoundedSemaphore,
+                                           CircuitBreaker]:
+        endpoint = self.endpoint(url)
+        with self._lock:
+            if self._pid != os.getpid():
+                # pooled connections must not be shared with the parent process
+                self._sessions = {}
+                self._semaphores = {}
+                self._pid = os.getpid()
+            session = self._sessions.get(endpoint)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[endpoint] = session
+                self._semaphores[endpoint] = threading.BoundedSemaphore(
+                    self.max_concurrency
+                )
+            breaker = self._breakers.get(endpoint)
+            if breaker is None:
+                # breakers outlive a fork, the endpoint is just as down in the child
+                breaker = self._breakers[endpoint] = CircuitBreaker(
+                    endpoint,
+                    failures=self.circuit_failures,
+                    reset_timeout=self.circuit_reset,
+                    reset_timeout_max=self.circuit_reset_max,
+                )
+                metrics.register_gauge(
+                    format_metric_name("http.circuit_state", (("endpoint", endpoint),)),
+                    lambda: breaker.state)
+            return session, self._semaphores[endpoint], breaker
+
+    def circuit_state(self, url: str) -> int:
+        """State of the circuit breaker of the endpoint of url."""
+        breaker = self._breakers.get(self.endpoint(url))
+        return breaker.state if breaker is not None else CircuitBreaker.CLOSED
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(
+            0, min(self.retry_backoff_max, self.retry_backoff * 2**attempt)
+        )
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Send a request, raises `requests.RequestException` after the last retry."""
+        method = method.upper()
+        kwargs.setdefault("timeout", self.timeout)
+        session, semaphore, breaker = self._endpoint(url)
+        if not breaker.allow():
+            metrics.incr("http.circuit_rejected", endpoint=breaker.name)
+            raise CircuitOpen(f"Circuit for {breaker.name} is open")
+        try:
+            response = self._send(session, semaphore, method, url, **kwargs)
+        except EndpointBusy:
+            breaker.cancel()
+            raise
+        except requests.RequestException:
+            breaker.failure()
+            raise
+        if response.status_code >= 500:
+            breaker.failure()
+        else:
+            breaker.success()
+        return response
+
+    def _send(self, session: requests.Session, semaphore: threading.BoundedSemaphore,
+              method: str, url: str, **kwargs) -> requests.Response:
+        retries = self.retries if method in RETRY_METHODS else 0
+        attempt = 0
+        while True:
+            # waiting for a slot counts against the connect timeout
+            if not semaphore.acquire(timeout=self.timeout[0]):
+                metrics.incr("http.busy", endpoint=self.endpoint(url))
+                raise EndpointBusy(f"Too many concurrent requests to {self.endpoint(url)}")
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= retries:
+                    raise
+                logger.warning("request to %s failed, retrying: %s", url, e)
+            else:
+                if response.status_code not in RETRY_STATUS or attempt >= retries:
+                    return response
+                response.close()
+            finally:
+                semaphore.release()
+            metrics.incr("http.retries", endpoint=self.endpoint(url))
+            time.sleep(self._backoff(attempt))
+            attempt += 1
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+            self._semaphores = {}
+
+
+def get_json_object(client: HttpClient, url: str, **kwargs) -> Optional[Dict[str, Any]]:
+    """GET a JSON object, None for client errors and bodies that are not an object.
+
+    Transport and server errors raise, callers keep serving their last value.
+    """
+    response = client.get(url, **kwargs)
+    if response.status_code >= 500:
+        raise requests.HTTPError(f"{response.status_code} from {url}", response=response)
+    if response.status_code < 200 or response.status_code >= 300:
+        return None
+    try:
+        value = response.json()
+    except requests.JSONDecodeError:
+        logger.warning("failed to decode JSON from %s", url)
+        return None
+    return value if isinstance(value, dict) else None
+
+
+_default_client: Optional[HttpClient] = None
+_default_lock = threading.Lock()
+
+
+def default_client() -> HttpClient:
+    """Client with the default settings for callers without a config."""
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            _default_client = HttpClient()
+        return _default_client
@@ -0,0 +1,147 @@
+import os
+import time
+import random
+import logging
+import threading
+import orjson
+
+from collections import defaultdict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+
+logger = logging.getLogger("datenstrom.metrics")
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class Metrics:
+    """Thread-safe per-interval counters and polled gauges.
+
+    Counters are cheap in-memory increments that are reset every time a
+    snapshot is taken. Gauges are callables that are only evaluated when a
+    snapshot is taken.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Tuple], int] = defaultdict(int)
+        self._gauges: Dict[str, Callable[[], Any]] = {}
+
+    def incr(self, name: str, value: int = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] += value
+
+    def register_gauge(self, name: str, fn: Callable[[], Any]) -> None:
+        self._gauges[name] = fn
+
+    def unregister_gauge(self, name: str) -> None:
+        self._gauges.pop(name, None)
+
+    def snapshot(self, reset: bool = True) -> Dict[str, Any]:
+        with self._lock:
+            counters = self._counters
+            if reset:
+                self._counters = defaultdict(int)
+            else:
+                counters = dict(counters)
+        result = {}
+        for (name, labels), value in counters.items():
+            result[format_metric_name(name, labels)] = value
+        for name, fn in list(self._gauges.items()):
+            try:
+                result[name] = fn()
+            except Exception as e:
+                logger.warning("failed to read gauge %s: %s", name, e)
+        return result
+
+
+def format_metric_name(name: str, labels: Tuple) -> str:
+    if not labels:
+        return name
+    inner = ",".join(f"{k}={v}" for k, v in labels)
+    return f"{name}{{{inner}}}"
+
+
+class MetricsReporter(threading.Thread):
+    """Background thread that periodically logs and resets the counters."""
+
+    def __init__(self, metrics: Metrics, interval: float):
+        super().__init__(daemon=True, name="metrics-reporter")
+        self.metrics = metrics
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        last = time.monotonic()
+        while not self._stopped.wait(self.interval):
+            now = time.monotonic()
+            self.emit(now - last)
+            last = now
+
+    def emit(self, elapsed: Optional[float] = None) -> None:
+        snapshot = self.metrics.snapshot()
+        if not snapshot:
+            return
+        line = {"interval": round(elapsed or self.interval, 3), "metrics": snapshot}
+        logger.info(orjson.dumps(line).decode("utf-8"))
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self.is_alive():
+            self.join()
+        # emit whatever was counted since the last interval
+        self.emit()
+
+
+class SampledLogger:
+    """Forwards only a random sample of debug lines to the wrapped logger."""
+
+    def __init__(self, logger: logging.Logger, rate: float):
+        self.logger = logger
+        self.rate = rate
+
+    def debug(self, msg: str, *args: Any) -> None:
+        if (
+            self.rate > 0
+            and random.random() < self.rate
+            and self.logger.isEnabledFor(logging.DEBUG)
+        ):
+            self.logger.debug(msg, *args)
+
+
+metrics = Metrics()
+
+_reporter: Optional[MetricsReporter] = None
+_reporter_pid: Optional[int] = None
+_reporter_lock = threading.Lock()
+
+
+def setup_logging(level: str = "INFO") -> None:
+    """Configure the root logger once (no-op if handlers are already present)."""
+    root = logging.getLogger()
+    if not root.handlers:
+        logging.basicConfig(level=level.upper(), format=LOG_FORMAT)
+    else:
+        root.setLevel(level.upper())
+
+
+def start_reporter(interval: float) -> MetricsReporter:
+    """Start the process wide metrics reporter (idempotent, fork aware)."""
+    global _reporter, _reporter_pid
+    with _reporter_lock:
+        # threads do not survive a fork - start a new reporter in the child
+        if _reporter is None or _reporter_pid != os.getpid() or not _reporter.is_alive():
+            _reporter = MetricsReporter(metrics, interval)
+            _reporter_pid = os.getpid()
+            _reporter.start()
+        return _reporter
+
+
+def stop_reporter() -> None:
+    global _reporter, _reporter_pid
+    with _reporter_lock:
+        if _reporter is not None and _reporter_pid == os.getpid():
+            _reporter.stop()
+        _reporter = None
+        _reporter_pid = None
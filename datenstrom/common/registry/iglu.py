@@ -1,11 +1,13 @@
+import logging
+
 from typing import Any, List, NamedTuple, Type, Optional, Dict
 from jsonschema import Draft202012Validator
 from jsonschema.protocols import Validator
 from jsonschema.exceptions import SchemaError, ValidationError
 from functools import lru_cache
-import requests
 
-from datenstrom.common.cache import TTLCache, cachedmethod
+from datenstrom.common.cache import TTLCache, SingleFlightCache, refresh_ttl
+from datenstrom.common.http import HttpClient, default_client
 from datenstrom.common.schema.atomic import ATOMIC_EVENT_SCHEMA
 from datenstrom.common.schema.events import STATIC_JSON_SCHEMAS
 from datenstrom.common.registry.base import SchemaValidationError, InvalidSchemaError
@@ -16,6 +18,9 @@ IGNORE_META_SCHEMA = True
 MAX_SCHEMA_SIZE =  128 * 1024  # 128kb
 
 
+logger = logging.getLogger(__name__)
+
+
 class IgluSchema(NamedTuple):
     type: str
     vendor: str
@@ -116,24 +121,39 @@ class HardcodedIgluRegistry(BaseIgluRegistry):
 
 class RemoteIgluRegistry(BaseIgluRegistry):
     def __init__(self, url: str, cache_size: Optional[int] = 1024,
-                 cache_ttl: Optional[int] = 3600, cache_ttl_none: Optional[int] = 60) -> None:
+                 cache_ttl: Optional[int] = 3600, cache_ttl_none: Optional[int] = 60,
+                 refresh_ratio: Optional[float] = None, hot_reads: Optional[int] = None,
+                 cache_ttl_none_max: Optional[int] = None,
+                 http: Optional[HttpClient] = None) -> None:
         self.url = url
-        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl, none_ttl=cache_ttl_none)
+        self.http = http if http is not None else default_client()
+        # registry errors still raise unless a schema was loaded before
+        self.cache = SingleFlightCache(
+            TTLCache(maxsize=cache_size, ttl=cache_ttl, none_ttl=cache_ttl_none),
+            name="iglu",
+            refresh_ttl=refresh_ttl(cache_ttl, refresh_ratio),
+            hot_reads=hot_reads,
+            none_ttl_max=cache_ttl_none_max,
+            fallback=True,
+        )
 
-    @cachedmethod(lambda self: self.cache, key=lambda s, iglus: iglus.hashkey())
     def _load_iglu_schema(self, iglu_schema: IgluSchema) -> Optional[Dict[str, Any]]:
-        # TODO: Implement better retry logic
+        return self.cache.get(
+            iglu_schema.hashkey(), lambda: self._fetch_iglu_schema(iglu_schema)
+        )
+
+    def _fetch_iglu_schema(self, iglu_schema: IgluSchema) -> Optional[Dict[str, Any]]:
         full_url = self.url + iglu_schema.to_path()
-        print(f"Loading schema: {full_url}")
-        # load the schema
-        r = requests.get(full_url)
+        logger.debug("loading schema %s", full_url)
+        # load the schema, retries and timeouts are handled by the http client
+        r = self.http.get(full_url)
         # check if the request was successful
         if r.status_code < 200 or r.status_code >= 300:
             return None
         # get content length
         content_length = int(r.headers.get("content-length", 0))
         if content_length > MAX_SCHEMA_SIZE:
-            print(f"Schema ({iglu_schema}) too large: {content_length} bytes")
+            logger.warning("schema %s too large: %d bytes", iglu_schema, content_length)
             return None
         # parse response json
         return dict(r.json())
@@ -7,6 +7,7 @@ from datenstrom.common.registry.iglu import (
     RemoteIgluRegistry, IgluSchema, HardcodedIgluRegistry
 )
 from datenstrom.common.registry.base import SchemaNotFound
+from datenstrom.common.http import HttpClient
 
 
 VALIDATOR_CACHE_SIZE = 100
@@ -29,6 +30,11 @@ class RegistryManager:
         self.iglu_registries = config.iglu_schema_registries
         self.cache_ttl = config.default_cache_ttl
         self.cache_ttl_none = config.none_cache_ttl
+        self.cache_refresh_ratio = config.cache_refresh_ratio
+        self.cache_hot_reads = config.cache_hot_reads
+        self.cache_ttl_none_max = config.none_cache_ttl_max
+        # one connection pool per registry host, shared by all registries
+        self.http = HttpClient.from_config(config)
 
         self.registries = []
         # add static registry
@@ -48,7 +54,13 @@ class RegistryManager:
     def add_registry(self, url: str, type: str) -> None:
         # add a registry to the list if it is not already present
         if url not in [r.url for r in self.registries]:
-            self.registries.append(RegistryEntry(url=url, type=type, registry=RemoteIgluRegistry(url=url)))
+            registry = RemoteIgluRegistry(url=url, cache_ttl=self.cache_ttl,
+                                          cache_ttl_none=self.cache_ttl_none,
+                                          refresh_ratio=self.cache_refresh_ratio,
+                                          hot_reads=self.cache_hot_reads,
+                                          cache_ttl_none_max=self.cache_ttl_none_max,
+                                          http=self.http)
+            self.registries.append(RegistryEntry(url=url, type=type, registry=registry))
 
     def validate(self, schema: str, data: Any) -> None:
         t = self.get_schema_type(schema)
@@ -1,25 +1,39 @@
-from typing import Optional, List, Dict
-from io import BytesIO
+from typing import Callable, Optional, List, Dict, Union
 import orjson
 import logging
 from datetime import datetime, timezone
 
 
-from thriftpy2.protocol.binary import TBinaryProtocol
-# from thriftpy2.protocol import TCompactProtocol
-
 from thriftpy2.thrift import TPayload, TType
-from fastavro import parse_schema, schemaless_writer, schemaless_reader
+from fastavro import parse_schema
 from pydantic import BaseModel, Field
 
+from datenstrom.common.schema.raw.codec import (
+    compile_avro_encoder, compile_avro_decoder,
+    compile_thrift_encoder, compile_thrift_decoder,
+    compile_thrift_compact_encoder, compile_thrift_compact_decoder,
+)
+
 
-THRIFT_PROTO = TBinaryProtocol
-#THRIFT_PROTO = TCompactProtocol
 SNOWPLOW_COLLECTOR_PAYLOAD_SCHEMA = (
     "iglu:com.snowplowanalytics.snowplow/CollectorPayload/thrift/1-0-0"
 )
 AVRO_SCHEMA_NAME = "CollectorPayload"
 
+RECORD_FORMATS = ("avro", "thrift", "thrift-compact")
+# Optional one byte prefix in front of raw records: the high nibble marks a
+# prefixed record, the low nibble is the format (version 1 of each format).
+# Unprefixed records never start with these bytes: avro records start with the
+# length of the short avro schema name and thrift records with the schema field.
+FORMAT_PREFIXES = {
+    "avro": b"\xd1",
+    "thrift": b"\xd2",
+    "thrift-compact": b"\xd3",
+}
+PREFIX_FORMATS = {prefix[0]: format for format, prefix in FORMAT_PREFIXES.items()}
+# compressed chunks are packed to this fraction of the estimated uncompressed limit
+COMPRESSED_SPLIT_MARGIN = 0.9
+
 
 logger = logging.getLogger(__name__)
 
@@ -28,6 +42,34 @@ class PayloadException(Exception):
     pass
 
 
+class PayloadTooLargeException(PayloadException):
+    """The event or a single item of its body does not fit into a record."""
+    pass
+
+
+def varint_size(n: int) -> int:
+    size = 1
+    while n >= 0x80:
+        n >>= 7
+        size += 1
+    return size
+
+
+def record_size(format: str, size_empty_body: int, body_size: int) -> int:
+    """Size of a serialized record given its size with an empty body and the body size."""
+    if format == "avro":
+        # the bytes are prefixed with their zigzag encoded length
+        return size_empty_body - 1 + varint_size(body_size << 1) + body_size
+    elif format == "thrift":
+        # fixed size length
+        return size_empty_body + body_size
+    elif format == "thrift-compact":
+        # the bytes are prefixed with their varint encoded length
+        return size_empty_body - 1 + varint_size(body_size) + body_size
+    else:
+        raise ValueError(f"Unknown format {format}")
+
+
 class CollectorPayload(BaseModel):
     schema_name: str = Field(alias="schema", default=AVRO_SCHEMA_NAME)
     ipAddress: str
@@ -45,91 +87,17 @@ class CollectorPayload(BaseModel):
     hostname: Optional[str] = None
     networkUserId: Optional[str] = None
 
-    def split_and_serialize(self, format: str, max_size: int) -> List[bytes]:
-        # try to serialize the full event
-        serialized = self.serialize(format)
-        if len(serialized) <= max_size:
-            return [serialized]
-
-        # try to serialize without the body
-        temp_body = self.body
-        self.body = None
-        serialized = self.serialize(format)
-        size_without_body = len(serialized)
-        if size_without_body >= max_size:
-            raise PayloadException(f"Event without body too large: {size_without_body} > {max_size}")
-
-        # if we dont have a body, we are done
-        if not temp_body:
-            return [serialized]
-
-        self.body = temp_body
-        # parse and split the body
-        parsed_body = orjson.loads(self.body)
-        # check schema and data
-        if "schema" not in parsed_body:
-            raise PayloadException("Missing schema in body")
-        if "data" not in parsed_body:
-            raise PayloadException("Missing data in body")
-        schema = parsed_body["schema"]
-        try:
-            data_list = list(parsed_body["data"])
-        except TypeError:
-            raise PayloadException("Data is not iterable")
-
-        # if we have an empty list, we are done
-        if len(data_list) == 0:
-            return [serialized]
-
-        # split the data
-        logger.info(f"Splitting {len(data_list)} items")
-        result = []
-        current_data = []
-        current_body = None
-
-        while len(data_list) > 0:
-            # check if we can add another item
-            previous_body = current_body
-            item = data_list[0]
-            current_data.append(item)
-            current_body = orjson.dumps({
-                "schema": schema,
-                "data": current_data
-            })
-            if len(current_body) + size_without_body > max_size:
-                # we are over the limit
-                # we need to serialize
-                if not previous_body:
-                    # we are to large to fit a single item
-                    raise PayloadException(f"Splitted single item too large: {len(current_body) + size_without_body} > {max_size}")
-                # otherwise, we serialize the previous body
-                self.body = previous_body
-                result.append(self.serialize(format))
-                # and reset the current body
-                current_data = []
-                current_body = None
-            else:
-                # we can add another item
-                data_list.pop(0)
-        # serialize the last body
-        if current_body:
-            self.body = current_body
-            result.append(self.serialize(format))
-
-        # splitting done
-        sizes = [len(x) for x in result]
-        logger.info(f"Split into {len(result)} items with sizes {sizes}")
-        return result
-
-    def serialize(self, format: str) -> bytes:
-        if format == "thrift":
-            self.schema_name = SNOWPLOW_COLLECTOR_PAYLOAD_SCHEMA
-            return to_thrift(self)
-        elif format == "avro":
-            self.schema_name = AVRO_SCHEMA_NAME
-            return to_avro(self)
-        else:
-            raise ValueError(f"Unknown format {format}")
+    def split_and_serialize(
+        self,
+        format: str,
+        max_size: int,
+        prefix: bool = False,
+        compress: Optional[Callable[[bytes], bytes]] = None,
+    ) -> List[bytes]:
+        return split_and_serialize(self, format, max_size, prefix=prefix, compress=compress)
+
+    def serialize(self, format: str, prefix: bool = False) -> bytes:
+        return serialize(self, format, prefix=prefix)
 
     def to_json(self):
         return self.model_dump_json(by_alias=True)
@@ -140,17 +108,11 @@ class CollectorPayload(BaseModel):
     def to_avro(self):
         return to_avro(self)
 
+    def to_raw(self) -> "RawCollectorPayload":
+        return RawCollectorPayload.from_model(self)
+
     def get_headers_dict(self) -> Dict[str, str]:
-        if self.headers is None:
-            return {}
-        result = {}
-        for h in self.headers:
-            try:
-                k, v = h.split(":", 1)
-                result[k.strip()] = v.strip()
-            except ValueError:
-                pass
-        return result
+        return parse_headers(self.headers)
 
     @classmethod
     def from_thrift(cls, b: bytes):
@@ -160,6 +122,10 @@ class CollectorPayload(BaseModel):
     def from_avro(cls, b: bytes):
         return from_avro(b)
 
+    @classmethod
+    def decode(cls, b: bytes, format: str) -> "CollectorPayload":
+        return decode(b, format).to_model()
+
 
 class ErrorPayload(BaseModel):
     collector_domain: str
@@ -258,79 +224,339 @@ RAW_AVRO_SCHEMA = {
 AVRO_SCHEMA = parse_schema(RAW_AVRO_SCHEMA)
 
 
-def to_thrift(e: CollectorPayload):
-    o = BytesIO()
-    d = e.model_dump(by_alias=True)
-    te = TCollectorPayload(
-        schema=d["schema"],
-        ipAddress=d["ipAddress"],
-        timestamp=d["timestamp"],
-        encoding=d["encoding"],
-        collector=d["collector"],
-        userAgent=d["userAgent"],
-        refererUri=d["refererUri"],
-        path=d["path"],
-        querystring=d["querystring"],
-        body=d["body"],
-        headers=d["headers"],
-        contentType=d["contentType"],
-        hostname=d["hostname"],
-        networkUserId=d["networkUserId"]
-    )
-    proto = THRIFT_PROTO(o)
-    proto.write_struct(te)
-    return o.getvalue()
+RAW_FIELDS = (
+    "schema_name", "ipAddress", "timestamp", "encoding", "collector",
+    "userAgent", "refererUri", "path", "querystring", "body", "headers",
+    "contentType", "hostname", "networkUserId",
+)
+# wire names that differ from the attribute names
+WIRE_NAMES = {"schema": "schema_name"}
+
+
+class RawCollectorPayload:
+    """Slotted collector payload for the hot paths.
+
+    Same fields and methods as `CollectorPayload` but without any validation,
+    the collector builds these per request and the enricher decodes into them.
+    Use `to_model` / `from_model` to convert from and to the pydantic model.
+    """
+
+    __slots__ = RAW_FIELDS + ("_headers_dict", "_headers_source")
+
+    def __init__(self, schema_name: str = AVRO_SCHEMA_NAME, ipAddress: Optional[str] = None,
+                 timestamp: Optional[int] = None, encoding: Optional[str] = None,
+                 collector: Optional[str] = None, userAgent: Optional[str] = None,
+                 refererUri: Optional[str] = None, path: Optional[str] = None,
+                 querystring: Optional[str] = None, body: Optional[bytes] = None,
+                 headers: Optional[List[str]] = None, contentType: Optional[str] = None,
+                 hostname: Optional[str] = None, networkUserId: Optional[str] = None):
+        self.schema_name = schema_name
+        self.ipAddress = ipAddress
+        self.timestamp = timestamp
+        self.encoding = encoding
+        self.collector = collector
+        self.userAgent = userAgent
+        self.refererUri = refererUri
+        self.path = path
+        self.querystring = querystring
+        self.body = body
+        self.headers = headers
+        self.contentType = contentType
+        self.hostname = hostname
+        self.networkUserId = networkUserId
+        # parsed lazily by get_headers_dict, valid as long as `headers` is the same list
+        self._headers_dict: Optional[Dict[str, str]] = None
+        self._headers_source: Optional[List[str]] = None
+
+    def __eq__(self, other):
+        if not isinstance(other, RawCollectorPayload):
+            return NotImplemented
+        return all(getattr(self, f) == getattr(other, f) for f in RAW_FIELDS)
+
+    def __repr__(self):
+        inner = ", ".join(f"{f}={getattr(self, f)!r}" for f in RAW_FIELDS)
+        return f"RawCollectorPayload({inner})"
+
+    def copy(self) -> "RawCollectorPayload":
+        c = RawCollectorPayload(*[getattr(self, f) for f in RAW_FIELDS])
+        c._headers_dict = self._headers_dict
+        c._headers_source = self._headers_source
+        return c
+
+    def split_and_serialize(
+        self,
+        format: str,
+        max_size: int,
+        prefix: bool = False,
+        compress: Optional[Callable[[bytes], bytes]] = None,
+    ) -> List[bytes]:
+        return split_and_serialize(self, format, max_size, prefix=prefix, compress=compress)
+
+    def serialize(self, format: str, prefix: bool = False) -> bytes:
+        return serialize(self, format, prefix=prefix)
+
+    def to_json(self):
+        return self.to_model().to_json()
+
+    def to_thrift(self):
+        return to_thrift(self)
+
+    def to_avro(self):
+        return to_avro(self)
+
+    def get_headers_dict(self) -> Dict[str, str]:
+        # parsed at most once per record, the dict is shared - do not modify it
+        if self._headers_dict is None or self._headers_source is not self.headers:
+            self._headers_dict = parse_headers(self.headers)
+            self._headers_source = self.headers
+        return self._headers_dict
+
+    def to_model(self) -> CollectorPayload:
+        # the values are not validated again
+        return CollectorPayload.model_construct(**{f: getattr(self, f) for f in RAW_FIELDS})
+
+    @classmethod
+    def from_model(cls, model: CollectorPayload) -> "RawCollectorPayload":
+        return cls(*[getattr(model, f) for f in RAW_FIELDS])
+
+    @classmethod
+    def from_thrift(cls, b: bytes) -> "RawCollectorPayload":
+        return decode_thrift(b)
+
+    @classmethod
+    def from_avro(cls, b: bytes) -> "RawCollectorPayload":
+        return decode_avro(b)
+
+    @classmethod
+    def decode(cls, b: bytes, format: str) -> "RawCollectorPayload":
+        return decode(b, format)
+
+
+Payload = Union[CollectorPayload, RawCollectorPayload]
+
+
+_avro_encode = compile_avro_encoder(RAW_AVRO_SCHEMA, WIRE_NAMES)
+_avro_decode = compile_avro_decoder(RAW_AVRO_SCHEMA, WIRE_NAMES)
+_thrift_encode = compile_thrift_encoder(TCollectorPayload.thrift_spec, WIRE_NAMES)
+_thrift_decode = compile_thrift_decoder(TCollectorPayload.thrift_spec, WIRE_NAMES,
+                                        binary_fields=frozenset(["body"]))
+_compact_encode = compile_thrift_compact_encoder(TCollectorPayload.thrift_spec, WIRE_NAMES)
+_compact_decode = compile_thrift_compact_decoder(TCollectorPayload.thrift_spec, WIRE_NAMES,
+                                                 binary_fields=frozenset(["body"]))
+
+# format -> (schema name, encoder, decoder)
+_CODECS = {
+    "avro": (AVRO_SCHEMA_NAME, _avro_encode, _avro_decode),
+    "thrift": (SNOWPLOW_COLLECTOR_PAYLOAD_SCHEMA, _thrift_encode, _thrift_decode),
+    "thrift-compact": (SNOWPLOW_COLLECTOR_PAYLOAD_SCHEMA, _compact_encode, _compact_decode),
+}
+
+
+def parse_headers(headers: Optional[List[str]]) -> Dict[str, str]:
+    if headers is None:
+        return {}
+    result = {}
+    for h in headers:
+        try:
+            k, v = h.split(":", 1)
+            result[k.strip()] = v.strip()
+        except ValueError:
+            pass
+    return result
+
+
+def serialize(e: Payload, format: str, prefix: bool = False) -> bytes:
+    try:
+        schema_name, encode, _ = _CODECS[format]
+    except KeyError:
+        raise ValueError(f"Unknown format {format}")
+    e.schema_name = schema_name
+    if prefix:
+        return FORMAT_PREFIXES[format] + encode(e)
+    return encode(e)
+
+
+def decode(b: bytes, format: str) -> RawCollectorPayload:
+    """Decode a raw record, the format prefix wins over the given format."""
+    if b and b[0] in PREFIX_FORMATS:
+        format = PREFIX_FORMATS[b[0]]
+        b = b[1:]
+    try:
+        _, _, decoder = _CODECS[format]
+    except KeyError:
+        raise ValueError(f"Unknown format {format}")
+    return RawCollectorPayload(**decoder(b))
+
+
+def split_and_serialize(e: Payload, format: str, max_size: int,
+                        prefix: bool = False,
+                        compress: Optional[Callable[[bytes], bytes]] = None) -> List[bytes]:
+    """Serialize the event, split the body if it is larger than `max_size`.
+
+    If `compress` is given the returned records are compressed and
+    `max_size` applies to the compressed records.
+    """
+    body = e.body
+
+    def finish(record: bytes) -> bytes:
+        return compress(record) if compress is not None else record
+
+    # if we dont have a body, we are done
+    if not body:
+        serialized = finish(serialize(e, format, prefix=prefix))
+        if len(serialized) > max_size:
+            raise PayloadTooLargeException(
+                f"Event too large: {len(serialized)} > {max_size}"
+            )
+        return [serialized]
+
+    # serialize the event with an empty body once, the size of the
+    # full event can then be calculated for any body length
+    e.body = b""
+    try:
+        size_without_body = len(serialize(e, format, prefix=prefix))
+    finally:
+        e.body = body
+
+    # try to serialize the full event
+    full_size = record_size(format, size_without_body, len(body))
+    if full_size <= max_size:
+        return [finish(serialize(e, format, prefix=prefix))]
+
+    # the uncompressed size limit for the chunks
+    limit = max_size
+    if compress is not None:
+        compressed = compress(serialize(e, format, prefix=prefix))
+        if len(compressed) <= max_size:
+            return [compressed]
+        # estimate from the compression ratio of the full event,
+        # chunks that still turn out too large are split again below
+        limit = max(
+            max_size,
+            int(max_size * full_size / len(compressed) * COMPRESSED_SPLIT_MARGIN),
+        )
+
+    if size_without_body >= max_size:
+        raise PayloadTooLargeException(
+            f"Event without body too large: {size_without_body} > {max_size}"
+        )
+
+    # parse and split the body
+    try:
+        parsed_body = orjson.loads(body)
+    except orjson.JSONDecodeError as ex:
+        raise PayloadException(f"Body is not valid JSON: {ex}")
+    if not isinstance(parsed_body, dict):
+        raise PayloadException("Body is not a JSON object")
+    # check schema and data
+    if "schema" not in parsed_body:
+        raise PayloadException("Missing schema in body")
+    if "data" not in parsed_body:
+        raise PayloadException("Missing data in body")
+    schema = parsed_body["schema"]
+    try:
+        data_list = list(parsed_body["data"])
+    except TypeError:
+        raise PayloadException("Data is not iterable")
+
+    # if we have an empty list, we are done
+    if len(data_list) == 0:
+        e.body = None
+        try:
+            return [finish(serialize(e, format, prefix=prefix))]
+        finally:
+            e.body = body
+
+    # split the data
+    logger.info(f"Splitting {len(data_list)} items")
+    # encode every item once - the chunks are built from the encoded items
+    # and are identical to orjson.dumps({"schema": schema, "data": items})
+    head = b'{"schema":' + orjson.dumps(schema) + b',"data":['
+    tail = b"]}"
+    empty_size = len(head) + len(tail)
+    chunks = []
+    current_items = []
+    current_size = empty_size
+    for item in data_list:
+        encoded = orjson.dumps(item)
+        # items are separated by a comma
+        size = current_size + len(encoded) + (1 if current_items else 0)
+        if record_size(format, size_without_body, size) > limit:
+            if not current_items:
+                # we are to large to fit a single item
+                raise PayloadTooLargeException(
+                    f"Splitted single item too large: "
+                    f"{record_size(format, size_without_body, size)} > {max_size}")
+            chunks.append(current_items)
+            current_items = []
+            size = empty_size + len(encoded)
+            if record_size(format, size_without_body, size) > limit:
+                raise PayloadTooLargeException(
+                    f"Splitted single item too large: "
+                    f"{record_size(format, size_without_body, size)} > {max_size}")
+        current_items.append(encoded)
+        current_size = size
+    if current_items:
+        chunks.append(current_items)
+
+    # serialize every chunk exactly once
+    result = []
+    try:
+        while chunks:
+            items = chunks.pop(0)
+            e.body = head + b",".join(items) + tail
+            record = finish(serialize(e, format, prefix=prefix))
+            if len(record) > max_size:
+                # only possible with compression - split the chunk in half
+                if len(items) == 1:
+                    raise PayloadTooLargeException(
+                        f"Splitted single item too large: {len(record)} > {max_size}"
+                    )
+                half = len(items) // 2
+                chunks[0:0] = [items[:half], items[half:]]
+                continue
+            result.append(record)
+    finally:
+        e.body = body
+
+    # splitting done
+    sizes = [len(x) for x in result]
+    logger.info(f"Split into {len(result)} items with sizes {sizes}")
+    return result
+
+
+def to_thrift(e: Payload) -> bytes:
+    return _thrift_encode(e)
+
+
+def decode_thrift(b: bytes) -> RawCollectorPayload:
+    return RawCollectorPayload(**_thrift_decode(b))
 
 
 def from_thrift(b: bytes) -> CollectorPayload:
-    i = BytesIO(b)
-    proto = THRIFT_PROTO(i)
-    te = TCollectorPayload()
-    proto.read_struct(te)
-    return CollectorPayload(
-        schema=te.schema,
-        ipAddress=te.ipAddress,
-        timestamp=te.timestamp,
-        encoding=te.encoding,
-        collector=te.collector,
-        userAgent=te.userAgent,
-        refererUri=te.refererUri,
-        path=te.path,
-        querystring=te.querystring,
-        body=te.body,
-        headers=te.headers,
-        contentType=te.contentType,
-        hostname=te.hostname,
-        networkUserId=te.networkUserId
-    )
-
-
-def to_avro(e: CollectorPayload):
-    o = BytesIO()
-    d = e.model_dump(by_alias=True)
-    schemaless_writer(o, AVRO_SCHEMA, d)
-    return o.getvalue()
+    # the decoded values are already typed - skip the validation
+    return CollectorPayload.model_construct(**_thrift_decode(b))
+
+
+def to_avro(e: Payload) -> bytes:
+    return _avro_encode(e)
+
+
+def decode_avro(b: bytes) -> RawCollectorPayload:
+    return RawCollectorPayload(**_avro_decode(b))
 
 
 def from_avro(b: bytes) -> CollectorPayload:
-    i = BytesIO(b)
-    try:
-        d = schemaless_reader(i, AVRO_SCHEMA)
-    except EOFError:
-        raise ValueError(f"Invalid AVRO message: {b}")
-    return CollectorPayload(
-        schema=d["schema"],
-        ipAddress=d["ipAddress"],
-        timestamp=d["timestamp"],
-        encoding=d["encoding"],
-        collector=d["collector"],
-        userAgent=d["userAgent"],
-        refererUri=d["refererUri"],
-        path=d["path"],
-        querystring=d["querystring"],
-        body=d["body"],
-        headers=d["headers"],
-        contentType=d["contentType"],
-        hostname=d["hostname"],
-        networkUserId=d["networkUserId"]
-    )
+    return CollectorPayload.model_construct(**_avro_decode(b))
+
+
+def to_thrift_compact(e: Payload) -> bytes:
+    return _compact_encode(e)
+
+
+def decode_thrift_compact(b: bytes) -> RawCollectorPayload:
+    return RawCollectorPayload(**_compact_decode(b))
+
+
+def from_thrift_compact(b: bytes) -> CollectorPayload:
+    return CollectorPayload.model_construct(**_compact_decode(b))
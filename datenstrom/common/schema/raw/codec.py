@@ -0,0 +1,555 @@
+"""Compiled encoders and decoders for raw collector payloads.
+
+The functions in this module turn an Avro record schema or a thrift spec
+into encode/decode functions that work directly on record attributes.
+There is no intermediate dict and no pydantic model involved, so they can be
+used on the hot path of the collector and the enricher.
+"""
+import struct
+
+from typing import Any, Callable, Dict, FrozenSet, List, Tuple
+
+from thriftpy2.thrift import TType
+
+
+Encoder = Callable[[Any], bytes]
+Decoder = Callable[[bytes], Dict[str, Any]]
+
+_pack_i16 = struct.Struct(">h").pack
+_pack_i32 = struct.Struct(">i").pack
+_pack_i64 = struct.Struct(">q").pack
+_unpack_i16 = struct.Struct(">h").unpack_from
+_unpack_i32 = struct.Struct(">i").unpack_from
+_unpack_i64 = struct.Struct(">q").unpack_from
+
+
+# Avro
+
+def varint(n: int) -> bytes:
+    """Unsigned LEB128 varint."""
+    if n < 0x80:
+        return bytes((n,))
+    out = bytearray()
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def read_varint(b: bytes, pos: int) -> Tuple[int, int]:
+    shift = 0
+    n = 0
+    while True:
+        byte = b[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def avro_long(n: int) -> bytes:
+    """Zigzag varint encoding of an Avro long."""
+    return varint((n << 1) ^ (n >> 63))
+
+
+def read_avro_long(b: bytes, pos: int) -> Tuple[int, int]:
+    n, pos = read_varint(b, pos)
+    return (n >> 1) ^ -(n & 1), pos
+
+
+# every value of the supported types starts with a long
+# (the length for strings and bytes and the block count for arrays)
+STRING, BYTES, LONG, STRING_ARRAY = range(4)
+
+_AVRO_TYPES = {"string": STRING, "bytes": BYTES, "long": LONG}
+# avro encoded longs for small lengths and counts
+_SMALL_LONGS = [avro_long(i) for i in range(1024)]
+
+
+def _avro_type(field_type: Any) -> Tuple[int, bool]:
+    """Return (kind, nullable) for the field types used in raw records."""
+    nullable = False
+    if isinstance(field_type, list):
+        types = [t for t in field_type if t != "null"]
+        if len(types) != 1 or field_type[0] != "null":
+            raise ValueError(f"Unsupported avro union: {field_type}")
+        nullable = True
+        field_type = types[0]
+    if isinstance(field_type, dict):
+        if field_type.get("type") == "array" and field_type.get("items") == "string":
+            return STRING_ARRAY, nullable
+        raise ValueError(f"Unsupported avro type: {field_type}")
+    if field_type not in _AVRO_TYPES:
+        raise ValueError(f"Unsupported avro type: {field_type}")
+    return _AVRO_TYPES[field_type], nullable
+
+
+def _avro_fields(
+    schema: Dict[str, Any], attributes: Dict[str, str]
+) -> List[Tuple[str, int, bool]]:
+    fields = []
+    for field in schema["fields"]:
+        kind, nullable = _avro_type(field["type"])
+        fields.append((attributes.get(field["name"], field["name"]), kind, nullable))
+    return fields
+
+
+def compile_avro_encoder(schema: Dict[str, Any], attributes: Dict[str, str]) -> Encoder:
+    """Compile an encoder for an Avro record schema.
+
+    `attributes` maps Avro field names to attribute names on the record if
+    they differ.
+    """
+    fields = _avro_fields(schema, attributes)
+    small = _SMALL_LONGS
+
+    def encode(record: Any) -> bytes:
+        parts: List[bytes] = []
+        append = parts.append
+        for attribute, kind, nullable in fields:
+            value = getattr(record, attribute)
+            if nullable:
+                if value is None:
+                    append(b"\x00")
+                    continue
+                append(b"\x02")
+            if kind == LONG:
+                append(avro_long(value))
+                continue
+            if kind == STRING_ARRAY:
+                if value:
+                    append(
+                        small[len(value)] if len(value) < 1024 else avro_long(len(value))
+                    )
+                    for item in value:
+                        item = item.encode("utf-8")
+                        append(
+                            small[len(item)] if len(item) < 1024 else avro_long(len(item))
+                        )
+                        append(item)
+                append(b"\x00")
+                continue
+            if value.__class__ is str:
+                value = value.encode("utf-8")
+            append(small[len(value)] if len(value) < 1024 else avro_long(len(value)))
+            append(value)
+        return b"".join(parts)
+
+    return encode
+
+
+def compile_avro_decoder(schema: Dict[str, Any], attributes: Dict[str, str]) -> Decoder:
+    """Compile a decoder that returns a dict keyed by attribute name."""
+    fields = _avro_fields(schema, attributes)
+
+    def decode(b: bytes) -> Dict[str, Any]:
+        result = {}
+        pos = 0
+        size = len(b)
+        try:
+            for attribute, kind, nullable in fields:
+                if nullable:
+                    index = b[pos]
+                    pos += 1
+                    if index == 0:
+                        result[attribute] = None
+                        continue
+                    if index != 2:
+                        raise ValueError(
+                            f"Invalid AVRO message: bad union index for {attribute}"
+                        )
+                n = b[pos]
+                if n < 0x80:
+                    pos += 1
+                    n = (n >> 1) ^ -(n & 1)
+                else:
+                    n, pos = read_avro_long(b, pos)
+                if kind == LONG:
+                    result[attribute] = n
+                elif kind == STRING_ARRAY:
+                    items = []
+                    while n:
+                        if n < 0:
+                            # negative block counts are followed by the block size
+                            n = -n
+                            _, pos = read_avro_long(b, pos)
+                        for _ in range(n):
+                            length, pos = read_avro_long(b, pos)
+                            end = pos + length
+                            if end > size:
+                                raise IndexError("string out of range")
+                            items.append(b[pos:end].decode("utf-8"))
+                            pos = end
+                        n, pos = read_avro_long(b, pos)
+                    result[attribute] = items
+                else:
+                    end = pos + n
+                    if n < 0 or end > size:
+                        raise IndexError("string out of range")
+                    if kind == STRING:
+                        result[attribute] = b[pos:end].decode("utf-8")
+                    else:
+                        result[attribute] = b[pos:end]
+                    pos = end
+        except IndexError:
+            raise ValueError(f"Invalid AVRO message: {b}")
+        except UnicodeDecodeError as e:
+            raise ValueError(f"Invalid AVRO message: {e}")
+        return result
+
+    return decode
+
+
+# Thrift
+
+_THRIFT_TYPES = frozenset([TType.STRING, TType.I64, TType.LIST])
+
+
+def _thrift_fields(spec: Dict[int, Tuple]) -> List[Tuple[int, int, str]]:
+    fields = []
+    for fid, field_spec in spec.items():
+        ttype, name = field_spec[0], field_spec[1]
+        if ttype == TType.LIST and field_spec[2] != TType.STRING:
+            raise ValueError(f"Unsupported thrift list type for {name}")
+        if ttype not in _THRIFT_TYPES:
+            raise ValueError(f"Unsupported thrift type for {name}: {ttype}")
+        fields.append((fid, ttype, name))
+    return fields
+
+
+def compile_thrift_encoder(spec: Dict[int, Tuple], attributes: Dict[str, str]) -> Encoder:
+    """Compile a TBinaryProtocol struct encoder for a thrift spec."""
+    fields = []
+    for fid, ttype, name in _thrift_fields(spec):
+        header = bytes((ttype,)) + _pack_i16(fid)
+        if ttype == TType.LIST:
+            header += bytes((TType.STRING,))
+        fields.append((attributes.get(name, name), header, ttype))
+    string, i64 = TType.STRING, TType.I64
+
+    def encode(record: Any) -> bytes:
+        parts: List[bytes] = []
+        append = parts.append
+        for attribute, header, ttype in fields:
+            value = getattr(record, attribute)
+            if value is None:
+                continue
+            append(header)
+            if ttype == string:
+                if value.__class__ is str:
+                    value = value.encode("utf-8")
+                append(_pack_i32(len(value)))
+                append(value)
+            elif ttype == i64:
+                append(_pack_i64(value))
+            else:
+                append(_pack_i32(len(value)))
+                for item in value:
+                    item = item.encode("utf-8")
+                    append(_pack_i32(len(item)))
+                    append(item)
+        append(b"\x00")  # STOP
+        return b"".join(parts)
+
+    return encode
+
+
+def _skip_thrift(b: bytes, pos: int, ttype: int) -> int:
+    if ttype in (TType.BOOL, TType.BYTE):
+        return pos + 1
+    if ttype == TType.I16:
+        return pos + 2
+    if ttype == TType.I32:
+        return pos + 4
+    if ttype in (TType.I64, TType.DOUBLE):
+        return pos + 8
+    if ttype == TType.STRING:
+        return pos + 4 + _unpack_i32(b, pos)[0]
+    if ttype in (TType.LIST, TType.SET):
+        etype = b[pos]
+        size = _unpack_i32(b, pos + 1)[0]
+        pos += 5
+        for _ in range(size):
+            pos = _skip_thrift(b, pos, etype)
+        return pos
+    if ttype == TType.MAP:
+        ktype, vtype = b[pos], b[pos + 1]
+        size = _unpack_i32(b, pos + 2)[0]
+        pos += 6
+        for _ in range(size):
+            pos = _skip_thrift(b, pos, ktype)
+            pos = _skip_thrift(b, pos, vtype)
+        return pos
+    if ttype == TType.STRUCT:
+        while True:
+            ftype = b[pos]
+            pos += 1
+            if ftype == TType.STOP:
+                return pos
+            pos = _skip_thrift(b, pos + 2, ftype)
+    raise ValueError(f"Unknown thrift type {ttype}")
+
+
+def compile_thrift_decoder(spec: Dict[int, Tuple], attributes: Dict[str, str],
+                           binary_fields: FrozenSet[str] = frozenset()) -> Decoder:
+    """Compile a TBinaryProtocol struct decoder for a thrift spec.
+
+    Strings are decoded as utf-8 unless the field is listed in
+    `binary_fields`, those are returned as bytes.
+    """
+    fields = {}
+    for fid, ttype, name in _thrift_fields(spec):
+        fields[fid] = (attributes.get(name, name), ttype, name in binary_fields)
+    defaults = {attribute: None for attribute, _, _ in fields.values()}
+
+    string, i64 = TType.STRING, TType.I64
+
+    def decode(b: bytes) -> Dict[str, Any]:
+        result = dict(defaults)
+        pos = 0
+        size = len(b)
+        try:
+            while True:
+                ftype = b[pos]
+                if ftype == TType.STOP:
+                    break
+                fid = _unpack_i16(b, pos + 1)[0]
+                pos += 3
+                field = fields.get(fid)
+                if field is None or field[1] != ftype:
+                    pos = _skip_thrift(b, pos, ftype)
+                    continue
+                attribute, ttype, binary = field
+                if ttype == string:
+                    length = _unpack_i32(b, pos)[0]
+                    pos += 4
+                    end = pos + length
+                    if length < 0 or end > size:
+                        raise IndexError("string out of range")
+                    result[attribute] = b[pos:end] if binary else b[pos:end].decode("utf-8")
+                    pos = end
+                elif ttype == i64:
+                    result[attribute] = _unpack_i64(b, pos)[0]
+                    pos += 8
+                else:
+                    etype = b[pos]
+                    count = _unpack_i32(b, pos + 1)[0]
+                    pos += 5
+                    items = []
+                    for _ in range(count):
+                        if etype != string:
+                            pos = _skip_thrift(b, pos, etype)
+                            continue
+                        length = _unpack_i32(b, pos)[0]
+                        pos += 4
+                        end = pos + length
+                        if length < 0 or end > size:
+                            raise IndexError("string out of range")
+                        items.append(b[pos:end].decode("utf-8"))
+                        pos = end
+                    result[attribute] = items
+        except (IndexError, struct.error):
+            raise ValueError(f"Invalid thrift message: {b}")
+        except UnicodeDecodeError as e:
+            raise ValueError(f"Invalid thrift message: {e}")
+        return result
+
+    return decode
+
+
+# Thrift compact protocol
+
+COMPACT_TYPES = {
+    TType.BOOL: 1,  # BOOLEAN_TRUE, 2 is BOOLEAN_FALSE
+    TType.BYTE: 3,
+    TType.I16: 4,
+    TType.I32: 5,
+    TType.I64: 6,
+    TType.DOUBLE: 7,
+    TType.STRING: 8,
+    TType.LIST: 9,
+    TType.SET: 10,
+    TType.MAP: 11,
+    TType.STRUCT: 12,
+}
+_COMPACT_STRING = COMPACT_TYPES[TType.STRING]
+_COMPACT_I64 = COMPACT_TYPES[TType.I64]
+_COMPACT_LIST = COMPACT_TYPES[TType.LIST]
+
+
+def _compact_field_header(last_fid: int, fid: int, ctype: int) -> bytes:
+    delta = fid - last_fid
+    if 0 < delta <= 15:
+        return bytes(((delta << 4) | ctype,))
+    return bytes((ctype,)) + varint((fid << 1) ^ (fid >> 15))
+
+
+def _compact_list_header(size: int, ctype: int) -> bytes:
+    if size < 15:
+        return bytes(((size << 4) | ctype,))
+    return bytes((0xF0 | ctype,)) + varint(size)
+
+
+def compile_thrift_compact_encoder(
+    spec: Dict[int, Tuple], attributes: Dict[str, str]
+) -> Encoder:
+    """Compile a TCompactProtocol struct encoder for a thrift spec."""
+    fields = [(attributes.get(name, name), fid, COMPACT_TYPES[ttype])
+              for fid, ttype, name in _thrift_fields(spec)]
+    # field headers depend on the id of the previously written field
+    headers: Dict[Tuple[int, int], bytes] = {}
+
+    def encode(record: Any) -> bytes:
+        parts: List[bytes] = []
+        append = parts.append
+        last_fid = 0
+        for attribute, fid, ctype in fields:
+            value = getattr(record, attribute)
+            if value is None:
+                continue
+            header = headers.get((last_fid, fid))
+            if header is None:
+                header = headers[(last_fid, fid)] = _compact_field_header(
+                    last_fid, fid, ctype
+                )
+            append(header)
+            last_fid = fid
+            if ctype == _COMPACT_STRING:
+                if value.__class__ is str:
+                    value = value.encode("utf-8")
+                append(varint(len(value)))
+                append(value)
+            elif ctype == _COMPACT_I64:
+                append(varint((value << 1) ^ (value >> 63)))
+            else:
+                append(_compact_list_header(len(value), _COMPACT_STRING))
+                for item in value:
+                    item = item.encode("utf-8")
+                    append(varint(len(item)))
+                    append(item)
+        append(b"\x00")  # STOP
+        return b"".join(parts)
+
+    return encode
+
+
+def _skip_compact(b: bytes, pos: int, ctype: int) -> int:
+    if ctype in (1, 2):
+        # booleans are encoded in the field type
+        return pos
+    if ctype == 3:
+        return pos + 1
+    if ctype in (4, 5, 6):
+        return read_varint(b, pos)[1]
+    if ctype == 7:
+        return pos + 8
+    if ctype == 8:
+        size, pos = read_varint(b, pos)
+        return pos + size
+    if ctype in (9, 10):
+        header = b[pos]
+        pos += 1
+        size = header >> 4
+        if size == 15:
+            size, pos = read_varint(b, pos)
+        etype = header & 0x0F
+        for _ in range(size):
+            # booleans in containers take one byte
+            pos = pos + 1 if etype in (1, 2) else _skip_compact(b, pos, etype)
+        return pos
+    if ctype == 11:
+        size, pos = read_varint(b, pos)
+        if size == 0:
+            return pos
+        ktype, vtype = b[pos] >> 4, b[pos] & 0x0F
+        pos += 1
+        for _ in range(size):
+            pos = pos + 1 if ktype in (1, 2) else _skip_compact(b, pos, ktype)
+            pos = pos + 1 if vtype in (1, 2) else _skip_compact(b, pos, vtype)
+        return pos
+    if ctype == 12:
+        while True:
+            header = b[pos]
+            pos += 1
+            if header == 0:
+                return pos
+            if header >> 4 == 0:
+                pos = read_varint(b, pos)[1]
+            pos = _skip_compact(b, pos, header & 0x0F)
+    raise ValueError(f"Unknown compact thrift type {ctype}")
+
+
+def compile_thrift_compact_decoder(spec: Dict[int, Tuple], attributes: Dict[str, str],
+                                   binary_fields: FrozenSet[str] = frozenset()) -> Decoder:
+    """Compile a TCompactProtocol struct decoder for a thrift spec."""
+    fields = {}
+    for fid, ttype, name in _thrift_fields(spec):
+        fields[fid] = (
+            attributes.get(name, name),
+            COMPACT_TYPES[ttype],
+            name in binary_fields,
+        )
+    defaults = {attribute: None for attribute, _, _ in fields.values()}
+
+    def decode(b: bytes) -> Dict[str, Any]:
+        result = dict(defaults)
+        pos = 0
+        size = len(b)
+        last_fid = 0
+        try:
+            while True:
+                header = b[pos]
+                pos += 1
+                if header == 0:
+                    break
+                ctype = header & 0x0F
+                delta = header >> 4
+                if delta:
+                    fid = last_fid + delta
+                else:
+                    fid, pos = read_varint(b, pos)
+                    fid = (fid >> 1) ^ -(fid & 1)
+                last_fid = fid
+                field = fields.get(fid)
+                if field is None or field[1] != ctype:
+                    pos = _skip_compact(b, pos, ctype)
+                    continue
+                attribute, ctype, binary = field
+                if ctype == _COMPACT_STRING:
+                    length, pos = read_varint(b, pos)
+                    end = pos + length
+                    if end > size:
+                        raise IndexError("string out of range")
+                    result[attribute] = b[pos:end] if binary else b[pos:end].decode("utf-8")
+                    pos = end
+                elif ctype == _COMPACT_I64:
+                    n, pos = read_varint(b, pos)
+                    result[attribute] = (n >> 1) ^ -(n & 1)
+                else:
+                    list_header = b[pos]
+                    pos += 1
+                    count = list_header >> 4
+                    if count == 15:
+                        count, pos = read_varint(b, pos)
+                    etype = list_header & 0x0F
+                    items = []
+                    for _ in range(count):
+                        if etype != _COMPACT_STRING:
+                            pos = _skip_compact(b, pos, etype)
+                            continue
+                        length, pos = read_varint(b, pos)
+                        end = pos + length
+                        if end > size:
+                            raise IndexError("string out of range")
+                        items.append(b[pos:end].decode("utf-8"))
+                        pos = end
+                    result[attribute] = items
+        except IndexError:
+            raise ValueError(f"Invalid thrift message: {b}")
+        except UnicodeDecodeError as e:
+            raise ValueError(f"Invalid thrift message: {e}")
+        return result
+
+    return decode
@@ -0,0 +1,295 @@
+"""Remote config cache shared by all worker processes on a host.
+
+The cache is a snapshot of `{hostname: [config, expires]}` in a memory
+mapped file, guarded by a sequence lock: the writer makes the sequence
+number odd, writes the snapshot and makes it even again. Readers never
+lock, they retry if the sequence number was odd or changed while they
+copied the snapshot and keep the parsed snapshot until the sequence
+number changes.
+
+Only one process writes. Every process tries to take an exclusive flock
+and the one holding it is the refresher, if it dies the lock is released
+and another process takes over. Workers ask the refresher for missing or
+expired hostnames by appending them to a small request file.
+"""
+import os
+import mmap
+import time
+import fcntl
+import struct
+import logging
+import threading
+
+import orjson
+
+from typing import Any, Dict, Iterable, Optional, Set
+
+from datenstrom.common.cache import damped_ttl
+from datenstrom.common.http import HttpClient, default_client, get_json_object
+from datenstrom.common.metrics import metrics
+
+
+# sequence number and snapshot length, written separately
+SEQ = struct.Struct("<Q")
+LENGTH = struct.Struct("<I")
+HEADER_SIZE = SEQ.size + LENGTH.size
+MAX_READ_RETRIES = 100
+MAX_HOSTNAME_LENGTH = 253
+
+
+logger = logging.getLogger(__name__)
+
+
+class SharedSnapshot:
+    """A dict snapshot in a memory mapped file with lock-free reads.
+
+    There must only be a single writer at a time.
+    """
+
+    def __init__(self, path: str, size: int = 4 * 1024 * 1024):
+        self.path = path
+        self.size = size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self._mm = mmap.mmap(
+                fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE
+            )
+        finally:
+            os.close(fd)
+        self._seq = -1
+        self._snapshot: Dict[str, Any] = {}
+
+    @property
+    def capacity(self) -> int:
+        return self.size - HEADER_SIZE
+
+    def read(self) -> Dict[str, Any]:
+        """Return the current snapshot, the result must not be modified."""
+        mm = self._mm
+        for _ in range(MAX_READ_RETRIES):
+            seq = SEQ.unpack_from(mm, 0)[0]
+            if seq == self._seq:
+                return self._snapshot
+            if seq & 1:
+                # a write is in progress
+                time.sleep(0)
+                continue
+            length = LENGTH.unpack_from(mm, SEQ.size)[0]
+            data = mm[HEADER_SIZE:HEADER_SIZE + length]
+            if SEQ.unpack_from(mm, 0)[0] != seq:
+                continue
+            try:
+                snapshot = orjson.loads(data) if length else {}
+            except orjson.JSONDecodeError:
+                continue
+            self._snapshot = snapshot
+            self._seq = seq
+            return snapshot
+        # the writer is stuck or died during a write - serve the last snapshot
+        return self._snapshot
+
+    def write(self, snapshot: Dict[str, Any]) -> bool:
+        """Publish a new snapshot, returns False if it does not fit."""
+        data = orjson.dumps(snapshot)
+        if len(data) > self.capacity:
+            return False
+        mm = self._mm
+        # odd while writing, an odd number left by a crashed writer is reused
+        seq = SEQ.unpack_from(mm, 0)[0] | 1
+        SEQ.pack_into(mm, 0, seq)
+        mm[HEADER_SIZE:HEADER_SIZE + len(data)] = data
+        LENGTH.pack_into(mm, SEQ.size, len(data))
+        SEQ.pack_into(mm, 0, seq + 1)
+        return True
+
+    def close(self):
+        self._mm.close()
+
+
+class SharedRemoteConfigClient:
+    """Remote config lookups served from a host wide shared snapshot.
+
+    `get()` never does network requests. Missing and expired hostnames
+    are requested from the refresher process, which fetches each
+    hostname once for all workers. An expired value is served until the
+    refresh is done. Entries that are not requested again are removed
+    `ttl` seconds after they expired. Missing configs and failed requests
+    are retried after `none_ttl`, doubling up to `none_ttl_max` while a
+    hostname keeps failing.
+    """
+
+    def __init__(self, endpoint: str, path: str, size: int = 4 * 1024 * 1024,
+                 ttl: int = 3600, none_ttl: int = 300, timeout: float = 5.0,
+                 poll_interval: float = 0.1, request_interval: float = 1.0,
+                 none_ttl_max: Optional[int] = None, http: Optional[HttpClient] = None):
+        self.endpoint = endpoint
+        self.path = path
+        self.size = size
+        self.ttl = ttl
+        self.none_ttl = none_ttl
+        self.none_ttl_max = none_ttl_max
+        self.timeout = timeout
+        self.http = http if http is not None else default_client()
+        self.poll_interval = poll_interval
+        self.request_interval = request_interval
+        self.requests_path = path + ".requests"
+        self.lock_path = path + ".lock"
+        self._snapshot: Optional[SharedSnapshot] = None
+        self._requested: Dict[str, float] = {}
+        self._failures: Dict[str, int] = {}
+        self._pid: Optional[int] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopped = threading.Event()
+        self._start_lock = threading.Lock()
+        self.is_refresher = False
+
+    @classmethod
+    def from_config(cls, config: Any) -> "SharedRemoteConfigClient":
+        return cls(endpoint=config.remote_config_endpoint,
+                   path=config.remote_config_shared_path,
+                   size=config.remote_config_shared_size,
+                   ttl=config.remote_config_ttl,
+                   none_ttl=config.remote_config_none_ttl,
+                   timeout=config.remote_config_timeout,
+                   none_ttl_max=config.none_cache_ttl_max,
+                   http=HttpClient.from_config(config))
+
+    def _start(self):
+        # started on first use, threads and locks do not survive a fork
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._snapshot = SharedSnapshot(self.path, self.size)
+            self._requested = {}
+            self._failures = {}
+            self._stopped = threading.Event()
+            self.is_refresher = False
+            self._thread = threading.Thread(target=self._run, daemon=True,
+                                            name="remote-config-refresher")
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def get(self, hostname: Optional[str], wait: float = 0) -> Optional[Dict[str, Any]]:
+        """Return the config for hostname, wait up to `wait` seconds for a missing entry."""
+        if not hostname or len(hostname) > MAX_HOSTNAME_LENGTH or "\n" in hostname:
+            return None
+        if self._pid != os.getpid():
+            self._start()
+        entry = self._snapshot.read().get(hostname)
+        if entry is None and wait > 0:
+            self._request(hostname)
+            deadline = time.monotonic() + wait
+            while entry is None and time.monotonic() < deadline:
+                time.sleep(self.poll_interval / 2)
+                entry = self._snapshot.read().get(hostname)
+        if entry is None:
+            self._request(hostname)
+            return None
+        if entry[1] <= time.time():
+            self._request(hostname)
+        return entry[0]
+
+    def _request(self, hostname: str):
+        now = time.monotonic()
+        last = self._requested.get(hostname, -self.request_interval)
+        if now - last < self.request_interval:
+            return
+        self._requested[hostname] = now
+        if len(self._requested) > 10_000:
+            self._requested.clear()
+        # appends of a single short line are atomic
+        fd = os.open(self.requests_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, hostname.encode("utf-8") + b"\n")
+        finally:
+            os.close(fd)
+
+    def _take_requests(self) -> Set[str]:
+        taken = f"{self.requests_path}.{os.getpid()}"
+        try:
+            os.rename(self.requests_path, taken)
+        except FileNotFoundError:
+            return set()
+        try:
+            with open(taken, "rb") as f:
+                lines = f.read().split(b"\n")
+        finally:
+            os.remove(taken)
+        return {line.decode("utf-8", "replace") for line in lines if line}
+
+    def _run(self):
+        lock_file = open(self.lock_path, "a")
+        try:
+            while not self._stopped.is_set():
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    self._stopped.wait(1.0)
+                    continue
+                self.is_refresher = True
+                logger.info("process %d refreshes the shared remote config", os.getpid())
+                while not self._stopped.wait(self.poll_interval):
+                    try:
+                        self.refresh(self._take_requests())
+                    except Exception as e:
+                        logger.error("shared remote config refresh failed: %s", e)
+        finally:
+            lock_file.close()
+
+    def refresh(self, hostnames: Iterable[str]) -> bool:
+        """Fetch the hostnames that are missing or expired and publish a new snapshot."""
+        current = self._snapshot.read()
+        snapshot = dict(current)
+        now = time.time()
+        for hostname in hostnames:
+            entry = snapshot.get(hostname)
+            if entry is not None and entry[1] > now:
+                continue
+            try:
+                value = self._fetch(hostname)
+            except Exception as e:
+                logger.warning("remote config request for %s failed: %s", hostname, e)
+                # keep serving the last known value and retry after the negative ttl
+                value = entry[0] if entry is not None else None
+                snapshot[hostname] = [value, now + self._none_ttl(hostname)]
+                continue
+            metrics.incr("remote_config.shared_fetch")
+            if value is None:
+                snapshot[hostname] = [None, now + self._none_ttl(hostname)]
+            else:
+                self._failures.pop(hostname, None)
+                snapshot[hostname] = [value, now + self.ttl]
+        for hostname, (value, expires) in list(snapshot.items()):
+            if expires + self.ttl < now:
+                del snapshot[hostname]
+        if snapshot == current:
+            return False
+        while not self._snapshot.write(snapshot):
+            # too large - drop the entries that expire first
+            hostname = min(snapshot, key=lambda h: snapshot[h][1])
+            del snapshot[hostname]
+            metrics.incr("remote_config.shared_evicted")
+        return True
+
+    def _none_ttl(self, hostname: str) -> float:
+        failures = self._failures.get(hostname, 0)
+        if len(self._failures) > 10_000:
+            self._failures.clear()
+        self._failures[hostname] = failures + 1
+        return damped_ttl(self.none_ttl, failures, self.none_ttl_max)
+
+    def _fetch(self, hostname: str) -> Optional[Dict[str, Any]]:
+        return get_json_object(self.http, self.endpoint, params={"hostname": hostname},
+                               timeout=(self.http.timeout[0], self.timeout))
+
+    def close(self):
+        self._stopped.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
+        self._pid = None
+        self.http.close()
@@ -1,6 +1,7 @@
+import threading
 import unittest
 
-from datenstrom.common.cache import TTLCache
+from datenstrom.common.cache import TTLCache, SingleFlightCache
 
 
 class Timer:
@@ -109,3 +110,206 @@ class TTLCacheTest(unittest.TestCase):
         self.assertEqual(4, cache[4])
         self.assertEqual(1, len(cache))
         self.assertEqual({4}, set(cache))
+
+    def test_mixed_ttl_expire(self):
+        cache = TTLCache(maxsize=10, ttl=3, none_ttl=1, timer=Timer())
+        cache[1] = 1
+        cache[2] = None
+        cache.timer.tick()
+        cache[3] = None
+        cache[4] = 4
+        self.assertEqual({1, 3, 4}, set(cache))
+        # the value expiring first was inserted after a value that lives longer
+        cache.timer.tick()
+        cache.expire()
+        self.assertEqual({1, 4}, set(cache))
+        self.assertEqual(2, len(cache))
+        cache.timer.tick()
+        cache.expire()
+        self.assertEqual({4}, set(cache))
+
+    def test_item_ttl(self):
+        cache = TTLCache(maxsize=10, ttl=5, none_ttl=1, timer=Timer())
+        cache.setitem(1, None, 3)
+        cache[2] = None
+        cache[3] = 3
+        cache.timer.tick()
+        cache.expire()
+        self.assertEqual({1, 3}, set(cache))
+        cache.timer.tick()
+        cache.timer.tick()
+        cache.expire()
+        self.assertEqual({3}, set(cache))
+
+    def test_pickle(self):
+        import pickle
+
+        cache = TTLCache(maxsize=10, ttl=3, none_ttl=1, timer=Timer())
+        cache[1] = 1
+        cache[2] = None
+        cache[3] = 3
+        copy = pickle.loads(pickle.dumps(cache))
+        self.assertEqual({1, 2, 3}, set(copy))
+        copy.timer.tick()
+        copy.expire()
+        self.assertEqual({1, 3}, set(copy))
+        copy[4] = None
+        self.assertEqual(None, copy[4])
+        self.assertEqual(1, copy.popitem()[0])
+
+
+class SingleFlightCacheTest(unittest.TestCase):
+    def test_coalesce(self):
+        cache = SingleFlightCache(TTLCache(maxsize=10, ttl=60))
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def loader():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "value"
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get("k", loader)))
+                   for _ in range(5)]
+        threads[0].start()
+        started.wait(5)
+        for t in threads[1:]:
+            t.start()
+        while cache.coalesced < 4:
+            threading.Event().wait(0.01)
+        release.set()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(1, len(calls))
+        self.assertEqual(["value"] * 5, results)
+        self.assertEqual("value", cache.get("k", loader))
+        self.assertEqual(
+            {
+                "hits": 1,
+                "misses": 1,
+                "coalesced": 4,
+                "stale": 0,
+                "refreshes": 0,
+                "fallbacks": 0,
+                "size": 1,
+            },
+            cache.stats(),
+        )
+
+    def test_error(self):
+        cache = SingleFlightCache(TTLCache(maxsize=10, ttl=60))
+
+        def failing():
+            raise ConnectionError("down")
+
+        with self.assertRaises(ConnectionError):
+            cache.get("k", failing)
+        self.assertNotIn("k", cache)
+        self.assertEqual(None, cache.get("k", lambda: None))
+        self.assertIn("k", cache)
+
+    def test_stale_while_revalidate(self):
+        timer = Timer()
+        cache = SingleFlightCache(TTLCache(maxsize=10, ttl=10, timer=timer), refresh_ttl=5)
+        loads = []
+
+        def loader():
+            loads.append(1)
+            return len(loads)
+
+        try:
+            self.assertEqual(1, cache.get("k", loader))
+            timer.time = 6
+            # the stale value is served while it is reloaded in the background
+            self.assertEqual(1, cache.get("k", loader))
+            for _ in range(500):
+                if cache.refreshes and "k" not in cache._flights:
+                    break
+                threading.Event().wait(0.01)
+            self.assertEqual(2, cache.get("k", loader))
+            self.assertEqual(1, cache.stale)
+        finally:
+            cache.close()
+
+    def test_refresh_hot(self):
+        timer = Timer()
+        cache = SingleFlightCache(TTLCache(maxsize=10, ttl=10, timer=timer),
+                                  refresh_ttl=5, hot_reads=2, refresh_interval=60)
+        values = {"hot": 0, "cold": 0}
+
+        def loader(key):
+            values[key] += 1
+            return values[key]
+
+        try:
+            for _ in range(3):
+                cache.get("hot", lambda: loader("hot"))
+            cache.get("cold", lambda: loader("cold"))
+            timer.time = 6
+            cache.refresh_hot()
+            cache._queue.put(None)
+            cache._thread.join()
+            self.assertEqual({"hot": 2, "cold": 1}, values)
+        finally:
+            cache.close()
+
+    def test_refresh_hot_without_stale_read(self):
+        timer = Timer()
+        cache = SingleFlightCache(TTLCache(maxsize=10, ttl=10, timer=timer),
+                                  refresh_ttl=5, hot_reads=2, refresh_interval=0.01)
+        loads = []
+
+        def loader():
+            loads.append(timer.time)
+            return len(loads)
+
+        try:
+            for _ in range(3):
+                cache.get("k", loader)
+            timer.time = 6
+            # the key is not read between the soft and the hard TTL
+            for _ in range(500):
+                if len(loads) == 2 and "k" not in cache._flights:
+                    break
+                threading.Event().wait(0.01)
+            self.assertEqual([0, 6], loads)
+            self.assertEqual(0, cache.stale)
+            timer.time = 11
+            self.assertIn("k", cache)
+            self.assertEqual(2, cache.get("k", loader))
+        finally:
+            cache.close()
+
+    def test_fallback_and_none_ttl(self):
+        timer = Timer()
+        cache = SingleFlightCache(TTLCache(maxsize=10, ttl=10, none_ttl=1, timer=timer),
+                                  none_ttl_max=4, fallback=True, cache_errors=True)
+
+        def failing():
+            raise ConnectionError("down")
+
+        self.assertEqual("good", cache.get("k", lambda: "good"))
+        timer.time = 10
+        # the last known value is served when the reload fails
+        self.assertEqual("good", cache.get("k", failing))
+        self.assertEqual(1, cache.fallbacks)
+
+        # failures without a last value are cached as None, the ttl doubles
+        for ttl in [1, 2, 4, 4]:
+            self.assertEqual(None, cache.get("other", failing))
+            self.assertIn("other", cache)
+            timer.time += ttl - 1
+            self.assertIn("other", cache)
+            timer.time += 1
+            self.assertNotIn("other", cache)
+
+        # a value resets the ttl
+        self.assertEqual("value", cache.get("other", lambda: "value"))
+        timer.time += 10
+        self.assertEqual(None, cache.get("other", lambda: None))
+        timer.time += 1
+        self.assertNotIn("other", cache)
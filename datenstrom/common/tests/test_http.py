@@ -0,0 +1,148 @@
+import threading
+
+import pytest
+import requests
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from datenstrom.common.http import (HttpClient, EndpointBusy, CircuitBreaker, CircuitOpen,
+                                    get_json_object)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        server.connections.add(self.client_address)
+        if self.path == "/slow":
+            server.release.wait(5)
+        status = 503 if server.failures > 0 else 200
+        server.failures -= 1
+        body = server.bodies.get(self.path, b"ok")
+        if self.path == "/missing":
+            status = 404
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.requests = 0
+    server.failures = 0
+    server.connections = set()
+    server.bodies = {}
+    server.release = threading.Event()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.release.set()
+    server.shutdown()
+    server.server_close()
+
+
+def url(server, path="/"):
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+
+def test_keep_alive(server):
+    client = HttpClient()
+    for _ in range(3):
+        assert client.get(url(server)).text == "ok"
+    assert server.requests == 3
+    assert len(server.connections) == 1
+    client.close()
+
+
+def test_retries(server):
+    client = HttpClient(retries=2, retry_backoff=0.01)
+    server.failures = 2
+    assert client.get(url(server)).status_code == 200
+    assert server.requests == 3
+
+    server.failures = 3
+    assert client.get(url(server)).status_code == 503
+    # only idempotent requests are retried
+    server.requests = 0
+    server.failures = 1
+    assert client.request("POST", url(server)).status_code == 503
+    assert server.requests == 1
+    client.close()
+
+
+def test_timeout_and_concurrency(server):
+    client = HttpClient(connect_timeout=0.2, read_timeout=0.2, retries=0, max_concurrency=1)
+    with pytest.raises(requests.Timeout):
+        client.get(url(server, "/slow"))
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(
+        client.get(url(server, "/slow"), timeout=5).status_code))
+    thread.start()
+    while server.requests < 2:
+        threading.Event().wait(0.01)
+    with pytest.raises(EndpointBusy):
+        client.get(url(server))
+    server.release.set()
+    thread.join()
+    assert results == [200]
+    client.close()
+
+
+def test_circuit_breaker():
+    timer = [0.0]
+    breaker = CircuitBreaker("test", failures=2, reset_timeout=1, reset_timeout_max=3,
+                             timer=lambda: timer[0])
+    breaker.failure()
+    assert breaker.allow()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    # a single trial request, the timeout doubles when it fails
+    timer[0] = 1
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    timer[0] = 2.5
+    assert not breaker.allow()
+    timer[0] = 3
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+def test_circuit_open(server):
+    client = HttpClient(retries=0, circuit_failures=2, circuit_reset=60)
+    server.failures = 10
+    for _ in range(2):
+        assert client.get(url(server)).status_code == 503
+    assert client.circuit_state(url(server)) == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpen):
+        client.get(url(server))
+    assert server.requests == 2
+    client.close()
+
+
+def test_get_json_object(server):
+    client = HttpClient()
+    server.bodies = {"/object": b'{"a": 1}', "/list": b"[1]"}
+    assert get_json_object(client, url(server, "/object")) == {"a": 1}
+    assert get_json_object(client, url(server, "/list")) is None
+    assert get_json_object(client, url(server, "/")) is None
+    assert get_json_object(client, url(server, "/missing")) is None
+    server.failures = 3
+    with pytest.raises(requests.HTTPError):
+        get_json_object(client, url(server, "/object"))
+    client.close()
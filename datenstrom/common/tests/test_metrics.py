@@ -0,0 +1,38 @@
+import logging
+
+from datenstrom.common.metrics import Metrics, MetricsReporter, SampledLogger
+
+
+def test_counters_and_gauges():
+    m = Metrics()
+    m.incr("requests", route="/i")
+    m.incr("requests", route="/i")
+    m.incr("bytes", 100, route="/i", sink="kafka")
+    m.register_gauge("queue_depth", lambda: 7)
+    snapshot = m.snapshot()
+    assert snapshot == {
+        "requests{route=/i}": 2,
+        "bytes{route=/i,sink=kafka}": 100,
+        "queue_depth": 7,
+    }
+    # counters are reset per interval, gauges are polled
+    assert m.snapshot() == {"queue_depth": 7}
+
+
+def test_reporter_emits(caplog):
+    m = Metrics()
+    m.incr("requests")
+    reporter = MetricsReporter(m, interval=60)
+    with caplog.at_level(logging.INFO, logger="datenstrom.metrics"):
+        reporter.emit()
+        reporter.emit()
+    assert len(caplog.records) == 1
+    assert '"requests":1' in caplog.records[0].getMessage()
+
+
+def test_sampled_logger(caplog):
+    logger = logging.getLogger("datenstrom.test.sampled")
+    with caplog.at_level(logging.DEBUG, logger="datenstrom.test.sampled"):
+        SampledLogger(logger, rate=0).debug("never")
+        SampledLogger(logger, rate=1).debug("always %d", 1)
+    assert [r.getMessage() for r in caplog.records] == ["always 1"]
@@ -1,7 +1,17 @@
 import os
 import json
 import base64
-from datenstrom.common.schema.raw import CollectorPayload, to_thrift, to_avro, from_thrift
+import orjson
+import pytest
+from io import BytesIO
+from fastavro import schemaless_reader, schemaless_writer
+from thriftpy2.protocol.binary import TBinaryProtocol
+from thriftpy2.protocol.compact import TCompactProtocol
+from datenstrom.common.schema.raw import (
+    CollectorPayload, PayloadException, RawCollectorPayload, TCollectorPayload, AVRO_SCHEMA,
+    FORMAT_PREFIXES, to_thrift, to_avro, from_thrift, from_avro, decode_thrift, decode_avro,
+    to_thrift_compact, from_thrift_compact, decode, record_size
+)
 
 
 def load_data():
@@ -30,13 +40,24 @@ def test_to_thrift():
                  b'\x0b\x00d\x00\x00\x00\x04sdsd\n\x00\xc8\x00\x00\x00\x00'
                  b'\x00\x00\x00{\x0b\x00\xd2\x00\x00\x00\x04sdsd\x0b\x00'
                  b'\xdc\x00\x00\x00\x04sdsd\x00')
-    # compact protocol
-    # assert t == (b'\x08\xd2\xe9\x03#iglu:com.acme/user/jsonschema/1-0-0'
-    #              b'\x08\xc8\x01\x04sdsd\x06\x90\x03\xf6\x01\xa8\x04sdsd'
-    #              b'\xa8\x04sdsd\x00')
     back = from_thrift(t)
     assert back == p
 
+
+def test_to_thrift_compact():
+    p = CollectorPayload(
+        schema="iglu:com.acme/user/jsonschema/1-0-0",
+        ipAddress="sdsd",
+        timestamp=123,
+        encoding="sdsd",
+        collector="sdsd",
+    )
+    t = to_thrift_compact(p)
+    assert t == (b'\x08\xd2\xe9\x03#iglu:com.acme/user/jsonschema/1-0-0'
+                 b'\x08\xc8\x01\x04sdsd\x06\x90\x03\xf6\x01\xa8\x04sdsd'
+                 b'\xa8\x04sdsd\x00')
+    assert from_thrift_compact(t) == p
+
 def test_thrift():
     test_data = load_data()
     p = from_thrift(test_data["event1"])
@@ -48,3 +69,249 @@ def test_thrift():
     t2 = to_thrift(from_thrift(t1))
     assert t1 == t2
     # assert t1 == test_data["event1"]
+
+
+def make_batch_payload(n_items: int) -> CollectorPayload:
+    data = [{"e": "pv", "eid": f"event-{i}", "url": "http://example.com/" + "x" * (i % 50)}
+            for i in range(n_items)]
+    body = orjson.dumps(
+        {
+            "schema": "iglu:com.snowplowanalytics.snowplow/payload_data/jsonschema/1-0-4",
+            "data": data,
+        }
+    )
+    return CollectorPayload(
+        ipAddress="127.0.0.1",
+        timestamp=123,
+        encoding="UTF-8",
+        collector="test",
+        path="/com.snowplowanalytics.snowplow/tp2",
+        body=body,
+    )
+
+
+@pytest.mark.parametrize("format", ["avro", "thrift", "thrift-compact"])
+def test_record_size(format):
+    p = make_batch_payload(10)
+    body = p.body
+    p.body = b""
+    size_empty_body = len(p.serialize(format))
+    p.body = body
+    assert record_size(format, size_empty_body, len(body)) == len(p.serialize(format))
+
+
+@pytest.mark.parametrize("format", ["avro", "thrift", "thrift-compact"])
+def test_split_and_serialize(format):
+    p = make_batch_payload(500)
+    original_body = p.body
+    full_size = len(p.serialize(format))
+    # no split needed
+    assert len(p.split_and_serialize(format, max_size=full_size)) == 1
+
+    max_size = 4000
+    records = p.split_and_serialize(format, max_size=max_size)
+    assert len(records) > 1
+    assert p.body == original_body
+
+    items = []
+    for i, r in enumerate(records):
+        assert len(r) <= max_size
+        body = orjson.loads(decode(r, format).body)
+        items.extend(body["data"])
+        if i + 1 < len(records):
+            # the split is greedy: the first item of the next record did not fit
+            next_item = orjson.loads(decode(records[i + 1], format).body)["data"][0]
+            body["data"].append(next_item)
+            p.body = orjson.dumps(body)
+            assert len(p.serialize(format)) > max_size
+            p.body = original_body
+    assert items == orjson.loads(original_body)["data"]
+
+
+def test_split_single_item_too_large():
+    p = make_batch_payload(3)
+    with pytest.raises(PayloadException):
+        p.split_and_serialize("avro", max_size=200)
+
+
+def full_payload() -> CollectorPayload:
+    return CollectorPayload(
+        schema="iglu:com.acme/user/jsonschema/1-0-0",
+        ipAddress="127.0.0.1",
+        timestamp=1700000000000,
+        encoding="UTF-8",
+        collector="test",
+        userAgent="Mozilla/5.0 (\u00e4\u00f6\u00fc)",
+        refererUri="http://example.com/",
+        path="/com.snowplowanalytics.snowplow/tp2",
+        querystring="a=1&b=2",
+        body=b'{"schema": "x", "data": [{"e": "pv"}]}',
+        headers=["Host: example.com", "User-Agent: test"],
+        contentType="application/json",
+        hostname="example.com",
+        networkUserId="c5f6ad3a-8ab7-4b1a-9d1c-2f1b3e8a7f10",
+    )
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        full_payload(),
+        CollectorPayload(
+            ipAddress="x", timestamp=-1, encoding="UTF-8", collector="c", headers=[]
+        ),
+    ],
+)
+def test_avro_matches_fastavro(payload):
+    o = BytesIO()
+    schemaless_writer(o, AVRO_SCHEMA, payload.model_dump(by_alias=True))
+    assert to_avro(payload) == o.getvalue()
+    d = schemaless_reader(BytesIO(o.getvalue()), AVRO_SCHEMA)
+    assert from_avro(o.getvalue()).model_dump(by_alias=True) == d
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        full_payload(),
+        CollectorPayload(
+            ipAddress="x", timestamp=-1, encoding="UTF-8", collector="c", headers=[]
+        ),
+    ],
+)
+def test_thrift_matches_thriftpy(payload):
+    o = BytesIO()
+    TBinaryProtocol(o).write_struct(TCollectorPayload(**payload.model_dump(by_alias=True)))
+    assert to_thrift(payload) == o.getvalue()
+    assert from_thrift(o.getvalue()) == payload
+
+
+@pytest.mark.parametrize("format", ["avro", "thrift"])
+def test_raw_collector_payload(format):
+    p = full_payload()
+    raw = RawCollectorPayload(**{f: getattr(p, f) for f in CollectorPayload.model_fields})
+    encode, decode = (
+        (to_avro, decode_avro) if format == "avro" else (to_thrift, decode_thrift)
+    )
+    assert encode(raw) == encode(p)
+    assert decode(encode(raw)) == raw
+
+
+def test_thrift_skips_unknown_fields():
+    t = to_thrift(full_payload())
+    # unknown i32 field 999 and a list of i64s before STOP
+    extra = (
+        b"\x08\x03\xe7\x00\x00\x00\x01"
+        + b"\x0f\x03\xe8\x0a\x00\x00\x00\x01"
+        + b"\x00" * 8
+    )
+    assert from_thrift(t[:-1] + extra + b"\x00") == full_payload()
+
+
+@pytest.mark.parametrize("decode", [from_avro, from_thrift])
+def test_decode_truncated(decode):
+    t = to_avro(full_payload()) if decode is from_avro else to_thrift(full_payload())
+    with pytest.raises(ValueError):
+        decode(t[:len(t) // 2])
+
+
+def test_raw_model_conversion():
+    p = full_payload()
+    raw = p.to_raw()
+    assert isinstance(raw, RawCollectorPayload)
+    assert raw.to_model() == p
+    assert RawCollectorPayload.from_model(p) == raw
+    assert raw.get_headers_dict() == p.get_headers_dict() == {"Host": "example.com",
+                                                              "User-Agent": "test"}
+    assert raw.to_json() == p.to_json()
+    with pytest.raises(AttributeError):
+        raw.unknown = 1
+
+
+@pytest.mark.parametrize("format", ["avro", "thrift"])
+def test_raw_split_and_serialize(format):
+    p = make_batch_payload(500)
+    raw = p.to_raw()
+    expected = p.split_and_serialize(format, max_size=4000)
+    assert raw.split_and_serialize(format, max_size=4000) == expected
+    assert raw.body == p.body
+
+    raw2 = raw.copy()
+    raw2.querystring = "e=pv"
+    assert raw.querystring is None
+    decode = (
+        RawCollectorPayload.from_avro
+        if format == "avro"
+        else RawCollectorPayload.from_thrift
+    )
+    assert decode(raw2.serialize(format)) == raw2
+
+
+@pytest.mark.parametrize(
+    "payload",
+    [
+        full_payload(),
+        CollectorPayload(
+            ipAddress="x", timestamp=-1, encoding="UTF-8", collector="c", headers=[]
+        ),
+        CollectorPayload(
+            ipAddress="x",
+            timestamp=1,
+            encoding="UTF-8",
+            collector="c",
+            headers=[f"h{i}: {i}" for i in range(40)],
+        ),
+    ],
+)
+def test_thrift_compact_matches_thriftpy(payload):
+    o = BytesIO()
+    TCompactProtocol(o).write_struct(TCollectorPayload(**payload.model_dump(by_alias=True)))
+    assert to_thrift_compact(payload) == o.getvalue()
+    assert from_thrift_compact(o.getvalue()) == payload
+
+
+@pytest.mark.parametrize("format", ["avro", "thrift", "thrift-compact"])
+def test_format_prefix(format):
+    p = full_payload()
+    raw = p.serialize(format)
+    prefixed = p.serialize(format, prefix=True)
+    assert prefixed == FORMAT_PREFIXES[format] + raw
+    # unprefixed records never look like a prefixed one
+    assert raw[0] not in [x[0] for x in FORMAT_PREFIXES.values()]
+    # the prefix wins over the configured format
+    for configured in ["avro", "thrift", "thrift-compact"]:
+        assert decode(prefixed, configured) == p.to_raw()
+    assert decode(raw, format) == p.to_raw()
+
+
+def test_split_with_prefix():
+    p = make_batch_payload(500)
+    records = p.split_and_serialize("thrift-compact", max_size=4000, prefix=True)
+    assert len(records) > 1
+    for r in records:
+        assert len(r) <= 4000
+        assert r[:1] == FORMAT_PREFIXES["thrift-compact"]
+        assert decode(r, "avro").path == p.path
+
+
+@pytest.mark.parametrize("format", ["avro", "thrift", "thrift-compact"])
+def test_split_with_compression(format):
+    import zlib
+
+    def compress(record):
+        return b"Z" + zlib.compress(record)
+
+    p = make_batch_payload(2000)
+    uncompressed = p.split_and_serialize(format, max_size=20000)
+    records = p.split_and_serialize(format, max_size=20000, compress=compress)
+    assert len(records) < len(uncompressed)
+    items = []
+    for r in records:
+        assert len(r) <= 20000
+        items.extend(orjson.loads(decode(zlib.decompress(r[1:]), format).body)["data"])
+    assert items == orjson.loads(p.body)["data"]
+
+    # everything fits compressed
+    records = p.split_and_serialize(format, max_size=len(compress(p.serialize(format))),
+                                    compress=compress)
+    assert len(records) == 1
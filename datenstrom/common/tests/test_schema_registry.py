@@ -16,6 +16,18 @@ class DummyConfig:
     ]
     default_cache_ttl = 3600
     none_cache_ttl = 60
+    cache_refresh_ratio = 0.8
+    cache_hot_reads = 10
+    none_cache_ttl_max = 3600
+    http_connect_timeout = 3.0
+    http_read_timeout = 10.0
+    http_retries = 2
+    http_retry_backoff = 0.2
+    http_pool_size = 10
+    http_max_concurrency = 10
+    http_circuit_failures = 5
+    http_circuit_reset = 5.0
+    http_circuit_reset_max = 300.0
 
 
 def test_iglu_parsing():
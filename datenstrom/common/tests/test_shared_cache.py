@@ -0,0 +1,79 @@
+import time
+import requests
+
+from datenstrom.common.shared_cache import SharedSnapshot, SharedRemoteConfigClient, SEQ
+
+
+class FakeSharedClient(SharedRemoteConfigClient):
+    calls = []
+
+    def __init__(self, path, **kwargs):
+        super().__init__(
+            endpoint="http://config.local/", path=path, poll_interval=0.01, **kwargs
+        )
+
+    def _fetch(self, hostname):
+        self.calls.append(hostname)
+        if hostname == "down.com":
+            raise requests.ConnectionError("down")
+        return {"enable_cookies": True, "call": len(self.calls)}
+
+
+def wait_for(predicate, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_snapshot(tmp_path):
+    path = str(tmp_path / "cache")
+    writer = SharedSnapshot(path, size=1024)
+    reader = SharedSnapshot(path, size=1024)
+    assert reader.read() == {}
+    assert writer.write({"a": [1, 2]})
+    assert reader.read() == {"a": [1, 2]}
+    assert not writer.write({"a": "x" * 2000})
+    assert reader.read() == {"a": [1, 2]}
+
+    # a writer died half way - readers keep the last snapshot, the next write recovers
+    SEQ.pack_into(writer._mm, 0, SEQ.unpack_from(writer._mm, 0)[0] + 1)
+    assert reader.read() == {"a": [1, 2]}
+    assert writer.write({"b": None})
+    assert reader.read() == {"b": None}
+
+
+def test_single_refresher(tmp_path):
+    FakeSharedClient.calls = []
+    path = str(tmp_path / "config")
+    a = FakeSharedClient(path)
+    b = FakeSharedClient(path)
+    try:
+        assert a.get("example.com") is None
+        assert b.get("example.com", wait=2)["call"] == 1
+        assert a.get("example.com")["call"] == 1
+        assert FakeSharedClient.calls == ["example.com"]
+        assert wait_for(lambda: a.is_refresher or b.is_refresher)
+        assert not (a.is_refresher and b.is_refresher)
+
+        # failures are cached with none_ttl
+        assert a.get("down.com", wait=2) is None
+        assert FakeSharedClient.calls.count("down.com") == 1
+    finally:
+        a.close()
+        b.close()
+
+
+def test_refresh_expired(tmp_path):
+    FakeSharedClient.calls = []
+    client = FakeSharedClient(str(tmp_path / "config"), ttl=1)
+    try:
+        assert client.get("example.com", wait=2)["call"] == 1
+        time.sleep(1.1)
+        # the expired value is served until the refresh is done
+        assert client.get("example.com")["call"] == 1
+        assert wait_for(lambda: client.get("example.com")["call"] == 2)
+    finally:
+        client.close()
@@ -0,0 +1,124 @@
+"""Record level compression for the sinks and sources.
+
+Compressed records are framed with a two byte header: a magic byte and
+the codec id. Sources can therefore decompress every record without any
+configuration, and uncompressed records (and records written before
+compression was enabled) pass through unchanged. Neither raw records
+(avro, thrift or a format prefix) nor JSON records start with the magic byte.
+"""
+import zlib
+
+from typing import Any, Callable, List, Optional
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - optional dependency
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:  # pragma: no cover - optional dependency
+    lz4_frame = None
+
+
+FRAME_MAGIC = 0xDC
+CODEC_IDS = {"zlib": 1, "zstd": 2, "lz4": 3}
+CODEC_NAMES = {v: k for k, v in CODEC_IDS.items()}
+DEFAULT_LEVELS = {"zlib": 6, "zstd": 3, "lz4": 0}
+
+
+class CompressionError(ValueError):
+    pass
+
+
+def is_available(codec: str) -> bool:
+    if codec == "zlib":
+        return True
+    if codec == "zstd":
+        return zstandard is not None
+    if codec == "lz4":
+        return lz4_frame is not None
+    return False
+
+
+def is_framed(data: bytes) -> bool:
+    return len(data) >= 2 and data[0] == FRAME_MAGIC and data[1] in CODEC_NAMES
+
+
+def _compress_func(codec: str, level: int) -> Callable[[bytes], bytes]:
+    if codec == "zlib":
+        return lambda data: zlib.compress(data, level)
+    if codec == "zstd":
+        compressor = zstandard.ZstdCompressor(level=level)
+        return compressor.compress
+    if codec == "lz4":
+        return lambda data: lz4_frame.compress(data, compression_level=level)
+    raise CompressionError(f"Unknown compression codec {codec}")
+
+
+def _decompress(codec: str, data: bytes) -> bytes:
+    if codec == "zlib":
+        return zlib.decompress(data)
+    if codec == "zstd":
+        if zstandard is None:
+            raise CompressionError("zstd compressed record but zstandard is not installed")
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "lz4":
+        if lz4_frame is None:
+            raise CompressionError("lz4 compressed record but lz4 is not installed")
+        return lz4_frame.decompress(data)
+    raise CompressionError(f"Unknown compression codec {codec}")
+
+
+class Compressor:
+    """Compresses and frames single records.
+
+    Records smaller than `min_size` and records that do not get smaller
+    are passed through unchanged. Already framed records are not
+    compressed again.
+    """
+
+    def __init__(
+        self, codec: str = "zlib", level: Optional[int] = None, min_size: int = 256
+    ):
+        if codec not in CODEC_IDS:
+            raise CompressionError(f"Unknown compression codec {codec}")
+        if not is_available(codec):
+            raise CompressionError(f"Compression codec {codec} is not installed")
+        self.codec = codec
+        self.level = DEFAULT_LEVELS[codec] if level is None else level
+        self.min_size = min_size
+        self.header = bytes((FRAME_MAGIC, CODEC_IDS[codec]))
+        self._compress = _compress_func(codec, self.level)
+
+    def compress(self, data: bytes) -> bytes:
+        if len(data) < self.min_size or is_framed(data):
+            return data
+        compressed = self.header + self._compress(data)
+        if len(compressed) >= len(data):
+            return data
+        return compressed
+
+    def compress_all(self, data: List[bytes]) -> List[bytes]:
+        return [self.compress(d) for d in data]
+
+
+def decompress(data: bytes) -> bytes:
+    """Undo `Compressor.compress`, unframed records are returned as they are."""
+    if not is_framed(data):
+        return data
+    try:
+        return _decompress(CODEC_NAMES[data[1]], data[2:])
+    except CompressionError:
+        raise
+    except Exception as e:
+        raise CompressionError(f"Cannot decompress record: {e}")
+
+
+def get_compressor(config: Any, queue_type: str) -> Optional[Compressor]:
+    """Return the configured compressor for a queue type or None if disabled."""
+    codec = config.get("compression")
+    if not codec or queue_type not in (config.get("compression_queues") or []):
+        return None
+    return Compressor(codec, level=config.get("compression_level"),
+                      min_size=config.get("compression_min_bytes", 256))
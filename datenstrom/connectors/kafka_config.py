@@ -0,0 +1,47 @@
+"""librdkafka settings for the Kafka sinks and sources.
+
+`kafka_producer_config` and `kafka_consumer_config` map a queue type
+("raw", "events", "errors") or "default" to librdkafka properties, the
+queue type specific values override the defaults. Properties that the
+connectors manage themselves are rejected when the settings are loaded.
+"""
+from typing import Any, Dict
+
+from confluent_kafka import KafkaException
+
+from datenstrom.settings import KafkaValue
+
+
+def merge_client_config(config: Dict[str, Dict[str, KafkaValue]],
+                        queue_type: str) -> Dict[str, KafkaValue]:
+    merged = dict(config.get("default") or {})
+    merged.update(config.get(queue_type) or {})
+    return merged
+
+
+def producer_config(config: Any, queue_type: str) -> Dict[str, KafkaValue]:
+    conf = merge_client_config(config.get("kafka_producer_config") or {}, queue_type)
+    conf["bootstrap.servers"] = config.kafka_brokers
+    return conf
+
+
+def consumer_config(config: Any, queue_type: str) -> Dict[str, KafkaValue]:
+    conf = {
+        "group.id": f"datenstrom-{queue_type}",
+        "auto.offset.reset": "earliest",  # TODO: change to latest
+    }
+    conf.update(merge_client_config(config.get("kafka_consumer_config") or {}, queue_type))
+    conf["bootstrap.servers"] = config.kafka_brokers
+    # offsets are committed after the batch is acknowledged
+    conf["enable.auto.commit"] = False
+    return conf
+
+
+def create_client(cls: type, conf: Dict[str, KafkaValue], queue_type: str):
+    """Create a Producer or Consumer, invalid properties fail with a ValueError."""
+    try:
+        return cls(conf)
+    except (KafkaException, TypeError, ValueError) as e:
+        raise ValueError(
+            f"Invalid Kafka {cls.__name__.lower()} config for {queue_type}: {e}"
+        )
@@ -0,0 +1,34 @@
+"""Message keys for the sinks.
+
+Kafka assigns records with the same key to the same partition, keyed
+records let consumers keep per-user state partition local. The keys are
+read from attributes of the objects that are serialized anyway (the raw
+payload in the collector, the atomic event in the enricher).
+"""
+import operator
+
+from typing import Any, Callable, List, Optional
+
+
+# raw payload attributes and atomic event fields that can be used as keys
+RAW_KEY_ATTRIBUTES = ("networkUserId", "ipAddress", "hostname")
+EVENT_KEY_ATTRIBUTES = ("domain_userid", "network_userid", "user_id", "app_id")
+# network user id of all anonymous requests, keying by it would put them on one partition
+ANONYMOUS_USER_ID = "00000000-0000-0000-0000-000000000000"
+
+Keys = Optional[List[Optional[bytes]]]
+KeyExtractor = Callable[[Any], Optional[bytes]]
+
+
+def key_extractor(attribute: Optional[str]) -> Optional[KeyExtractor]:
+    """Return a function that reads the key from `attribute`, None if keys are disabled."""
+    if not attribute:
+        return None
+    getter = operator.attrgetter(attribute)
+
+    def extract(obj: Any) -> Optional[bytes]:
+        value = getter(obj)
+        if not value or value == ANONYMOUS_USER_ID:
+            return None
+        return str(value).encode("utf-8")
+    return extract
@@ -1,6 +1,26 @@
-from typing import List, Any
+from typing import Callable, List, Any, Optional, Tuple
 from abc import ABC, abstractmethod
 
+import logging
+
+from datenstrom.connectors.compression import get_compressor
+from datenstrom.connectors.keys import Keys
+
+
+logger = logging.getLogger(__name__)
+
+
+class SinkFullError(Exception):
+    """The sink cannot accept more records right now.
+
+    `written` is the number of leading records the sink did accept.
+    """
+
+    def __init__(self, message: str = "", written: int = 0):
+        super().__init__(message)
+        self.written = written
+
+
 class Sink(ABC):
     """The sink class."""
 
@@ -8,15 +28,50 @@ class Sink(ABC):
         """Initialize."""
         self.config = config
         self.queue_type = self.check_queue_type(queue_type)
+        self.compressor = get_compressor(config, self.queue_type)
+        # receives records that could not be delivered, see `on_failure`
+        self.failure_handler: Optional[Callable[..., None]] = None
 
     def check_queue_type(self, queue_type: str) -> str:
         if queue_type in ("raw", "events", "errors"):
             return queue_type
         raise ValueError(f"Unknown queue type {queue_type} for sink.")
 
+    def compress(self, data: List[bytes]) -> List[bytes]:
+        """Compress the records if compression is enabled for this queue."""
+        if self.compressor is None:
+            return data
+        return self.compressor.compress_all(data)
+
+    def on_failure(self, records: List[bytes], error: Any, keys: Keys = None) -> bool:
+        """Hand undelivered records to the failure handler.
+
+        Returns False if there is no handler and the records are lost.
+        """
+        if self.failure_handler is None:
+            return False
+        try:
+            self.failure_handler(records, error, keys=keys)
+        except Exception as e:
+            logger.error("Failure handler could not take %d records: %s", len(records), e)
+            return False
+        return True
+
+    def backlog(self) -> Tuple[int, int]:
+        """Number of records and bytes accepted but not yet delivered."""
+        return 0, 0
+
+    def is_full(self) -> bool:
+        """True while `write` would raise `SinkFullError`."""
+        return False
+
     @abstractmethod
-    def write(self, data: List[bytes]) -> int:
-        """Write data to the sink."""
+    def write(self, data: List[bytes], keys: Keys = None) -> int:
+        """Write data to the sink.
+
+        `keys` holds an optional message key for every record, sinks
+        without keyed messages ignore them.
+        """
         pass
 
     @abstractmethod
@@ -0,0 +1,215 @@
+import time
+import logging
+import threading
+
+from typing import List, Optional, Tuple
+
+from datenstrom.connectors.sinks.base import Sink, SinkFullError
+from datenstrom.connectors.keys import Keys
+from datenstrom.common.metrics import metrics
+
+
+RETRY_BACKOFF_MAX = 5.0  # seconds between retries of a failed batch
+
+
+logger = logging.getLogger(__name__)
+
+
+class BatchingSink(Sink):
+    """Buffers records and hands them to the wrapped sink in batches.
+
+    `write()` only appends to an in-memory buffer. A background thread
+    flushes the buffer to the wrapped sink as soon as it holds `max_records`
+    records or `max_bytes` bytes, or when the oldest buffered record is
+    older than `linger_ms`. The buffer holds at most `max_buffer_records`
+    records and `max_buffer_bytes` bytes, `write()` raises `SinkFullError`
+    instead of growing it further. It also raises while the wrapped sink
+    reports that it is full.
+
+    Batches the wrapped sink rejects are not dropped. Records that could not
+    be written go to the failure handler of the wrapped sink, or back to the
+    front of the buffer to be retried after a backoff. A sink that stays full
+    therefore fills the buffer and new writes are rejected.
+    """
+
+    def __init__(
+        self,
+        sink: Sink,
+        max_records: int = 500,
+        max_bytes: int = 1_000_000,
+        linger_ms: int = 20,
+        max_buffer_records: int = 100_000,
+        max_buffer_bytes: int = 128 * 1024 * 1024,
+        retry_backoff_ms: int = 100,
+    ):
+        """Initialize."""
+        super().__init__(sink.config, queue_type=sink.queue_type)
+        self.sink = sink
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.linger = linger_ms / 1000.0
+        self.max_buffer_records = max_buffer_records
+        self.max_buffer_bytes = max_buffer_bytes
+        self.retry_backoff = retry_backoff_ms / 1000.0
+
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._buffer: List[bytes] = []
+        self._keys: List[Optional[bytes]] = []
+        self._keyed = False
+        self._buffer_bytes = 0
+        self._deadline = None
+        self._retry_at = 0.0
+        self._retries = 0
+        self._cancelled = False
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=f"batching-sink-{self.queue_type}")
+        self._thread.start()
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of records waiting to be written."""
+        return len(self._buffer)
+
+    @property
+    def queued_bytes(self) -> int:
+        """Number of bytes waiting to be written."""
+        return self._buffer_bytes
+
+    def backlog(self) -> Tuple[int, int]:
+        """Buffered records plus the backlog of the wrapped sink."""
+        records, size = self.sink.backlog()
+        return records + len(self._buffer), size + self._buffer_bytes
+
+    def write(self, data: List[bytes], keys: Keys = None) -> int:
+        """Add data and their keys to the buffer."""
+        if self.sink.is_full():
+            metrics.incr("sink.buffer_full", sink="batch", queue=self.queue_type)
+            raise SinkFullError("Wrapped sink is full")
+        size = 0
+        for d in data:
+            size += len(d)
+        with self._condition:
+            if (len(self._buffer) + len(data) > self.max_buffer_records
+                    or self._buffer_bytes + size > self.max_buffer_bytes):
+                metrics.incr("sink.buffer_full", sink="batch", queue=self.queue_type)
+                raise SinkFullError("Batching buffer is full")
+            was_empty = not self._buffer
+            if was_empty:
+                self._deadline = time.monotonic() + self.linger
+            self._buffer.extend(data)
+            if keys is not None:
+                self._keys.extend(keys)
+                self._keyed = True
+            else:
+                self._keys.extend([None] * len(data))
+            self._buffer_bytes += size
+            if was_empty or self._is_full():
+                # wake the writer to arm the linger timer or to flush
+                self._condition.notify()
+        return size
+
+    def _is_full(self) -> bool:
+        return len(self._buffer) >= self.max_records or self._buffer_bytes >= self.max_bytes
+
+    def _take(self) -> Tuple[List[bytes], Keys]:
+        batch = self._buffer
+        keys = self._keys if self._keyed else None
+        self._buffer = []
+        self._keys = []
+        self._keyed = False
+        self._buffer_bytes = 0
+        self._deadline = None
+        return batch, keys
+
+    def _requeue(self, batch: List[bytes], keys: Keys):
+        """Put records back at the front of the buffer, they may exceed its limits."""
+        with self._condition:
+            self._buffer[:0] = batch
+            if keys is not None:
+                self._keys[:0] = keys
+                self._keyed = True
+            else:
+                self._keys[:0] = [None] * len(batch)
+            self._buffer_bytes += sum(len(d) for d in batch)
+            if self._deadline is None:
+                self._deadline = time.monotonic()
+            backoff = min(self.retry_backoff * 2 ** self._retries, RETRY_BACKOFF_MAX)
+            self._retry_at = time.monotonic() + backoff
+            self._retries += 1
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._cancelled:
+                    now = time.monotonic()
+                    if now < self._retry_at:
+                        self._condition.wait(self._retry_at - now)
+                    elif self._is_full():
+                        break
+                    elif self._buffer:
+                        timeout = self._deadline - now
+                        if timeout <= 0:
+                            break
+                        self._condition.wait(timeout)
+                    else:
+                        self._condition.wait()
+                if self._cancelled:
+                    return
+            self.flush()
+
+    def flush(self, retry: bool = True):
+        """Write all buffered records to the wrapped sink.
+
+        Records the wrapped sink rejects are requeued if `retry` is set,
+        otherwise they are lost unless its failure handler takes them.
+        """
+        # the write lock keeps batches in order between the
+        # background thread and explicit flushes
+        with self._write_lock:
+            with self._condition:
+                batch, keys = self._take()
+            if not batch:
+                return
+            metrics.incr("sink.batches", queue=self.queue_type)
+            try:
+                if keys is not None:
+                    self.sink.write(batch, keys=keys)
+                else:
+                    self.sink.write(batch)
+            except Exception as e:
+                metrics.incr("sink.batch_errors", queue=self.queue_type)
+                # records before `written` are with the wrapped sink already
+                written = getattr(e, "written", 0)
+                batch = batch[written:]
+                if keys is not None:
+                    keys = keys[written:]
+                # a full sink drains by itself, everything else is a delivery failure
+                handle = not retry or not isinstance(e, SinkFullError)
+                if handle and self.sink.on_failure(batch, e, keys=keys):
+                    return
+                if retry:
+                    logger.warning(
+                        "[Batching Sink] Failed to write %d records, retrying: %s",
+                        len(batch),
+                        e,
+                    )
+                    self._requeue(batch, keys)
+                    return
+                metrics.incr(
+                    "sink.undelivered", len(batch), sink="batch", queue=self.queue_type
+                )
+                logger.error(
+                    "[Batching Sink] Failed to write %d records: %s", len(batch), e
+                )
+            else:
+                self._retries = 0
+
+    def close(self):
+        """Flush the buffer and close the wrapped sink."""
+        with self._condition:
+            self._cancelled = True
+            self._condition.notify()
+        self._thread.join()
+        self.flush(retry=False)
+        self.sink.close()
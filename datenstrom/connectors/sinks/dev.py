@@ -1,5 +1,6 @@
 from typing import List,Any
 from datenstrom.connectors.sinks.base import Sink
+from datenstrom.connectors.keys import Keys
 
 
 class DevSink(Sink):
@@ -8,12 +9,15 @@ class DevSink(Sink):
         """Initialize."""
         super().__init__(config, queue_type=queue_type)
         self.last_record = None
+        self.last_key = None
 
-    def write(self, data: List[bytes]) -> int:
+    def write(self, data: List[bytes], keys: Keys = None) -> int:
         """Write data to std out."""
+        data = self.compress(data)
         size = 0
-        for d in data:
+        for i, d in enumerate(data):
             self.last_record = d
+            self.last_key = keys[i] if keys is not None else None
             print(d)
             size += len(d)
         return size
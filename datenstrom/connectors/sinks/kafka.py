@@ -1,16 +1,24 @@
 import os
 import signal
+import logging
 
-from typing import List, Any
+from typing import List, Any, Optional, Tuple
 from datetime import datetime, timezone, timedelta
 from confluent_kafka import Producer
-from threading import Thread
+from threading import Thread, Lock
 
-from datenstrom.connectors.sinks.base import Sink
+from datenstrom.connectors.sinks.base import Sink, SinkFullError
+from datenstrom.connectors.kafka_config import create_client, producer_config
+from datenstrom.connectors.keys import Keys
+from datenstrom.common.metrics import metrics
 
 
 COUNTER_RESET_INTERVAL = timedelta(seconds=60)
 MAX_ERRORS_PER_INTERVAL = 10
+POLL_INTERVAL = 0.1  # seconds the poller thread waits for delivery reports
+
+
+logger = logging.getLogger(__name__)
 
 
 class KafkaSink(Sink):
@@ -38,49 +46,126 @@ class KafkaSink(Sink):
 
         self.counter = dict(ok=0, err=0, last_reset=datetime.now(timezone.utc))
         self._cancelled = False
-        self._producer = Producer({
-            'bootstrap.servers': self.bootstrap_servers
-        })
-        self._thread = Thread(target=self._run)
+        self._inflight_lock = Lock()
+        self._inflight_bytes = 0
+        # delivery reports are aggregated and moved to the metrics after each poll
+        self._delivered = 0
+        self._delivered_bytes = 0
+        self._failed = 0
+        self._latency = 0.0
+        self.close_timeout = config.get("sink_close_timeout", 10.0)
+        self._producer = create_client(
+            Producer, producer_config(config, queue_type), queue_type
+        )
+        # serves the delivery callbacks, without it the local queue fills up
+        self._thread = Thread(
+            target=self._run, daemon=True, name=f"kafka-poller-{queue_type}"
+        )
+        self._thread.start()
 
     def _run(self):
         while not self._cancelled:
-            self._producer.poll(0.1)
+            try:
+                self._producer.poll(POLL_INTERVAL)
+            except Exception as e:
+                logger.error("KafkaSink: poll failed: %s", e)
+            self.report_deliveries()
+
+    def report_deliveries(self):
+        with self._inflight_lock:
+            delivered, self._delivered = self._delivered, 0
+            delivered_bytes, self._delivered_bytes = self._delivered_bytes, 0
+            failed, self._failed = self._failed, 0
+            latency, self._latency = self._latency, 0.0
+        if delivered:
+            metrics.incr("sink.delivered", delivered, sink="kafka", queue=self.queue_type)
+            metrics.incr(
+                "sink.delivered_bytes",
+                delivered_bytes,
+                sink="kafka",
+                queue=self.queue_type,
+            )
+            metrics.incr("sink.delivery_latency_ms", int(latency * 1000), sink="kafka",
+                         queue=self.queue_type)
+        if failed:
+            metrics.incr("sink.errors", failed, sink="kafka", queue=self.queue_type)
 
     def count_ok(self):
         self.counter["ok"] += 1
-        print(f"KafkaSink: {self.counter}")
         # check if counter needs to be reset
         now = datetime.now(timezone.utc)
         if now - self.counter["last_reset"] > COUNTER_RESET_INTERVAL:
-            # print counter
             self.counter["last_reset"] = now
             self.counter["ok"] = 0
             self.counter["err"] = 0
 
     def count_err(self):
         self.counter["err"] += 1
-        # check if we have to many errors
-        if self.counter["err"] > MAX_ERRORS_PER_INTERVAL:
-            print(f"KafkaSink: too many errors, crashing")
+        # check if we have to many errors,
+        # undelivered records are not lost with a failure handler
+        if self.failure_handler is None and self.counter["err"] > MAX_ERRORS_PER_INTERVAL:
+            logger.error("KafkaSink: too many errors, crashing")
             os.kill(os.getpid(), signal.SIGINT)
 
-    def write(self, data: List[bytes]) -> int:
-        """Write data to the development sink."""
+    def backlog(self) -> Tuple[int, int]:
+        # messages in the local producer queue and in flight to the brokers
+        return len(self._producer), self._inflight_bytes
+
+    def _produce(self, d: bytes, key: Optional[bytes] = None):
+        try:
+            self._producer.produce(self.topic, d, key=key, callback=self.ack)
+        except BufferError:
+            # the poller thread makes room, never wait for it on the caller's thread
+            metrics.incr("sink.buffer_full", sink="kafka", queue=self.queue_type)
+            raise SinkFullError("Kafka producer queue is full")
+
+    def write(self, data: List[bytes], keys: Keys = None) -> int:
+        """Write data to Kafka, records with the same key go to the same partition."""
+        data = self.compress(data)
         size = 0
-        for d in data:
-            self._producer.produce(self.topic, d, callback=self.ack)
-            size += len(d)
+        try:
+            for i, d in enumerate(data):
+                # counted before produce, the delivery callback may run right away
+                with self._inflight_lock:
+                    self._inflight_bytes += len(d)
+                try:
+                    self._produce(d, keys[i] if keys is not None else None)
+                except Exception as e:
+                    with self._inflight_lock:
+                        self._inflight_bytes -= len(d)
+                    if isinstance(e, SinkFullError):
+                        e.written = i
+                    raise
+                size += len(d)
+        finally:
+            metrics.incr("sink.records", len(data), sink="kafka", queue=self.queue_type)
+            metrics.incr("sink.bytes", size, sink="kafka", queue=self.queue_type)
         return size
 
     def ack(self, err, msg):
+        size = len(msg.value() or b"")
+        with self._inflight_lock:
+            self._inflight_bytes -= size
+            if err:
+                self._failed += 1
+            else:
+                self._delivered += 1
+                self._delivered_bytes += size
+                self._latency += msg.latency() or 0.0
         if err:
-            print("Failed to deliver message: %s: %s" % (str(msg), str(err)))
+            logger.warning("Failed to deliver message: %s: %s", msg, err)
             self.count_err()
+            self.on_failure([msg.value()], err, keys=[msg.key()])
         else:
             self.count_ok()
 
     def close(self):
-        """Close the sink."""
+        """Deliver the queued messages within close_timeout and close the sink."""
         self._cancelled = True
-        self._thread.join()
+        if self._thread.is_alive():
+            self._thread.join()
+        remaining = self._producer.flush(self.close_timeout)
+        self.report_deliveries()
+        if remaining:
+            metrics.incr("sink.undelivered", remaining, sink="kafka", queue=self.queue_type)
+            logger.error("KafkaSink: %d messages not delivered on close", remaining)
@@ -0,0 +1,327 @@
+import os
+import time
+import zlib
+import fcntl
+import struct
+import logging
+import threading
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from datenstrom.connectors.sinks.base import Sink, SinkFullError
+from datenstrom.connectors.keys import Keys
+from datenstrom.common.metrics import metrics
+
+
+# every record is prefixed with its length, the length of its key and
+# the crc32 of key and record
+RECORD_HEADER = struct.Struct(">III")
+SEGMENT_PREFIX = "spill-"
+SEGMENT_SUFFIX = ".log"
+
+
+logger = logging.getLogger(__name__)
+
+
+class SpillLogLocked(Exception):
+    """The spill directory is used by another process."""
+    pass
+
+
+class SpillLog:
+    """Append-only local log for records that could not be delivered.
+
+    Records are appended to the active segment file, a new segment is
+    started once the active one is larger than `segment_bytes`. Appends
+    are rejected when the log would grow beyond `max_bytes`. Segments are
+    read back oldest first and deleted once they have been replayed.
+    Segments left behind by a previous process are picked up on start.
+    The directory is locked, a second process cannot open it and gets
+    `SpillLogLocked`.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 64 * 1024 * 1024,
+                 max_bytes: int = 1024 * 1024 * 1024, fsync: bool = False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+        # released when the process exits, even if it crashes
+        self._dir_fd = os.open(directory, os.O_RDONLY)
+        try:
+            fcntl.flock(self._dir_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(self._dir_fd)
+            raise SpillLogLocked(f"Spill directory {directory} is used by another process")
+
+        self._lock = threading.Lock()
+        self._sizes: Dict[int, int] = {}
+        for name in os.listdir(directory):
+            if not name.startswith(SEGMENT_PREFIX) or not name.endswith(SEGMENT_SUFFIX):
+                continue
+            try:
+                seq = int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+            except ValueError:
+                logger.warning(
+                    "ignoring unknown file %s in spill directory %s", name, directory
+                )
+                continue
+            self._sizes[seq] = os.path.getsize(self._path(seq))
+        self._next_seq = max(self._sizes, default=0) + 1
+        self._active = None
+        self._active_seq: Optional[int] = None
+        if self._sizes:
+            logger.info("found %d spill segments with %d bytes in %s",
+                        len(self._sizes), self.size, directory)
+
+    def _path(self, seq: int) -> str:
+        return os.path.join(self.directory, f"{SEGMENT_PREFIX}{seq:012d}{SEGMENT_SUFFIX}")
+
+    @property
+    def size(self) -> int:
+        """Bytes on disk."""
+        return sum(self._sizes.values())
+
+    def is_empty(self) -> bool:
+        return self.size == 0
+
+    def is_full(self) -> bool:
+        return self.size >= self.max_bytes
+
+    def append(self, records: List[bytes], keys: Keys = None) -> bool:
+        """Append records and their keys, returns False if the log is full."""
+        parts = []
+        for i, r in enumerate(records):
+            key = (keys[i] if keys is not None else None) or b""
+            parts.append(
+                RECORD_HEADER.pack(len(r), len(key), zlib.crc32(r, zlib.crc32(key)))
+            )
+            parts.append(key)
+            parts.append(r)
+        buf = b"".join(parts)
+        with self._lock:
+            if self.size + len(buf) > self.max_bytes:
+                return False
+            if (
+                self._active is not None
+                and self._sizes[self._active_seq] >= self.segment_bytes
+            ):
+                self._close_active()
+            if self._active is None:
+                self._active_seq = self._next_seq
+                self._next_seq += 1
+                self._active = open(self._path(self._active_seq), "ab")
+                self._sizes[self._active_seq] = 0
+            self._active.write(buf)
+            self._active.flush()
+            if self.fsync:
+                os.fsync(self._active.fileno())
+            self._sizes[self._active_seq] += len(buf)
+        return True
+
+    def _close_active(self):
+        if self._active is not None:
+            self._active.close()
+            self._active = None
+            self._active_seq = None
+
+    def rotate(self):
+        """Close the active segment so that it can be replayed."""
+        with self._lock:
+            self._close_active()
+
+    def segments(self) -> List[int]:
+        """Closed segments, oldest first."""
+        with self._lock:
+            return sorted(seq for seq in self._sizes if seq != self._active_seq)
+
+    def read(
+        self, seq: int, offset: int = 0
+    ) -> Iterator[Tuple[bytes, Optional[bytes], int]]:
+        """Yield the records of a segment with their key and the offset after each record.
+
+        Reading stops at the first truncated or corrupt record, the rest of
+        the segment cannot be trusted.
+        """
+        with open(self._path(seq), "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if not header:
+                    return
+                if len(header) < RECORD_HEADER.size:
+                    self._corrupt(seq, offset, "truncated header")
+                    return
+                length, key_length, crc = RECORD_HEADER.unpack(header)
+                key = f.read(key_length)
+                data = f.read(length)
+                if len(key) < key_length or len(data) < length:
+                    self._corrupt(seq, offset, "truncated record")
+                    return
+                if zlib.crc32(data, zlib.crc32(key)) != crc:
+                    self._corrupt(seq, offset, "checksum mismatch")
+                    return
+                offset += RECORD_HEADER.size + key_length + length
+                yield data, key or None, offset
+
+    def _corrupt(self, seq: int, offset: int, reason: str):
+        metrics.incr("spill.corrupt")
+        logger.error("spill segment %d is corrupt at offset %d: %s", seq, offset, reason)
+
+    def remove(self, seq: int):
+        with self._lock:
+            if seq == self._active_seq:
+                raise ValueError("Cannot remove the active segment")
+            os.remove(self._path(seq))
+            self._sizes.pop(seq, None)
+
+    def close(self):
+        self.rotate()
+        if self._dir_fd is not None:
+            os.close(self._dir_fd)
+            self._dir_fd = None
+
+
+class SpillingSink(Sink):
+    """Writes to the wrapped sink and spills records to a local log on failures.
+
+    Records go to the spill log when the wrapped sink raises or reports
+    undelivered records through its failure handler. The sink is then
+    considered unhealthy for `retry_interval` seconds. A background thread
+    replays the log in batches of `batch_records` once the sink is healthy
+    again. If the spill log is full, writes raise `SinkFullError`.
+    """
+
+    def __init__(self, sink: Sink, log: SpillLog, batch_records: int = 1000,
+                 retry_interval: float = 5.0):
+        """Initialize."""
+        super().__init__(sink.config, queue_type=sink.queue_type)
+        self.sink = sink
+        self.log = log
+        self.batch_records = batch_records
+        self.retry_interval = retry_interval
+        # records the wrapped sink could not deliver are spilled as well
+        sink.failure_handler = self.spill
+
+        self._retry_at = 0.0
+        self._offsets: Dict[int, int] = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=f"spill-replayer-{self.queue_type}")
+        self._thread.start()
+
+    @property
+    def healthy(self) -> bool:
+        return time.monotonic() >= self._retry_at
+
+    def _mark_unhealthy(self, error: Any):
+        if self.healthy:
+            logger.warning("[Spilling Sink] sink unhealthy, spilling records: %s", error)
+        self._retry_at = time.monotonic() + self.retry_interval
+
+    def backlog(self) -> Tuple[int, int]:
+        records, size = self.sink.backlog()
+        if self.log.is_full():
+            # no room left on disk - let admission control reject
+            size += self.log.size
+        return records, size
+
+    def is_full(self) -> bool:
+        # while the sink is unhealthy every write goes to the log
+        return not self.healthy and self.log.is_full()
+
+    def spill(self, records: List[bytes], error: Any = None, keys: Keys = None):
+        """Append records to the spill log."""
+        if error is not None:
+            self._mark_unhealthy(error)
+        if not self.log.append(records, keys=keys):
+            metrics.incr("spill.dropped", len(records), queue=self.queue_type)
+            raise SinkFullError("Spill log is full")
+        metrics.incr("spill.records", len(records), queue=self.queue_type)
+
+    def write(self, data: List[bytes], keys: Keys = None) -> int:
+        """Write to the wrapped sink or to the spill log if it is unhealthy."""
+        size = sum(len(d) for d in data)
+        if self.healthy:
+            try:
+                self._write(data, keys)
+                return size
+            except Exception as e:
+                # records before `written` are with the wrapped sink already
+                written = getattr(e, "written", 0)
+                self.spill(
+                    data[written:], e, keys=keys[written:] if keys is not None else None
+                )
+                return size
+        self.spill(data, keys=keys)
+        return size
+
+    def _write(self, data: List[bytes], keys: Keys):
+        if keys is not None:
+            self.sink.write(data, keys=keys)
+        else:
+            self.sink.write(data)
+
+    def _run(self):
+        while not self._stopped.wait(min(1.0, self.retry_interval)):
+            if self.healthy and not self.log.is_empty():
+                self.replay()
+
+    def replay(self) -> int:
+        """Replay spilled records to the wrapped sink, returns the number of records."""
+        replayed = 0
+        self.log.rotate()
+        for seq in self.log.segments():
+            batch = []
+            keys = []
+            offsets = []
+            for record, key, next_offset in self.log.read(seq, self._offsets.get(seq, 0)):
+                batch.append(record)
+                keys.append(key)
+                offsets.append(next_offset)
+                if len(batch) >= self.batch_records:
+                    written = self._replay_batch(seq, batch, keys, offsets)
+                    replayed += written
+                    if written < len(batch):
+                        return replayed
+                    batch = []
+                    keys = []
+                    offsets = []
+            if batch:
+                written = self._replay_batch(seq, batch, keys, offsets)
+                replayed += written
+                if written < len(batch):
+                    return replayed
+            self.log.remove(seq)
+            self._offsets.pop(seq, None)
+            if not self.healthy or self._stopped.is_set():
+                break
+        if replayed:
+            logger.info("[Spilling Sink] replayed %d records", replayed)
+        return replayed
+
+    def _replay_batch(self, seq: int, batch: List[bytes], keys: List[Optional[bytes]],
+                      offsets: List[int]) -> int:
+        """Write a batch read from segment `seq`, returns the number of records written.
+
+        The read offset of the segment moves past the written records, so
+        that they are not replayed again.
+        """
+        try:
+            self._write(batch, keys if any(k is not None for k in keys) else None)
+            written = len(batch)
+        except Exception as e:
+            self._mark_unhealthy(e)
+            written = getattr(e, "written", 0)
+        if written:
+            self._offsets[seq] = offsets[written - 1]
+            metrics.incr("spill.replayed", written, queue=self.queue_type)
+        return written
+
+    def close(self):
+        """Stop the replayer and close the wrapped sink, spilled records stay on disk."""
+        self._stopped.set()
+        self._thread.join()
+        self.log.close()
+        self.sink.close()
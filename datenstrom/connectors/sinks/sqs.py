@@ -1,21 +1,28 @@
 import os
 import signal
 import base64
+import logging
 
-from typing import List, Any
+from typing import List, Any, Tuple
 from datetime import datetime, timezone, timedelta
 import boto3
 import threading
 from concurrent.futures import ThreadPoolExecutor
 
 from datenstrom.connectors.sinks.base import Sink
+from datenstrom.connectors.compression import is_framed
+from datenstrom.connectors.keys import Keys
+from datenstrom.common.metrics import metrics
 
 
 COUNTER_RESET_INTERVAL = timedelta(seconds=60)
 MAX_ERRORS_PER_INTERVAL = 10
+MAX_BATCH_ENTRIES = 10  # SQS limit for SendMessageBatch
+MAX_BATCH_BYTES = 256 * 1024  # SQS limit for the total batch payload
 
 
 boto3_client_lock = threading.Lock()
+logger = logging.getLogger(__name__)
 
 
 class SQSSink(Sink):
@@ -50,57 +57,140 @@ class SQSSink(Sink):
         # })
         # self._thread = Thread(target=self._run)
         self._executor = ThreadPoolExecutor(max_workers=10)
+        # records and bytes submitted to the executor but not sent yet
+        self._inflight_lock = threading.Lock()
+        self._inflight_records = 0
+        self._inflight_bytes = 0
 
     # def _run(self):
     #     while not self._cancelled:
     #         self._producer.poll(0.1)
 
-    def count_ok(self):
-        self.counter["ok"] += 1
+    def count_ok(self, n: int = 1):
+        self.counter["ok"] += n
+        metrics.incr("sink.delivered", n, sink="sqs", queue=self.queue_type)
         # check if counter needs to be reset
         now = datetime.now(timezone.utc)
         if now - self.counter["last_reset"] > COUNTER_RESET_INTERVAL:
-            print(f"[SQS Sink]: {self.counter}")
-            # print counter
             self.counter["last_reset"] = now
             self.counter["ok"] = 0
             self.counter["err"] = 0
 
     def count_err(self):
         self.counter["err"] += 1
-        # check if we have to many errors
-        if self.counter["err"] > MAX_ERRORS_PER_INTERVAL:
-            print(f"[SQS Sink]: too many errors, crashing")
+        metrics.incr("sink.errors", sink="sqs", queue=self.queue_type)
+        # check if we have to many errors,
+        # undelivered records are not lost with a failure handler
+        if self.failure_handler is None and self.counter["err"] > MAX_ERRORS_PER_INTERVAL:
+            logger.error("[SQS Sink]: too many errors, crashing")
             os.kill(os.getpid(), signal.SIGINT)
 
-    def _send(self, message: bytes) -> str:
-        if self.queue_type == "raw":
-            body = base64.b64encode(message).decode("utf-8")
-        else:
-            body = message.decode("utf-8")
+    def _is_binary(self, message: bytes) -> bool:
+        # raw and compressed records are not valid message bodies
+        return self.queue_type == "raw" or is_framed(message)
 
+    def _encode(self, message: bytes) -> str:
+        if self._is_binary(message):
+            return base64.b64encode(message).decode("utf-8")
+        return message.decode("utf-8")
+
+    def _send(self, message: bytes) -> str:
         resp = self.sqs.send_message(
             QueueUrl=self.queue_url,
-            MessageBody=body,
+            MessageBody=self._encode(message),
         )
         return resp["MessageId"]
 
-    def write(self, data: List[bytes]) -> int:
-        """Write data to the development sink."""
-        size = 0
+    def _send_batch(self, messages: List[bytes]) -> int:
+        entries = [
+            {"Id": str(i), "MessageBody": self._encode(m)}
+            for i, m in enumerate(messages)
+        ]
+        resp = self.sqs.send_message_batch(
+            QueueUrl=self.queue_url,
+            Entries=entries,
+        )
+        failed = resp.get("Failed", [])
+        for f in failed:
+            logger.warning(
+                "[SQS Sink] Failed to send message: %s %s",
+                f.get("Code"),
+                f.get("Message"),
+            )
+            self.count_err()
+        if failed:
+            self.on_failure([messages[int(f["Id"])] for f in failed], failed[0].get("Code"))
+        return len(resp.get("Successful", []))
+
+    def _batches(self, data: List[bytes]) -> List[List[bytes]]:
+        batches = []
+        current = []
+        current_size = 0
         for d in data:
-            result_future = self._executor.submit(self._send, d)
-            result_future.add_done_callback(self.on_result)
-            size += len(d)
+            # base64 inflates binary records by 4/3
+            size = (len(d) + 2) // 3 * 4 if self._is_binary(d) else len(d)
+            if current and (len(current) >= MAX_BATCH_ENTRIES or
+                            current_size + size > MAX_BATCH_BYTES):
+                batches.append(current)
+                current = []
+                current_size = 0
+            current.append(d)
+            current_size += size
+        if current:
+            batches.append(current)
+        return batches
+
+    def backlog(self) -> Tuple[int, int]:
+        return self._inflight_records, self._inflight_bytes
+
+    def _track(self, records: int, size: int):
+        with self._inflight_lock:
+            self._inflight_records += records
+            self._inflight_bytes += size
+
+    def _submit(self, fn, arg, callback, records: int, size: int):
+        self._track(records, size)
+        future = self._executor.submit(fn, arg)
+        future.add_done_callback(lambda f: self._track(-records, -size))
+        future.add_done_callback(lambda f: callback(f, arg))
+
+    def write(self, data: List[bytes], keys: Keys = None) -> int:
+        """Write data to SQS, message keys are ignored."""
+        data = self.compress(data)
+        size = 0
+        if len(data) == 1:
+            size = len(data[0])
+            self._submit(self._send, data[0], self.on_result, 1, size)
+        else:
+            for batch in self._batches(data):
+                batch_size = sum(len(d) for d in batch)
+                self._submit(
+                    self._send_batch, batch, self.on_batch_result, len(batch), batch_size
+                )
+                size += batch_size
+        metrics.incr("sink.records", len(data), sink="sqs", queue=self.queue_type)
+        metrics.incr("sink.bytes", size, sink="sqs", queue=self.queue_type)
         return size
 
-    def on_result(self, future):
+    def on_batch_result(self, future, batch: List[bytes]):
+        try:
+            sent = future.result()
+        except Exception as exc:
+            logger.warning("[SQS Sink] Error: %s", exc)
+            self.count_err()
+            if not self.on_failure(batch, exc):
+                raise exc
+        else:
+            self.count_ok(sent)
+
+    def on_result(self, future, message: bytes):
         try:
             result = future.result()
         except Exception as exc:
-            print(f"[SQS Sink] Error: {exc}")
+            logger.warning("[SQS Sink] Error: %s", exc)
             self.count_err()
-            raise exc
+            if not self.on_failure([message], exc):
+                raise exc
         else:
             self.count_ok()
 
@@ -28,4 +28,8 @@ class Source(ABC):
     @abstractmethod
     def read(self) -> List[Message]:
         """Read data from the source."""
-        pass
\ No newline at end of file
+        pass
+
+    def close(self):
+        """Close the source."""
+        pass
@@ -5,6 +5,9 @@ from typing import List, Any
 from confluent_kafka import Consumer
 from confluent_kafka import Message as ConfluentMessage
 from datenstrom.connectors.sources.base import Source, Message
+from datenstrom.connectors.compression import decompress
+from datenstrom.connectors.kafka_config import create_client, consumer_config
+from datenstrom.common.metrics import metrics
 
 
 class KafkaMessage(Message):
@@ -14,7 +17,7 @@ class KafkaMessage(Message):
         self.is_acknowledged = False
 
     def data(self):
-        return self.message.value()
+        return decompress(self.message.value())
 
     def ack(self):
         self.is_acknowledged = True
@@ -38,12 +41,8 @@ class KafkaSource(Source):
             raise ValueError("Missing Kafka brokers")
         self.bootstrap_servers = config.kafka_brokers
 
-        self.consumer = Consumer({
-            'bootstrap.servers': self.bootstrap_servers,
-            'group.id': f"datenstrom-{self.queue_type}",
-            'auto.offset.reset': 'earliest',  # TODO: change to latest
-            'enable.auto.commit': False,
-        })
+        self.consumer = create_client(Consumer, consumer_config(config, self.queue_type),
+                                      self.queue_type)
         self.consumer.subscribe([self.topic])
         self.last_batch = []
 
@@ -63,4 +62,18 @@ class KafkaSource(Source):
 
         messages = self.consumer.consume(num_messages=10, timeout=1)
         self.last_batch = [KafkaMessage(message, queue_type=self.queue_type) for message in messages]
+        if self.last_batch:
+            metrics.incr(
+                "source.messages",
+                len(self.last_batch),
+                source="kafka",
+                queue=self.queue_type,
+            )
         return self.last_batch
+
+    def close(self):
+        """Commit the acknowledged last batch and leave the consumer group."""
+        if self.last_batch and all(m.is_acknowledged for m in self.last_batch):
+            self.consumer.commit(asynchronous=False)
+        self.last_batch = []
+        self.consumer.close()
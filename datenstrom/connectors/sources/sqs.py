@@ -4,6 +4,8 @@ import boto3
 from typing import List, Any
 
 from datenstrom.connectors.sources.base import Source, Message
+from datenstrom.connectors.compression import decompress
+from datenstrom.common.metrics import metrics
 
 
 class SQSMessage(Message):
@@ -12,9 +14,11 @@ class SQSMessage(Message):
         self.queue_type = queue_type
 
     def data(self):
-        if self.queue_type == "raw":
-            return base64.b64decode(self.message.body)
-        return self.message.body.encode("utf-8")
+        body = self.message.body
+        # JSON records are sent as they are, everything else is base64 encoded
+        if self.queue_type == "raw" or not body.startswith(("{", "[")):
+            return decompress(base64.b64decode(body))
+        return body.encode("utf-8")
 
     def ack(self):
         self.message.delete()
@@ -40,4 +44,8 @@ class SQSSource(Source):
             MaxNumberOfMessages=10,
             WaitTimeSeconds=1,
         )
+        if messages:
+            metrics.incr(
+                "source.messages", len(messages), source="sqs", queue=self.queue_type
+            )
         return [SQSMessage(message, queue_type=self.queue_type) for message in messages]
@@ -0,0 +1,164 @@
+import time
+import pytest
+
+from typing import List
+
+from datenstrom.settings import get_test_settings
+from datenstrom.connectors.sinks.base import Sink, SinkFullError
+from datenstrom.connectors.sinks.batch import BatchingSink
+
+
+class RecordingSink(Sink):
+    def __init__(self):
+        super().__init__(get_test_settings(), queue_type="raw")
+        self.batches = []
+        self.closed = False
+
+    def write(self, data: List[bytes]) -> int:
+        self.batches.append(list(data))
+        return sum(len(d) for d in data)
+
+    def close(self):
+        self.closed = True
+
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.005)
+    return False
+
+
+def test_flush_on_count():
+    sink = RecordingSink()
+    batcher = BatchingSink(sink, max_records=3, linger_ms=10_000)
+    for i in range(3):
+        assert batcher.write([b"x%d" % i]) == 2
+    assert wait_for(lambda: len(sink.batches) == 1)
+    assert sink.batches[0] == [b"x0", b"x1", b"x2"]
+    assert batcher.queue_depth == 0
+    batcher.close()
+
+
+def test_flush_on_bytes():
+    sink = RecordingSink()
+    batcher = BatchingSink(sink, max_bytes=10, linger_ms=10_000)
+    batcher.write([b"12345"])
+    assert batcher.queue_depth == 1
+    assert batcher.queued_bytes == 5
+    batcher.write([b"67890"])
+    assert wait_for(lambda: len(sink.batches) == 1)
+    batcher.close()
+
+
+def test_flush_on_linger():
+    sink = RecordingSink()
+    batcher = BatchingSink(sink, linger_ms=10)
+    batcher.write([b"a"])
+    assert wait_for(lambda: sink.batches == [[b"a"]])
+    batcher.close()
+
+
+def test_close_flushes():
+    sink = RecordingSink()
+    batcher = BatchingSink(sink, linger_ms=10_000)
+    batcher.write([b"a", b"b"])
+    batcher.close()
+    assert sink.batches == [[b"a", b"b"]]
+    assert sink.closed
+
+
+def test_backlog():
+    inner = RecordingSink()
+    sink = BatchingSink(inner, max_records=100, max_bytes=10_000, linger_ms=10_000)
+    sink.write([b"abc", b"de"])
+    assert sink.backlog() == (2, 5)
+    sink.flush()
+    assert sink.backlog() == (0, 0)
+    sink.close()
+
+
+def test_keys():
+    sink = RecordingSink()
+    written = []
+    sink.write = lambda data, keys=None: written.append(keys) or 0
+    batcher = BatchingSink(sink, linger_ms=10_000)
+    batcher.write([b"a"])
+    batcher.write([b"b", b"c"], keys=[b"k1", b"k2"])
+    batcher.flush()
+    assert written == [[None, b"k1", b"k2"]]
+    batcher.close()
+
+
+def test_buffer_limit():
+    sink = RecordingSink()
+    batcher = BatchingSink(
+        sink, linger_ms=10_000, max_buffer_records=3, max_buffer_bytes=100
+    )
+    batcher.write([b"a", b"b"])
+    with pytest.raises(SinkFullError):
+        batcher.write([b"c", b"d"])
+    with pytest.raises(SinkFullError):
+        batcher.write([b"x" * 100])
+    batcher.write([b"c"])
+    assert batcher.queue_depth == 3
+    batcher.close()
+    assert sink.batches == [[b"a", b"b", b"c"]]
+
+
+class FullSink(RecordingSink):
+    """Accepts one record and then raises `SinkFullError` `failures` times."""
+
+    def __init__(self, failures: int = 1):
+        super().__init__()
+        self.failures = failures
+
+    def write(self, data: List[bytes]) -> int:
+        if self.failures:
+            self.failures -= 1
+            self.batches.append(list(data[:1]))
+            raise SinkFullError("full", written=1)
+        return super().write(data)
+
+
+def test_retry_when_full():
+    sink = FullSink()
+    batcher = BatchingSink(sink, linger_ms=10_000, retry_backoff_ms=10)
+    batcher.write([b"a", b"b", b"c"])
+    batcher.flush()
+    # the rest of the batch waits at the front of the buffer
+    assert batcher.queue_depth == 2
+    batcher.write([b"d"])
+    assert wait_for(lambda: len(sink.batches) == 2)
+    assert sink.batches == [[b"a"], [b"b", b"c", b"d"]]
+    batcher.close()
+
+
+def test_full_sink_fills_buffer():
+    sink = FullSink(failures=1000)
+    batcher = BatchingSink(sink, linger_ms=10_000, max_buffer_records=3,
+                           retry_backoff_ms=10_000)
+    batcher.write([b"a", b"b", b"c"])
+    batcher.flush()
+    batcher.write([b"d"])
+    with pytest.raises(SinkFullError):
+        batcher.write([b"e"])
+    batcher.close()
+
+
+def test_failure_handler():
+    sink = RecordingSink()
+    failed = []
+
+    def write(data):
+        raise ValueError("broken")
+    sink.write = write
+    sink.failure_handler = lambda records, error, keys=None: failed.append(records)
+    batcher = BatchingSink(sink, linger_ms=10_000)
+    batcher.write([b"a", b"b"])
+    batcher.flush()
+    assert failed == [[b"a", b"b"]]
+    assert batcher.queue_depth == 0
+    batcher.close()
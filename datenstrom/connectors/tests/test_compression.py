@@ -0,0 +1,77 @@
+import base64
+import orjson
+import pytest
+
+from datenstrom.settings import get_test_settings
+from datenstrom.connectors.compression import (
+    Compressor, CompressionError, decompress, get_compressor, is_available, is_framed,
+)
+from datenstrom.connectors.sinks.dev import DevSink
+from datenstrom.connectors.sources.sqs import SQSMessage
+
+
+RECORD = orjson.dumps({"schema": "iglu:com.acme/event/jsonschema/1-0-0",
+                       "data": [{"e": "pv", "url": "https://example.com/"}] * 50})
+
+
+@pytest.mark.parametrize("codec", ["zlib", "zstd", "lz4"])
+def test_roundtrip(codec):
+    if not is_available(codec):
+        with pytest.raises(CompressionError):
+            Compressor(codec)
+        return
+    c = Compressor(codec)
+    compressed = c.compress(RECORD)
+    assert is_framed(compressed)
+    assert len(compressed) < len(RECORD)
+    assert decompress(compressed) == RECORD
+    # framed records are not compressed again
+    assert c.compress(compressed) == compressed
+
+
+def test_passthrough():
+    c = Compressor("zlib", min_size=64)
+    assert c.compress(b"short") == b"short"
+    incompressible = bytes(range(256))
+    assert c.compress(incompressible) == incompressible
+    assert decompress(RECORD) == RECORD
+    assert decompress(b"") == b""
+
+
+def test_corrupt_frame():
+    with pytest.raises(CompressionError):
+        decompress(b"\xdc\x01not zlib")
+
+
+def test_get_compressor():
+    config = get_test_settings()
+    assert get_compressor(config, "raw") is None
+    config = config.model_copy(
+        update={"compression": "zlib", "compression_queues": ["events"]}
+    )
+    assert get_compressor(config, "raw") is None
+    assert get_compressor(config, "events").codec == "zlib"
+
+
+def test_sink_compresses():
+    config = get_test_settings().model_copy(update={"compression": "zlib"})
+    sink = DevSink(config=config, queue_type="events")
+    size = sink.write([RECORD])
+    assert size == len(sink.last_record) < len(RECORD)
+    assert decompress(sink.last_record) == RECORD
+
+
+class FakeSQSMessage:
+    def __init__(self, body: str):
+        self.body = body
+
+
+def test_sqs_message_decompresses():
+    compressed = Compressor("zlib").compress(RECORD)
+    body = base64.b64encode(compressed).decode("utf-8")
+    assert SQSMessage(FakeSQSMessage(body), queue_type="events").data() == RECORD
+    assert SQSMessage(FakeSQSMessage(body), queue_type="raw").data() == RECORD
+    assert (
+        SQSMessage(FakeSQSMessage(RECORD.decode("utf-8")), queue_type="events").data()
+        == RECORD
+    )
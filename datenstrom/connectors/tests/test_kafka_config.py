@@ -0,0 +1,53 @@
+import pytest
+
+from confluent_kafka import Producer
+from pydantic import ValidationError
+
+from datenstrom.settings import get_test_settings, BaseConfig
+from datenstrom.connectors.kafka_config import (
+    producer_config,
+    consumer_config,
+    create_client,
+)
+
+
+def make_config(**kwargs):
+    return BaseConfig(transport="kafka", kafka_brokers="localhost:9092", **kwargs)
+
+
+def test_producer_config():
+    config = make_config(kafka_producer_config={
+        "default": {"linger.ms": 20, "compression.type": "lz4", "enable.idempotence": True},
+        "raw": {"linger.ms": 5, "acks": "all"},
+    })
+    assert producer_config(config, "raw") == {
+        "linger.ms": 5, "compression.type": "lz4", "enable.idempotence": True,
+        "acks": "all", "bootstrap.servers": "localhost:9092",
+    }
+    assert producer_config(config, "events")["linger.ms"] == 20
+    assert list(producer_config(get_test_settings(), "raw")) == ["bootstrap.servers"]
+
+
+def test_consumer_config():
+    config = make_config(kafka_consumer_config={"events": {"fetch.min.bytes": 1024,
+                                                           "group.id": "enricher"}})
+    conf = consumer_config(config, "events")
+    assert conf["group.id"] == "enricher"
+    assert conf["fetch.min.bytes"] == 1024
+    assert conf["enable.auto.commit"] is False
+    assert consumer_config(config, "raw")["group.id"] == "datenstrom-raw"
+
+
+def test_validation():
+    with pytest.raises(ValidationError):
+        make_config(kafka_producer_config={"default": {"bootstrap.servers": "other:9092"}})
+    with pytest.raises(ValidationError):
+        make_config(kafka_consumer_config={"raw": {"enable.auto.commit": True}})
+    with pytest.raises(ValidationError):
+        make_config(kafka_producer_config={"clicks": {"acks": "all"}})
+    with pytest.raises(ValueError):
+        create_client(
+            Producer,
+            {"bootstrap.servers": "localhost:9092", "no.such.property": 1},
+            "raw",
+        )
@@ -0,0 +1,95 @@
+import pytest
+
+from datenstrom.settings import get_test_settings
+from datenstrom.connectors.sinks.base import SinkFullError
+from datenstrom.connectors.sinks.kafka import KafkaSink
+from datenstrom.common.metrics import metrics
+
+
+class FakeMessage:
+    def __init__(self, value: bytes, key: bytes = None):
+        self._value = value
+        self._key = key
+
+    def value(self):
+        return self._value
+
+    def key(self):
+        return self._key
+
+    def latency(self):
+        return 0.005
+
+
+class FakeProducer:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.queue = []
+        self.polls = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def produce(self, topic, value, key=None, callback=None):
+        if len(self.queue) >= self.capacity:
+            raise BufferError("Local: Queue full")
+        self.queue.append((value, key, callback))
+
+    def poll(self, timeout=None):
+        self.polls += 1
+        return 0
+
+    def flush(self, timeout=None):
+        self.deliver_all()
+        return len(self.queue)
+
+    def deliver_all(self):
+        for value, key, callback in self.queue:
+            callback(None, FakeMessage(value, key))
+        self.queue = []
+
+
+@pytest.fixture
+def sink():
+    config = get_test_settings().model_copy(update={"kafka_brokers": "localhost:9092",
+                                                    "kafka_topic_raw": "raw"})
+    sink = KafkaSink(config=config, queue_type="raw")
+    sink._producer = FakeProducer(capacity=2)
+    yield sink
+    # stop the poller, it would report deliveries into the next test
+    sink.close()
+
+
+def test_backlog(sink):
+    sink.write([b"abc", b"de"])
+    assert sink.backlog() == (2, 5)
+    sink._producer.deliver_all()
+    assert sink.backlog() == (0, 0)
+
+
+def test_buffer_full(sink):
+    sink.write([b"a"])
+    with pytest.raises(SinkFullError) as e:
+        sink.write([b"b", b"c"])
+    # the caller is not blocked, the first record made it into the queue
+    assert e.value.written == 1
+    assert sink.backlog() == (2, 2)
+
+
+def test_poller_and_close(sink):
+    # delivery reports are served in the background
+    assert sink._thread.is_alive()
+    metrics.snapshot()
+    sink.write([b"abc"])
+    sink.close()
+    assert not sink._thread.is_alive()
+    assert sink.backlog() == (0, 0)
+    snapshot = metrics.snapshot()
+    assert snapshot["sink.delivered{queue=raw,sink=kafka}"] == 1
+    assert snapshot["sink.delivered_bytes{queue=raw,sink=kafka}"] == 3
+    assert snapshot["sink.delivery_latency_ms{queue=raw,sink=kafka}"] == 5
+
+
+def test_keys(sink):
+    sink.write([b"a", b"b"], keys=[b"user-1", None])
+    assert [key for _, key, _ in sink._producer.queue] == [b"user-1", None]
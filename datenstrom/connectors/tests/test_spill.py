@@ -0,0 +1,207 @@
+import os
+import time
+
+import pytest
+
+from typing import List
+
+from datenstrom.settings import get_test_settings
+from datenstrom.connectors.sinks.base import Sink, SinkFullError
+from datenstrom.connectors.sinks.spill import SpillLog, SpillLogLocked, SpillingSink
+from datenstrom.connectors.sinks.batch import BatchingSink
+
+
+class FlakySink(Sink):
+    def __init__(self):
+        super().__init__(get_test_settings(), queue_type="raw")
+        self.records = []
+        self.batches = 0
+        self.down = False
+
+    def write(self, data: List[bytes]) -> int:
+        if self.down:
+            raise ConnectionError("broker unavailable")
+        self.batches += 1
+        self.records.extend(data)
+        return sum(len(d) for d in data)
+
+    def close(self):
+        pass
+
+
+def wait_for(predicate, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+def test_log_roundtrip_and_rotation(tmp_path):
+    log = SpillLog(str(tmp_path), segment_bytes=30)
+    for i in range(10):
+        assert log.append([b"record-%d" % i])
+    log.rotate()
+    segments = log.segments()
+    assert len(segments) > 1
+    records = [r for seq in segments for r, _, _ in log.read(seq)]
+    assert records == [b"record-%d" % i for i in range(10)]
+
+    # segments are picked up again after a restart
+    log.close()
+    log = SpillLog(str(tmp_path))
+    assert log.segments() == segments
+    for seq in segments:
+        log.remove(seq)
+    assert log.is_empty()
+
+
+def test_log_stray_files(tmp_path):
+    for name in ("spill-old.log", "spill-000000000001.log.tmp"):
+        (tmp_path / name).write_bytes(b"x")
+    log = SpillLog(str(tmp_path))
+    assert log.is_empty()
+    assert log.append([b"a"])
+    log.rotate()
+    assert log.segments() == [1]
+
+
+def test_log_locked(tmp_path):
+    log = SpillLog(str(tmp_path))
+    with pytest.raises(SpillLogLocked):
+        SpillLog(str(tmp_path))
+    log.close()
+    SpillLog(str(tmp_path)).close()
+
+
+def test_log_max_bytes(tmp_path):
+    log = SpillLog(str(tmp_path), max_bytes=50)
+    assert log.append([b"x" * 30])
+    assert not log.append([b"x" * 30])
+    assert log.size == 42
+
+
+def test_log_corrupt_record(tmp_path):
+    log = SpillLog(str(tmp_path))
+    log.append([b"first", b"second", b"third"])
+    log.rotate()
+    seq = log.segments()[0]
+    path = log._path(seq)
+    data = bytearray(open(path, "rb").read())
+    data[12 + 5 + 12] ^= 0xFF  # first byte of the second record
+    with open(path, "wb") as f:
+        f.write(data)
+    assert [r for r, _, _ in log.read(seq)] == [b"first"]
+
+
+def test_spill_and_replay(tmp_path):
+    inner = FlakySink()
+    sink = SpillingSink(inner, SpillLog(str(tmp_path)), batch_records=3, retry_interval=0.1)
+    try:
+        sink.write([b"a"])
+        inner.down = True
+        sink.write([b"b", b"c"])
+        sink.write([b"d"])
+        assert not sink.healthy
+        assert inner.records == [b"a"]
+        assert not sink.log.is_empty()
+
+        inner.down = False
+        assert wait_for(sink.log.is_empty)
+        assert sorted(inner.records) == [b"a", b"b", b"c", b"d"]
+        assert os.listdir(tmp_path) == []
+    finally:
+        sink.close()
+
+
+def test_failure_handler(tmp_path):
+    inner = FlakySink()
+    sink = SpillingSink(inner, SpillLog(str(tmp_path)), retry_interval=60)
+    try:
+        # asynchronous delivery failures are reported by the wrapped sink
+        assert inner.on_failure([b"late"], "timed out", keys=[b"user"])
+        assert not sink.healthy
+        sink.log.rotate()
+        seq = sink.log.segments()[0]
+        assert [(r, k) for r, k, _ in sink.log.read(seq)] == [(b"late", b"user")]
+    finally:
+        sink.close()
+
+
+def test_spill_full(tmp_path):
+    inner = FlakySink()
+    inner.down = True
+    sink = SpillingSink(inner, SpillLog(str(tmp_path), max_bytes=30), retry_interval=60)
+    try:
+        sink.write([b"x" * 10])
+        with pytest.raises(SinkFullError):
+            sink.write([b"x" * 10])
+    finally:
+        sink.close()
+
+
+def test_spill_full_with_batching(tmp_path):
+    inner = FlakySink()
+    inner.down = True
+    # room for two records of three bytes
+    sink = SpillingSink(inner, SpillLog(str(tmp_path), max_bytes=30), retry_interval=60)
+    batcher = BatchingSink(sink, linger_ms=10_000, retry_backoff_ms=10_000)
+    try:
+        batcher.write([b"abc"])
+        batcher.flush()
+        # the log has no room for the next batch, it stays buffered
+        batcher.write([b"defghi"])
+        batcher.flush()
+        assert batcher.queue_depth == 1
+        assert len(inner.records) == 0
+
+        sink.spill([b"jkl"])
+        assert sink.is_full()
+        # new records are rejected up front once the log is full
+        with pytest.raises(SinkFullError):
+            batcher.write([b"mno"])
+    finally:
+        batcher.close()
+
+
+def test_spill_partial_write(tmp_path):
+    inner = FlakySink()
+
+    def write(data):
+        inner.records.append(data[0])
+        raise SinkFullError("full", written=1)
+    inner.write = write
+    sink = SpillingSink(inner, SpillLog(str(tmp_path)), retry_interval=60)
+    try:
+        sink.write([b"a", b"b"])
+        sink.log.rotate()
+        seq = sink.log.segments()[0]
+        # only the record the wrapped sink did not take is spilled
+        assert [r for r, _, _ in sink.log.read(seq)] == [b"b"]
+    finally:
+        sink.close()
+
+
+def test_replay_partial_batch(tmp_path):
+    inner = FlakySink()
+    sink = SpillingSink(inner, SpillLog(str(tmp_path)), batch_records=3, retry_interval=60)
+    sink._stopped.set()
+    sink.spill([b"a", b"b", b"c", b"d", b"e"])
+
+    def write(data):
+        # the sink fills up after two records of every batch
+        inner.records.extend(data[:2])
+        if len(data) > 2:
+            raise SinkFullError("full", written=2)
+        return 0
+    inner.write = write
+    assert sink.replay() == 2
+    sink._retry_at = 0.0
+    assert sink.replay() == 2
+    sink._retry_at = 0.0
+    # the last partial batch of the segment
+    assert sink.replay() == 1
+    assert inner.records == [b"a", b"b", b"c", b"d", b"e"]
+    assert sink.log.is_empty()
+    sink.close()
@@ -1,8 +1,9 @@
-from typing import List
+from typing import List, Optional, Tuple
 
 from datenstrom.settings import BaseConfig, get_settings
-from datenstrom.common.schema.raw import CollectorPayload, ErrorPayload
-from datenstrom.processing.processor import RawEventProcessor
+from datenstrom.common.schema.raw import Payload, ErrorPayload
+from datenstrom.processing.processor import RawEventProcessor, close_all
+from datenstrom.connectors.keys import key_extractor
 from datenstrom.processing.raw_processor import RawProcessor
 from datenstrom.common.registry.base import SchemaNotFound, SchemaValidationError, InvalidSchemaError
 
@@ -33,18 +34,26 @@ class Enricher(RawEventProcessor):
             raise ValueError(f"Cannot use sink {transport} as enricher sink.")
 
         self.raw_processor = RawProcessor(config=config)
+        self.partition_key = key_extractor(config.get("partition_key_events"))
 
-    def enrich(self, event: CollectorPayload) -> List[bytes]:
+    def enrich(self, event: Payload) -> List[bytes]:
+        return self.enrich_with_keys(event)[0]
+
+    def enrich_with_keys(self, event: Payload) -> Tuple[List[bytes], List[Optional[bytes]]]:
+        """Enrich the event, keys are read from the atomic events before serializing."""
         atomic_events = self.raw_processor.process_raw_event(event)
         output_messages = []
+        keys = []
         for a in atomic_events:
             json_string = a.model_dump_json(by_alias=True)
             output_messages.append(json_string.encode("utf-8"))
-        return output_messages
+            if self.partition_key is not None:
+                keys.append(self.partition_key(a))
+        return output_messages, keys
 
-    def process_single(self, event: CollectorPayload) -> bool:
+    def process_single(self, event: Payload) -> bool:
         try:
-            enriched_events = self.enrich(event)
+            enriched_events, keys = self.enrich_with_keys(event)
         except SchemaNotFound as e:
             print(f"schema not found: {e}")
             error = ErrorPayload(collector_domain=event.hostname,
@@ -74,12 +83,18 @@ class Enricher(RawEventProcessor):
             self.error_sink.write([error.to_bytes()])
             return False
 
-        self.sink.write(enriched_events)
+        if self.partition_key is not None:
+            self.sink.write(enriched_events, keys=keys)
+        else:
+            self.sink.write(enriched_events)
         return True
 
-    def process(self, raw_events: List[CollectorPayload]) -> List[bool]:
+    def process(self, raw_events: List[Payload]) -> List[bool]:
         return [self.process_single(e) for e in raw_events]
 
+    def close(self):
+        close_all([self.sink, self.error_sink], self.source)
+
 
 if __name__ == "__main__":
     config = get_settings()
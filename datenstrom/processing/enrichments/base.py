@@ -3,14 +3,14 @@ from typing import Any, Optional, Dict, List, NamedTuple
 
 from pydantic import ValidationError
 
-from datenstrom.common.schema.raw import CollectorPayload
+from datenstrom.common.schema.raw import Payload
 from datenstrom.common.schema.atomic import AtomicEvent, SelfDescribingContext, SelfDescribingEvent
 
 
 class TemporaryAtomicEvent():
     MODEL_FIELDS = set(AtomicEvent.model_fields.keys())
 
-    def __init__(self, raw_event: CollectorPayload,
+    def __init__(self, raw_event: Payload,
                  initial_data: Optional[Dict] = None) -> None:
         self.raw_event = raw_event
         self.temp_data = initial_data or {}
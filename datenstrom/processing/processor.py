@@ -1,13 +1,39 @@
 import time
+import logging
 
 from typing import List, Literal, Union, Optional
 
-from datenstrom.common.schema.raw import CollectorPayload, ErrorPayload
+from datenstrom.common.schema.raw import RawCollectorPayload, ErrorPayload
 from datenstrom.common.schema.atomic import AtomicEvent
+from datenstrom.connectors.sinks.base import Sink
 from datenstrom.connectors.sinks.dev import DevSink
+from datenstrom.connectors.sources.base import Source
 # from datenstrom.common.registry import SchemaNotFound, SchemaError
 from signal import signal, SIGINT, SIGTERM
 from datenstrom.settings import BaseConfig
+from datenstrom.common.metrics import (
+    metrics,
+    SampledLogger,
+    setup_logging,
+    start_reporter,
+    stop_reporter,
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+def close_all(sinks: List[Sink], source: Optional[Source] = None):
+    for sink in sinks:
+        try:
+            sink.close()
+        except Exception as e:
+            logger.error("failed to close %s sink: %s", sink.queue_type, e)
+    if source is not None:
+        try:
+            source.close()
+        except Exception as e:
+            logger.error("failed to close source: %s", e)
 
 
 class SignalHandler:
@@ -24,6 +50,8 @@ class SignalHandler:
 class BaseProcessor:
     def __init__(self, config: BaseConfig, queue_type: Literal["raw", "events", "errors"]):
         self.config = config
+        self.queue_type = queue_type
+        self._sampled_logger = SampledLogger(logger, rate=config.log_sample_rate)
 
         if queue_type == "events":
             if config.atomic_event_transport:
@@ -65,14 +93,13 @@ class BaseProcessor:
             ev = message
         return ev
 
-    def _decode_raw_message(self, message: bytes) -> Optional[CollectorPayload]:
+    def _decode_raw_message(self, message: bytes) -> Optional[RawCollectorPayload]:
         try:
-            if self.config.record_format == "avro":
-                payload = CollectorPayload.from_avro(message)
-            elif self.config.record_format == "thrift":
-                payload = CollectorPayload.from_thrift(message)
+            # prefixed records are detected, others use the configured format
+            payload = RawCollectorPayload.decode(message, self.config.record_format)
         except ValueError as e:
-            print(f"cannot decode message: {e}")
+            metrics.incr("processor.decode_errors", queue=self.queue_type)
+            self._sampled_logger.debug("cannot decode message: %s", e)
             error = ErrorPayload(
                 collector_domain="unknown",
                 reason=f"cannot decode message: {e}",
@@ -86,7 +113,8 @@ class BaseProcessor:
         try:
             ev = AtomicEvent.model_validate_json(message)
         except ValueError as e:
-            print(f"cannot decode message: {e}")
+            metrics.incr("processor.decode_errors", queue=self.queue_type)
+            self._sampled_logger.debug("cannot decode message: %s", e)
             error = ErrorPayload(
                 collector_domain="unknown",
                 reason=f"cannot decode message: {e}",
@@ -99,11 +127,23 @@ class BaseProcessor:
     def process_events(self, events: List[AtomicEvent]) -> List[bool]:
         raise NotImplementedError("process_events not implemented")
     
-    def process_raw(self, raw_events: List[CollectorPayload]) -> List[bool]:
+    def process_raw(self, raw_events: List[RawCollectorPayload]) -> List[bool]:
         raise NotImplementedError("process_raw not implemented")
 
     def run(self):
         signal_handler = SignalHandler()
+        setup_logging(self.config.log_level)
+        start_reporter(self.config.metrics_interval)
+        queue = self.source.queue_type
+        try:
+            self._run(signal_handler, queue, self._sampled_logger)
+        finally:
+            self.close()
+            stop_reporter()
+
+    def _run(
+        self, signal_handler: SignalHandler, queue: str, sampled_logger: SampledLogger
+    ):
         while not signal_handler.received_signal:
             messages = self.source.read()
             if len(messages) == 0:
@@ -122,18 +162,26 @@ class BaseProcessor:
             for message in messages:
                 message.ack()
             t = (time.time() - t0) * 1000.0
-            if success_counter > 0 or error_counter > 0:
-                print(f"processed success={success_counter}, error={error_counter} in {t:.2f} milliseconds", flush=True)
+            metrics.incr("processor.batches", queue=queue)
+            metrics.incr("processor.success", success_counter, queue=queue)
+            metrics.incr("processor.error", error_counter, queue=queue)
+            metrics.incr("processor.time_ms", int(t), queue=queue)
+            sampled_logger.debug("processed success=%d, error=%d in %.2f milliseconds",
+                                 success_counter, error_counter, t)
+
+    def close(self):
+        """Flush and close the sinks and close the source."""
+        close_all([self.error_sink], self.source)
 
 
 class RawEventProcessor(BaseProcessor):
     def __init__(self, config: BaseConfig):
         super().__init__(config, queue_type="raw")
 
-    def process_raw(self, raw_events: List[CollectorPayload]) -> List[bool]:
+    def process_raw(self, raw_events: List[RawCollectorPayload]) -> List[bool]:
         return self.process(raw_events)
     
-    def process(self, raw_events: List[CollectorPayload]) -> List[bool]:
+    def process(self, raw_events: List[RawCollectorPayload]) -> List[bool]:
         raise NotImplementedError("please implement process method")
 
 
@@ -3,7 +3,7 @@ import orjson
 from typing import List, Optional, Dict, Any, Callable
 from urllib.parse import parse_qs
 
-from datenstrom.common.schema.raw import CollectorPayload
+from datenstrom.common.schema.raw import Payload
 from datenstrom.common.schema.atomic import AtomicEvent
 from datenstrom.common.registry.manager import RegistryManager
 from datenstrom.processing.enrichments.transformer import TransformEnrichment, transform_tstamp
@@ -16,9 +16,7 @@ from datenstrom.processing.enrichments.device import DeviceEnrichment
 from datenstrom.processing.enrichments.pii_processing import PIIProcessor
 from datenstrom.processing.version import VERSION
 from datenstrom.common.cache import CachedRequestClient
-
-
-httpclient = CachedRequestClient(maxsize=2048, ttl=3600, none_ttl=300)
+from datenstrom.common.http import HttpClient
 
 
 SP_PAYLOAD_SCHEMA_START = "iglu:com.snowplowanalytics.snowplow/payload_data/jsonschema/1"
@@ -61,6 +59,20 @@ class RawProcessor():
         self.registry = RegistryManager(config=config)
         self.enrichments = []
         self.config = config or {}
+        self.shared_config = None
+        self.httpclient = None
+        endpoint = self.config.get("remote_config_endpoint")
+        if endpoint and self.config.get("remote_config_shared"):
+            from datenstrom.common.shared_cache import SharedRemoteConfigClient
+            self.shared_config = SharedRemoteConfigClient.from_config(self.config)
+        elif endpoint:
+            self.httpclient = CachedRequestClient(
+                maxsize=2048, ttl=self.config.remote_config_ttl,
+                none_ttl=self.config.remote_config_none_ttl,
+                refresh_ratio=self.config.cache_refresh_ratio,
+                hot_reads=self.config.cache_hot_reads,
+                none_ttl_max=self.config.none_cache_ttl_max,
+                http=HttpClient.from_config(self.config))
         self.setup_enrichments(self.config)
 
     def setup_enrichments(self, config: Optional[Any] = None) -> None:
@@ -111,15 +123,20 @@ class RawProcessor():
         return [{"schema": data["schema"], "event": data["data"]}]
 
     def get_remote_config(self, hostname: str) -> Optional[RemoteEnrichmentConfig]:
-        if self.config.remote_config_endpoint:
+        config = None
+        if self.shared_config is not None:
+            # wait for the refresher on a miss, the config decides about pii processing
+            config = self.shared_config.get(hostname, wait=self.shared_config.timeout)
+        elif self.httpclient is not None:
             url = f"{self.config.remote_config_endpoint}?hostname={hostname}"
-            config = httpclient.get_json(url, timeout=5)
-            if config:
-                if "enable_full_ip" in config and isinstance(config["enable_full_ip"], bool):
-                    return RemoteEnrichmentConfig(enable_full_ip=config["enable_full_ip"])
+            timeout = (self.config.http_connect_timeout, self.config.remote_config_timeout)
+            config = self.httpclient.get_json(url, timeout=timeout)
+        if config:
+            if "enable_full_ip" in config and isinstance(config["enable_full_ip"], bool):
+                return RemoteEnrichmentConfig(enable_full_ip=config["enable_full_ip"])
         return None
 
-    def process_raw_event(self, raw_event: CollectorPayload) -> List[AtomicEvent]:
+    def process_raw_event(self, raw_event: Payload) -> List[AtomicEvent]:
         # get config for this host/collector
         remote_config = None
         if raw_event.hostname:
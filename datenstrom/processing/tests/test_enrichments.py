@@ -5,7 +5,8 @@ from unittest.mock import patch
 from datenstrom.processing.enrichments.geoip import GeoIPEnrichment
 from datenstrom.processing.enrichments.authentication import AuthenticationEnrichment
 from datenstrom.processing.enrichments.campaign import CampaignEnrichment
-from datenstrom.processing.enrichments.base import TemporaryAtomicEvent, CollectorPayload
+from datenstrom.processing.enrichments.base import TemporaryAtomicEvent
+from datenstrom.common.schema.raw import CollectorPayload
 from datenstrom.settings import get_test_settings
 
 
@@ -6,10 +6,12 @@ import copy
 import urllib.parse
 
 from datenstrom.processing.raw_processor import RawProcessor
+from datenstrom.processing.processor import RawEventProcessor
 from datenstrom.common.schema.raw import from_avro
 from datenstrom.settings import get_test_settings
 from datenstrom.processing.enrichments.base import TemporaryAtomicEvent
 from datenstrom.processing.enricher import Enricher
+from datenstrom.common.metrics import metrics
 
 test_config = get_test_settings()
 
@@ -117,6 +119,19 @@ def test_enricher_invalid_event():
     assert ev is False
 
 
+def test_enricher_detects_format_prefix():
+    d = load_data()
+    raw_event = d["webevent_get"]
+    enricher = Enricher(test_config)
+    assert test_config.record_format == "avro"
+
+    for format in ["avro", "thrift", "thrift-compact"]:
+        message = raw_event.serialize(format, prefix=True)
+        payload = enricher._decode_raw_message(message)
+        assert payload.querystring == raw_event.querystring
+        assert payload.body == raw_event.body
+
+
 def test_invalid_temporary_atomic_event():
     d = load_data()
     raw_event = d["webevent_get"]
@@ -156,3 +171,10 @@ def test_campaign_enrichment():
     assert device_info["schema"] == 'iglu:io.datenstrom/device_info/jsonschema/1-0-0'
     assert device_info["data"]["browser_family"] == 'Chrome'
     assert device_info["data"]["os_family"] == 'Windows'
+
+
+def test_decode_error():
+    p = RawEventProcessor(test_config)
+    metrics.snapshot()
+    assert p._decode_raw_message(b"not a payload") is None
+    assert metrics.snapshot()["processor.decode_errors{queue=raw}"] == 1
@@ -1,7 +1,8 @@
 import os
 
 from pathlib import Path
-from typing import Optional, List,  Tuple, Type, Literal, Dict
+from typing import Optional, List,  Tuple, Type, Literal, Dict, Union
+from pydantic import StrictBool, ValidationInfo, field_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict, PydanticBaseSettingsSource
 from functools import lru_cache
 
@@ -11,15 +12,44 @@ _config_dir = os.path.dirname(os.path.realpath(__file__))
 _base_dir = os.path.abspath(os.path.join(_config_dir, ".."))
 
 
+KafkaQueue = Literal["default", "raw", "events", "errors"]
+KafkaValue = Union[StrictBool, int, float, str]
+# set from kafka_brokers or managed by the connectors
+KAFKA_RESERVED_PROPERTIES = {
+    "kafka_producer_config": frozenset(["bootstrap.servers"]),
+    "kafka_consumer_config": frozenset(["bootstrap.servers", "enable.auto.commit"]),
+}
+
+
 class BaseConfig(BaseSettings):
     model_config = SettingsConfigDict(env_file_encoding='utf-8')
 
     base_dir: str = _base_dir
     asset_dir: str = os.path.join(_base_dir, "assets")
     max_bytes: int = 190000  # 190 kB < 256 kb after base64 for SQS
+    # request bodies above this size are rejected with a 413 while reading
+    max_body_bytes: int = 1_000_000
+    # gzip, deflate and br (needs brotli) request bodies are decoded up to this size
+    decode_content_encoding: bool = True
+    max_decoded_body_bytes: int = 5_000_000
+    # reject tp2 bodies that are not a self-describing JSON object with a data array
+    validate_tp2: bool = False
 
     add_vendor_paths: Optional[List[str]] = None
     enable_redirect_tracking: bool = False
+    collector_fast_path: bool = False
+
+    # collector server (datenstrom.collector.server), 0 workers means one per cpu
+    collector_host: str = "0.0.0.0"
+    collector_port: int = 8000
+    collector_workers: int = 0
+    collector_reuse_port: bool = True
+    collector_backlog: int = 2048
+    collector_graceful_timeout: int = 30
+
+    # None or ["*"] reflects any origin
+    cors_allowed_origins: Optional[List[str]] = None
+    cors_max_age: int = 3600
 
     iglu_schema_registries: List[str] = [
         "http://iglucentral.com/schemas/",
@@ -33,7 +63,9 @@ class BaseConfig(BaseSettings):
     campaign_enrichment_enabled: bool = True
     device_enrichment_enabled: bool = True
 
-    record_format: Literal["thrift", "avro"] = "avro"
+    record_format: Literal["thrift", "thrift-compact", "avro"] = "avro"
+    # prefix raw records with a format byte (the enricher detects it per message)
+    record_format_prefix: bool = False
     transport: Literal["kafka", "sqs", "dev"]
     atomic_event_transport: Optional[Literal["dev", "kafka", "sqs"]] = None
 
@@ -48,6 +80,49 @@ class BaseConfig(BaseSettings):
     kafka_topic_events: Optional[str] = None
     kafka_topic_errors: Optional[str] = None
     kafka_brokers: Optional[str] = None
+    # librdkafka properties per queue type ("default" applies to all), e.g.
+    # {"default": {"linger.ms": 20, "compression.type": "lz4"}, "raw": {"acks": "all"}}
+    kafka_producer_config: Dict[KafkaQueue, Dict[str, KafkaValue]] = {}
+    kafka_consumer_config: Dict[KafkaQueue, Dict[str, KafkaValue]] = {}
+    # message keys (kafka partitioning): a raw payload attribute and an atomic event field
+    partition_key_raw: Optional[Literal["networkUserId", "ipAddress", "hostname"]] = None
+    partition_key_events: Optional[Literal["domain_userid", "network_userid",
+                                           "user_id", "app_id"]] = None
+    # seconds a sink waits for outstanding deliveries on close
+    sink_close_timeout: float = 10.0
+
+    collector_batch_enabled: bool = True
+    collector_batch_max_records: int = 500
+    collector_batch_max_bytes: int = 1_000_000
+    collector_batch_linger_ms: int = 20
+    # requests get a 503 once the batching buffer holds this many records or bytes
+    collector_batch_max_buffer_records: int = 100_000
+    collector_batch_max_buffer_bytes: int = 128 * 1024 * 1024
+
+    # reject requests with a 503 while the sink backlog is above these limits
+    admission_enabled: bool = True
+    admission_max_records: int = 100_000
+    admission_max_bytes: int = 128 * 1024 * 1024
+    admission_low_water: float = 0.5
+    admission_retry_after: int = 5
+
+    # spill raw records to a local log while the sink is unavailable,
+    # implies collector batching
+    spill_enabled: bool = False
+    # with several collector workers each one spills to worker-<index> below this directory,
+    # only datenstrom.collector.server does that, other servers spill in one worker only
+    spill_directory: str = "/tmp/datenstrom-spill"
+    spill_segment_bytes: int = 64 * 1024 * 1024
+    spill_max_bytes: int = 1024 * 1024 * 1024
+    spill_fsync: bool = False
+    spill_replay_batch_records: int = 1000
+    spill_retry_interval: float = 5.0
+
+    # record level compression in the sinks (zstd and lz4 need the optional packages)
+    compression: Optional[Literal["zlib", "zstd", "lz4"]] = None
+    compression_level: Optional[int] = None
+    compression_min_bytes: int = 256
+    compression_queues: List[str] = ["raw", "events"]
 
     cookie_enabled: bool = True
     cookie_expiration_days: int = 365
@@ -56,6 +131,10 @@ class BaseConfig(BaseSettings):
     cookie_http_only: bool = True
     cookie_same_site: str = "None"
 
+    # request headers captured in raw records, entries ending with * match prefixes
+    header_allowlist: Optional[List[str]] = None
+    header_denylist: Optional[List[str]] = None
+
     cookie_domains: Optional[List[str]] = None
     cookie_fallback_domain: Optional[str] = None
 
@@ -66,8 +145,53 @@ class BaseConfig(BaseSettings):
 
     default_cache_ttl: int = 3600
     none_cache_ttl: int = 60
+    # cached values older than ratio * ttl are served and refreshed in the background,
+    # values read cache_hot_reads times are refreshed without waiting for a read
+    cache_refresh_ratio: Optional[float] = 0.8
+    cache_hot_reads: Optional[int] = 10
+    # the ttl of None values and failed lookups doubles with every failure of a key in a row
+    none_cache_ttl_max: Optional[int] = 3600
+
+    # outgoing requests of the remote config and iglu registry clients
+    http_connect_timeout: float = 3.0
+    http_read_timeout: float = 10.0
+    # retries of failed GET requests, with exponential backoff and jitter
+    http_retries: int = 2
+    http_retry_backoff: float = 0.2
+    # keep-alive connections and concurrent requests per endpoint
+    http_pool_size: int = 10
+    http_max_concurrency: int = 10
+    # open the circuit of an endpoint after this many failed requests in a row (0 disables),
+    # the first trial request is sent after http_circuit_reset seconds,
+    # doubling up to the max
+    http_circuit_failures: int = 5
+    http_circuit_reset: float = 5.0
+    http_circuit_reset_max: float = 300.0
+
+    log_level: str = "INFO"
+    log_sample_rate: float = 0.01
+    metrics_interval: int = 60
 
     remote_config_endpoint: Optional[str] = None
+    remote_config_ttl: int = 3600
+    remote_config_none_ttl: int = 300
+    remote_config_timeout: float = 5.0
+    # share the remote config between all processes on a host (mmap file, one refresher)
+    remote_config_shared: bool = False
+    remote_config_shared_path: str = "/dev/shm/datenstrom-remote-config"
+    remote_config_shared_size: int = 4 * 1024 * 1024
+
+    @field_validator("kafka_producer_config", "kafka_consumer_config")
+    @classmethod
+    def check_kafka_config(cls, v, info: ValidationInfo):
+        reserved = KAFKA_RESERVED_PROPERTIES[info.field_name]
+        for queue_type, properties in v.items():
+            invalid = reserved.intersection(properties)
+            if invalid:
+                raise ValueError(
+                    f"Cannot set {', '.join(sorted(invalid))} for {queue_type}"
+                )
+        return v
 
     @classmethod
     def settings_customise_sources(